@@ -54,6 +54,8 @@ def main():
 
     config.carica_impostazioni()
     config.aggiorna_manico()
+    # Il banco di campioni del suono attivo si prepara in background mentre l'app si avvia
+    views.prepara_banco_campioni()
 
     import GBAudio
     try:
@@ -5,66 +5,216 @@
 
 import atexit
 import ctypes
+import hashlib
+import heapq
+import json
+import os
+import queue
 import re
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import sounddevice as sd
+from scipy import fft as sp_fft
 from scipy import signal
+from scipy.io import wavfile
+import audio_backend
+from audio_backend import WavWriter
 
 # --- Costanti Globali ---
-FS = 44100  # Aumentata frequenza di campionamento per KS
-BLOCK_SIZE = 256
+# Frequenza di campionamento nativa dell'uscita (44100 se non si può interrogare):
+# sintetizzando alla frequenza del dispositivo né PortAudio né il sistema ricampionano
+FS = audio_backend.native_samplerate()
+BLOCK_SIZE = audio_backend.ENGINE_BLOCK_SIZE
 HARMONICS = [1, 0.5, 0.33, 0.25, 0.2, 0.17, 0.14, 0.125, 0.11, 0.1, 0.09, 0.08, 0.07]
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Budget di memoria per la cache delle note renderizzate
+EXCITATION_SEED = 0  # Seme di default per il rumore delle eccitazioni Karplus-Strong
+EXCITATION_BANK_MAX_ENTRIES = 4096
+STRING_VOICE_WINDOW = 4096  # Campioni di uscita che una StringVoice accumula prima di riportare indietro la storia
+WAVETABLE_SIZE = 2048  # Campioni per ciclo delle tabelle d'onda (potenza di 2)
+COMMAND_QUEUE_SIZE = 256  # Comandi UI -> callback audio in attesa (potenza di 2)
+RELEASE_MS = 80  # Rampa di rilascio sul note-off
+DEFAULT_POLYPHONY = 16
+SCHEDULE_LEAD = 0.1  # Anticipo (s) con cui la UI programma i passi successivi di una sequenza a tempo
+TAIL_THRESHOLD_DB = -90.0  # Sotto questa soglia (dBFS) la coda di una nota è considerata silenzio
+OFFLINE_BLOCK_SIZE = 4096  # Campioni per blocco nel rendering su file
+RENDER_WORKERS = 2  # Thread del pool di rendering in background (lfilter rilascia il GIL)
+BODY_IR_MAX_SECONDS = 2.0  # Le risposte all'impulso della cassa vengono troncate a questa durata
+BODY_MIX_DEFAULT = 0.5  # Proporzione di suono con la cassa (0 = solo corde, 1 = solo cassa)
+SAMPLE_BANK_DIR = "samplebank"  # Cartella dei banchi di campioni su disco
+SAMPLE_BANK_MAX_FILES = 6  # Banchi conservati (strumenti/suoni diversi); i più vecchi vengono rimossi
+SAMPLE_BANK_VERSION = 1  # Da incrementare se cambia la sintesi, per invalidare i banchi esistenti
+MIDI_IN_BUS = "midi_in"  # Bus del motore audio su cui suonano le note della tastiera MIDI
+MIDI_VELOCITY_LAYERS = 8  # Livelli di dinamica: velocity vicine condividono lo stesso render in cache
+MIDI_VELOCITY_CURVE = 2.0  # Ampiezza proporzionale a (velocity/127)^curva
+MIDI_VELOCITY_TIMBRE = 0.5  # Quanto si scurisce una nota suonata piano (0 = timbro fisso)
+SAMPLE_BANK_RATES = audio_backend.SUPPORTED_SAMPLE_RATES  # Frequenze da cui un banco può essere ricampionato
+
+NOTE_TABLE_OCTAVES = range(0, 10)  # Ottave precalcolate; le altre passano dal parser
+
+_NOTE_LETTERS = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+# Suffissi microtonali, dal più lungo al più corto: (offset per la frequenza, offset per il MIDI)
+_NOTE_MICROS = [("~~", 1.5, 1), ("``", -1.5, -1), ("~", 0.5, 0), ("`", -0.5, 0)]
+
+def _parse_note(note):
+    """
+    Analizza un nome di nota (es. "C#4", "E-4", "F~5").
+    Restituisce (numero MIDI con i microtoni, numero MIDI intero) oppure None se non è valido.
+    """
+    note_lower = note.lower().replace('-', 'b')
+    match_octave = re.search(r"\d+$", note_lower)
+    if not match_octave:
+        return None
+    octave_str = match_octave.group()
+    octave = int(octave_str)
+    note_base = note_lower[:-len(octave_str)]
+
+    micro_freq, micro_midi = 0.0, 0
+    for micro, offset_freq, offset_midi in _NOTE_MICROS:
+        if note_base.endswith(micro):
+            micro_freq, micro_midi = offset_freq, offset_midi
+            note_base = note_base[:-len(micro)]
+            break
+
+    match_std = re.match(r"^([a-g])([#b]?)$", note_base)
+    if not match_std:
+        return None
+    note_letter, accidental = match_std.groups()
+    semitone = _NOTE_LETTERS[note_letter]
+    if accidental == '#':
+        semitone += 1
+    elif accidental == 'b':
+        semitone -= 1
+    midi_num = 12 + semitone + 12 * octave
+    return midi_num + micro_freq, int(round(midi_num + micro_midi))
+
+def midi_to_freq(midi_num):
+    """Numero MIDI (anche frazionario, anche array) -> frequenza in Hz."""
+    if np.ndim(midi_num):
+        return 440.0 * (2.0 ** ((np.asarray(midi_num, dtype=np.float64) - 69) / 12.0))
+    return 440.0 * (2.0 ** ((midi_num - 69) / 12.0))
+
+def _build_note_tables():
+    """Tabelle nome -> Hz e nome -> MIDI per ogni lettera, alterazione, microtono e ottava supportati."""
+    freqs = {'p': 0.0, 'P': 0.0}
+    midis = {'p': None, 'P': None}
+    micros = [''] + [m for m, _, _ in _NOTE_MICROS]
+    for letter in _NOTE_LETTERS:
+        for l in (letter, letter.upper()):
+            for accidental in ('', '#', 'b', 'B', '-'):
+                for micro in micros:
+                    for octave in NOTE_TABLE_OCTAVES:
+                        name = f"{l}{accidental}{micro}{octave}"
+                        parsed = _parse_note(name)
+                        if parsed is not None:
+                            freqs[name] = midi_to_freq(parsed[0])
+                            midis[name] = parsed[1]
+    return freqs, midis
+
+_NOTE_FREQ_TABLE, _NOTE_MIDI_TABLE = _build_note_tables()
+_NOTE_MISSING = object()
 
 def note_to_freq(note):
-    """Converte la notazione (es. "C4", "F~5", "B`5") in frequenza (Hz)."""
+    """Converte la notazione (es. "C4", "F~5", "B`5") in frequenza (Hz). 0.0 per pause e nomi non validi."""
     if isinstance(note, (int, float)): return float(note)
     if isinstance(note, str):
-        note_lower = note.lower()
-        if note_lower == 'p': return 0.0 # Pausa
-        note_lower = note_lower.replace('-', 'b')
-        
-        # Estrai l'ottava (cifre finali)
-        match_octave = re.search(r"\d+$", note_lower)
-        if not match_octave:
-            return 0.0
-        octave_str = match_octave.group()
-        try:
-            octave = int(octave_str)
-        except ValueError:
-            return 0.0
-            
-        # Rimuovi l'ottava per ottenere la nota e le alterazioni
-        note_base = note_lower[:-len(octave_str)]
-        
-        # Estrai i simboli microtonali alla fine di note_base
-        micro_offset = 0.0
-        # Ordina dal più lungo al più corto per evitare match parziali
-        possible_micros = [("~~", 1.5), ("``", -1.5), ("~", 0.5), ("`", -0.5)]
-        for micro, offset in possible_micros:
-            if note_base.endswith(micro):
-                micro_offset = offset
-                note_base = note_base[:-len(micro)]
-                break
-                
-        # Ora note_base contiene solo la nota e le alterazioni standard (es. "c", "c#", "eb")
-        match_std = re.match(r"^([a-g])([#b]?)$", note_base)
-        if not match_std:
-            return 0.0
-        note_letter, accidental = match_std.groups()
+        freq = _NOTE_FREQ_TABLE.get(note)
+        if freq is not None:
+            return freq
+        parsed = _parse_note(note)
+        return 0.0 if parsed is None else midi_to_freq(parsed[0])
+    return 0.0
+
+def notes_to_freqs(notes):
+    """
+    Versione vettoriale di note_to_freq: converte un'intera lista di nomi di nota
+    (o numeri, anche di NumPy, o None per le pause) in un array float64 di frequenze.
+    """
+    notes = list(notes)
+    table = _NOTE_FREQ_TABLE
+    def _one(n):
+        if isinstance(n, str):
+            freq = table.get(n)
+            return note_to_freq(n) if freq is None else freq
+        return float(n) if n else 0.0
+    return np.fromiter((_one(n) for n in notes), dtype=np.float64, count=len(notes))
+
+class ExcitationBank:
+    """
+    Banco condiviso delle eccitazioni Karplus-Strong già pronte.
+    Chiave: (seme, L, durezza, ritardo del plettro). Il rumore è generato con un
+    seme derivato da (seme, L), quindi la stessa corda ha sempre la stessa
+    eccitazione, da qualunque renderer venga chiesta.
+    """
+    def __init__(self, seed=EXCITATION_SEED, max_entries=EXCITATION_BANK_MAX_ENTRIES):
+        self.seed = seed
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._harmonics = {}
+        self._lock = threading.Lock()
+
+    def _harmonics_for(self, L):
+        harmonics = self._harmonics.get(L)
+        if harmonics is None:
+            t = np.linspace(0., 1., L, endpoint=False)
+            harmonics = np.zeros(L, dtype=np.float32)
+            base_amps = [1.0, 0.5, 0.25, 0.12, 0.06, 0.03]
+            for i, amp in enumerate(base_amps):
+                harmonics += amp * np.sin(2 * np.pi * (i + 1) * t)
+            self._harmonics[L] = harmonics
+        return harmonics
+
+    def _build(self, L, pluck_hardness, pick_delay, seed):
+        noise = np.random.default_rng([seed, L]).uniform(-1, 1, L).astype(np.float32)
+        excitation = (noise * (1.0 - pluck_hardness)) + (self._harmonics_for(L) * pluck_hardness)
         
-        note_base_semitones = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
-        semitone = note_base_semitones[note_letter]
-        if accidental == '#':
-            semitone += 1
-        elif accidental == 'b':
-            semitone -= 1
+        # Effetto Comb Filter per la posizione del plettro
+        if pick_delay > 0:
+            excitation = excitation - np.roll(excitation, pick_delay)
             
-        midi_num = 12 + semitone + 12 * octave + micro_offset
-        freq = 440.0 * (2.0 ** ((midi_num - 69) / 12.0))
-        return freq
-    return 0.0
+        max_e = np.max(np.abs(excitation))
+        if max_e > 0: excitation /= max_e
+        excitation.flags.writeable = False
+        return excitation
+
+    def get(self, L, pluck_hardness, pick_position, seed=None):
+        """Restituisce l'eccitazione normalizzata (sola lettura) lunga L campioni."""
+        seed = self.seed if seed is None else seed
+        pick_delay = int(pick_position * L)
+        key = (seed, L, round(float(pluck_hardness), 4), pick_delay)
+        with self._lock:
+            excitation = self._items.get(key)
+            if excitation is not None:
+                self._items.move_to_end(key)
+                return excitation
+            excitation = self._build(L, pluck_hardness, pick_delay, seed)
+            self._items[key] = excitation
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            return excitation
+
+    def precompute(self, freqs, pluck_hardness, pick_position, fs=FS, seed=None):
+        """Prepara in anticipo le eccitazioni per un insieme di frequenze (es. le note di uno strumento)."""
+        for freq in freqs:
+            if freq and freq > 0:
+                L = int(fs / freq)
+                if L > 1:
+                    self.get(L, pluck_hardness, pick_position, seed)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._harmonics.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+_excitation_bank = ExcitationBank()
+
+def get_excitation_bank():
+    """Restituisce il banco condiviso delle eccitazioni Karplus-Strong."""
+    return _excitation_bank
 
 class FastGuitarSynth:
     """
@@ -72,8 +222,28 @@ class FastGuitarSynth:
     Usa scipy.signal.lfilter per generare l'intero decadimento istantaneamente in C,
     senza lenti cicli for in Python. Aggiunge pick_position per maggior realismo.
     """
-    def __init__(self, fs=FS):
+    def __init__(self, fs=FS, seed=None):
         self.fs = fs
+        # Seme del rumore: a parità di seme l'eccitazione è riproducibile (default EXCITATION_SEED)
+        self.seed = EXCITATION_SEED if seed is None else seed
+
+    def _build_excitation(self, L, pluck_hardness, pick_position):
+        """Eccitazione iniziale (Rumore + Armoniche) lunga L campioni, presa dal banco condiviso."""
+        return _excitation_bank.get(L, pluck_hardness, pick_position, self.seed)
+
+    def _build_coefficients(self, L, damping_factor, brightness):
+        """
+        Calcola i coefficienti del filtro Karplus-Strong.
+        Eq: y[n] = x[n] + damping * ( (1-S)*y[n-L] + S*y[n-L-1] )
+        S = brightness (0.5 = media standard, <0.5 = più brillante)
+        """
+        a = np.zeros(L + 2, dtype=np.float32)
+        a[0] = 1.0
+        a[L] = -damping_factor * (1.0 - brightness)
+        a[L+1] = -damping_factor * brightness
+        # Tutto in float32: così lfilter lavora e restituisce in singola precisione
+        b = np.ones(1, dtype=np.float32)
+        return b, a
 
     def render_string(self, freq, dur, vol, pluck_hardness=0.6, damping_factor=0.996, pick_position=0.15, brightness=0.4):
         if freq <= 0: return np.zeros(0, dtype=np.float32)
@@ -83,131 +253,975 @@ class FastGuitarSynth:
         if L <= 1: return np.zeros(N_samples, dtype=np.float32)
         
         # 1. Generazione dell'eccitazione (Rumore + Armoniche)
-        noise = np.random.uniform(-1, 1, L).astype(np.float32)
-        
-        t = np.linspace(0., 1., L, endpoint=False)
-        harmonics = np.zeros(L, dtype=np.float32)
-        base_amps = [1.0, 0.5, 0.25, 0.12, 0.06, 0.03]
-        for i, amp in enumerate(base_amps):
-            harmonics += amp * np.sin(2 * np.pi * (i + 1) * t)
-            
-        excitation = (noise * (1.0 - pluck_hardness)) + (harmonics * pluck_hardness)
-        
-        # Effetto Comb Filter per la posizione del plettro
-        pick_delay = int(pick_position * L)
-        if pick_delay > 0:
-            excitation = excitation - np.roll(excitation, pick_delay)
-            
-        max_e = np.max(np.abs(excitation))
-        if max_e > 0: excitation /= max_e
+        excitation = self._build_excitation(L, pluck_hardness, pick_position)
         
-        # 2. Prepara l'input per il filtro IIR
+        # 2. Prepara l'input per il filtro IIR, già scalato:
+        # il picco dell'uscita coincide con quello dell'eccitazione (vedi create_voice),
+        # quindi normalizzazione e volume si applicano ai soli L campioni d'ingresso
         x = np.zeros(N_samples, dtype=np.float32)
         actual_L = min(L, N_samples)
-        x[:actual_L] = excitation[:actual_L]
+        max_x = np.max(np.abs(excitation[:actual_L]))
+        if max_x > 0:
+            np.multiply(excitation[:actual_L], vol / max_x, out=x[:actual_L])
         
         # 3. Calcola i coefficienti del filtro Karplus-Strong
-        # Eq: y[n] = x[n] + damping * ( (1-S)*y[n-L] + S*y[n-L-1] )
-        # S = brightness (0.5 = media standard, <0.5 = più brillante)
-        a = np.zeros(L + 2, dtype=np.float32)
-        a[0] = 1.0
-        a[L] = -damping_factor * (1.0 - brightness)
-        a[L+1] = -damping_factor * brightness
-        b = [1.0]
+        b, a = self._build_coefficients(L, damping_factor, brightness)
         
-        # 4. Applica il filtro (Istantaneo in C)
-        y = signal.lfilter(b, a, x)
+        # 4. Applica il filtro (Istantaneo in C, in float32)
+        return signal.lfilter(b, a, x)
+
+    def render_strings(self, freqs, dur, vol, pluck_hardness=0.6, damping_factor=0.996, pick_position=0.15, brightness=0.4,
+                       seeds=None):
+        """
+        Versione a blocchi di render_string per più corde con parametri comuni.
+        Le corde con la stessa lunghezza di ritardo L condividono i coefficienti
+        e vengono filtrate con un'unica chiamata a lfilter su una matrice.
+        'seeds' dà il seme di ogni corda; di default le corde all'unisono ricevono
+        semi consecutivi. Restituisce una matrice (num_corde, N_samples).
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        N_samples = int(self.fs * dur)
+        out = np.zeros((len(freqs), N_samples), dtype=np.float32)
+        if N_samples <= 0: return out
+        
+        lengths = np.zeros(len(freqs), dtype=np.int64)
+        valid = freqs > 0
+        lengths[valid] = (self.fs / freqs[valid]).astype(np.int64)
+        
+        for L in np.unique(lengths[lengths > 1]):
+            rows = np.flatnonzero(lengths == L)
+            actual_L = min(int(L), N_samples)
+            x = np.zeros((len(rows), N_samples), dtype=np.float32)
+            for r in range(len(rows)):
+                # Corde all'unisono: semi diversi, altrimenti suonerebbero come una sola corda più forte
+                seed = self.seed + r if seeds is None else seeds[rows[r]]
+                exc = _excitation_bank.get(int(L), pluck_hardness, pick_position, seed)
+                max_x = np.max(np.abs(exc[:actual_L]))
+                if max_x > 0:
+                    np.multiply(exc[:actual_L], vol / max_x, out=x[r, :actual_L])
+            
+            b, a = self._build_coefficients(int(L), damping_factor, brightness)
+            out[rows] = signal.lfilter(b, a, x, axis=-1)
+        return out
+
+    def create_voice(self, freq, dur, vol, pluck_hardness=0.6, damping_factor=0.996, pick_position=0.15, brightness=0.4,
+                     tail_db=TAIL_THRESHOLD_DB):
+        """
+        Crea una StringVoice che sintetizza la stessa nota di render_string,
+        ma un blocco alla volta: il costo iniziale è solo quello dell'eccitazione.
+        La voce termina da sola quando scende sotto tail_db.
+        """
+        if freq <= 0: return None
+        N_samples = int(self.fs * dur)
+        L = int(self.fs / freq)
+        if L <= 1 or N_samples <= 0: return None
         
-        max_y = np.max(np.abs(y))
-        if max_y > 0: y /= max_y
+        excitation = self._build_excitation(L, pluck_hardness, pick_position)
+        b, a = self._build_coefficients(L, damping_factor, brightness)
         
-        y *= vol
-        return y.astype(np.float32)
+        # Per n >= L il filtro è una media pesata e smorzata dei campioni passati,
+        # quindi il picco dell'uscita coincide con quello dell'eccitazione che entra:
+        # lo stesso fattore di normalizzazione di render_string, noto in anticipo.
+        actual_L = min(L, N_samples)
+        max_x = np.max(np.abs(excitation[:actual_L]))
+        gain = vol / max_x if max_x > 0 else 0.0
+        return StringVoice(b, a, excitation[:actual_L], N_samples, gain, tail_db=tail_db)
+
+_EMPTY_BLOCK = np.zeros(0, dtype=np.float32)
+
+def _db_to_amp(threshold_db):
+    return 0.0 if threshold_db is None else 10.0 ** (threshold_db / 20.0)
+
+def _tail_length(wave, threshold_db=TAIL_THRESHOLD_DB):
+    """Numero di campioni fino all'ultimo sopra la soglia (None = tutta la nota)."""
+    if threshold_db is None or len(wave) == 0:
+        return len(wave)
+    above = np.flatnonzero(np.abs(wave) > _db_to_amp(threshold_db))
+    return int(above[-1]) + 1 if len(above) else 0
+
+def resample(wave, from_fs, to_fs, axis=0):
+    """Ricampiona con un filtro polifase (resample_poly) da from_fs a to_fs; float32 in uscita."""
+    from_fs, to_fs = int(from_fs), int(to_fs)
+    if from_fs == to_fs:
+        return np.asarray(wave, dtype=np.float32)
+    g = np.gcd(from_fs, to_fs)
+    return signal.resample_poly(np.asarray(wave, dtype=np.float32), to_fs // g, from_fs // g, axis=axis).astype(np.float32, copy=False)
+
+def _trim_tail(wave, threshold_db=TAIL_THRESHOLD_DB):
+    """Taglia la coda della nota dopo l'ultimo campione sopra la soglia (None = nessun taglio)."""
+    end = _tail_length(wave, threshold_db)
+    if end >= len(wave):
+        return wave
+    # Copia, così il buffer lungo originale può essere liberato
+    return wave[:end].copy()
+
+class BufferVoice:
+    """Voce che legge un buffer mono già renderizzato, un blocco alla volta."""
+    def __init__(self, audio_mono):
+        self.audio = audio_mono
+        self.pos = 0
+
+    @property
+    def finished(self):
+        return self.pos >= len(self.audio)
+
+    def read(self, frames):
+        """Restituisce fino a 'frames' campioni (vista sul buffer, nessuna copia)."""
+        start = self.pos
+        end = min(start + frames, len(self.audio))
+        self.pos = end
+        return self.audio[start:end]
+
+    def read_into(self, out):
+        """Copia i prossimi campioni in 'out' (senza allocare). Restituisce quanti ne ha scritti."""
+        start = self.pos
+        n = min(len(out), len(self.audio) - start)
+        if n <= 0:
+            return 0
+        np.copyto(out[:n], self.audio[start:start + n])
+        self.pos = start + n
+        return n
+
+    def stop(self):
+        self.pos = len(self.audio)
+
+class StringVoice:
+    """
+    Voce Karplus-Strong in streaming. Invece di un buffer pre-renderizzato di
+    molti secondi, conserva solo l'eccitazione e le ultime L+1 uscite del filtro,
+    e sintetizza ogni blocco direttamente nella callback audio.
+    Il filtro y[n] = x[n] + c1*y[n-L] + c2*y[n-L-1] è calcolato a tratti di al più
+    L campioni dentro una finestra preallocata: nessuna allocazione per blocco.
+    La memoria occupata dipende da L, non dalla durata della nota.
+    Finita l'eccitazione, la voce si chiude appena un blocco resta sotto tail_db.
+    """
+    def __init__(self, b, a, excitation, n_samples, gain, tail_db=TAIL_THRESHOLD_DB):
+        self.b = b
+        self.a = a
+        self.excitation = excitation
+        self.n_samples = n_samples
+        self.gain = gain
+        self.pos = 0
+        self.tail_amp = _db_to_amp(tail_db)
+        # Coefficienti di _build_coefficients: a = [1, 0, ..., -c1, -c2], b = [1]
+        self._L = len(a) - 2
+        self._c1 = np.float32(-a[self._L])
+        self._c2 = np.float32(-a[self._L + 1])
+        # Finestra di uscita: le prime L+1 posizioni sono la storia, poi si scrive in avanti
+        self._history = self._L + 1
+        self._window = np.zeros(self._history + max(STRING_VOICE_WINDOW, self._history), dtype=np.float32)
+        self._write = self._history
+        self._tmp = np.empty(self._L, dtype=np.float32)
+
+    @property
+    def finished(self):
+        return self.pos >= self.n_samples
+
+    def read(self, frames):
+        """Sintetizza i prossimi 'frames' campioni, portando avanti lo stato del filtro."""
+        n = min(frames, self.n_samples - self.pos)
+        if n <= 0:
+            return _EMPTY_BLOCK
+        y = self._filter_block(n) * self.gain
+        self._check_tail(y)
+        return y
+
+    def read_into(self, out):
+        """Sintetizza direttamente in 'out'. Restituisce quanti campioni ha scritto."""
+        n = min(len(out), self.n_samples - self.pos)
+        if n <= 0:
+            return 0
+        np.multiply(self._filter_block(n), self.gain, out=out[:n])
+        self._check_tail(out[:n])
+        return n
+
+    def _check_tail(self, block):
+        if self.pos > len(self.excitation) and max(block.max(), -block.min()) < self.tail_amp:
+            self.stop()
+
+    def stop(self):
+        self.pos = self.n_samples
+
+    def _filter_block(self, n):
+        """
+        Calcola i prossimi n campioni (senza guadagno) e li restituisce come vista
+        sulla finestra interna, valida fino alla chiamata successiva.
+        """
+        win = self._window
+        L, hist = self._L, self._history
+        if self._write + n > len(win):
+            if n > len(win) - hist:
+                # Blocco più grande della finestra: succede solo fuori dalla callback
+                self._window = win = np.concatenate((win[self._write - hist:self._write], np.zeros(n, dtype=np.float32)))
+            else:
+                # Riporta la storia all'inizio (le due zone non si sovrappongono)
+                win[:hist] = win[self._write - hist:self._write]
+            self._write = hist
+        start = self._write
+        exc_len = len(self.excitation)
+        done = 0
+        while done < n:
+            # Con m <= L ogni campione dipende solo da uscite già calcolate
+            m = min(L, n - done)
+            w = start + done
+            y = win[w:w + m]
+            tmp = self._tmp[:m]
+            np.multiply(win[w - L:w - L + m], self._c1, out=y)
+            np.multiply(win[w - L - 1:w - L - 1 + m], self._c2, out=tmp)
+            y += tmp
+            # L'eccitazione entra nel filtro solo nei primi L campioni
+            p = self.pos + done
+            if p < exc_len:
+                exc_end = min(exc_len, p + m)
+                y[:exc_end - p] += self.excitation[p:exc_end]
+            done += m
+        self._write = start + n
+        self.pos += n
+        return win[start:start + n]
+
+class CommandRing:
+    """
+    Coda circolare a produttore singolo / consumatore singolo tra i thread
+    dell'interfaccia e la callback audio. Gli slot sono preallocati e i due
+    indici sono scritti ciascuno da un solo lato, quindi il consumatore
+    (la callback) non prende mai lock e non si blocca.
+    Più thread produttori vengono serializzati da un lock che usa solo chi scrive.
+    """
+    def __init__(self, size=COMMAND_QUEUE_SIZE):
+        if size & (size - 1):
+            raise ValueError("La dimensione della coda deve essere una potenza di 2")
+        self._slots = [None] * size
+        self._mask = size - 1
+        self._head = 0  # Scritto solo dal produttore
+        self._tail = 0  # Scritto solo dal consumatore
+        self._producer_lock = threading.Lock()
+
+    def push(self, cmd):
+        """Accoda un comando. Restituisce False se la coda è piena."""
+        with self._producer_lock:
+            head = self._head
+            if head - self._tail > self._mask:
+                return False
+            self._slots[head & self._mask] = cmd
+            # L'indice si pubblica solo dopo aver scritto lo slot
+            self._head = head + 1
+            return True
+
+    def pop(self):
+        """Estrae il prossimo comando, o None se la coda è vuota. Solo per il consumatore."""
+        tail = self._tail
+        if tail == self._head:
+            return None
+        idx = tail & self._mask
+        cmd = self._slots[idx]
+        self._slots[idx] = None
+        self._tail = tail + 1
+        return cmd
+
+    def __len__(self):
+        return self._head - self._tail
+
+def load_impulse_response(path, fs=FS, max_seconds=BODY_IR_MAX_SECONDS):
+    """
+    Legge una risposta all'impulso da un file WAV (mono o stereo, intero o float)
+    e la porta alla frequenza 'fs'. Restituisce una matrice float32 (campioni, canali)
+    normalizzata a guadagno massimo 1 in frequenza, oppure None in caso di errore.
+    """
+    try:
+        rate, data = wavfile.read(path)
+    except (OSError, ValueError) as e:
+        print(f"Impossibile leggere la risposta all'impulso '{path}': {e}")
+        return None
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        # I WAV a 8 bit sono senza segno, centrati su 128
+        data = (data.astype(np.float64) - (info.min + info.max + 1) / 2.0) / (info.max + 1 - (info.min + info.max + 1) / 2.0)
+    ir = np.asarray(data, dtype=np.float64)
+    if ir.ndim == 1:
+        ir = ir[:, None]
+    ir = ir[:, :2]
+    if rate != fs:
+        ir = resample(ir, rate, fs)
+    ir = ir[:int(max_seconds * fs)]
+    peak = np.abs(np.fft.rfft(ir, axis=0)).max() if len(ir) else 0.0
+    if peak <= 0.0:
+        print(f"La risposta all'impulso '{path}' è vuota o silenziosa.")
+        return None
+    ir = (ir / peak).astype(np.float32)
+    return ir[:max(1, _tail_length(np.abs(ir).max(axis=1)))]
+
+class PartitionedConvolver:
+    """
+    Convoluzione a blocchi uniformi nel dominio della frequenza (overlap-save con
+    linea di ritardo in frequenza), per applicare la risonanza della cassa al mix
+    in tempo reale. La risposta all'impulso è divisa in partizioni di 'block_size'
+    campioni, trasformate una volta sola: ogni blocco costa una FFT, un prodotto
+    con tutte le partizioni e una IFFT, indipendentemente dalla lunghezza della nota.
+    process() lavora in-place su blocchi stereo di qualsiasi lunghezza, con un
+    ritardo fisso di 'block_size' campioni (latency); il segnale diretto viene
+    ritardato allo stesso modo, così 'mix' non produce effetti di pettine.
+    """
+    def __init__(self, ir, block_size=BLOCK_SIZE, channels=2, mix=BODY_MIX_DEFAULT):
+        ir = np.asarray(ir, dtype=np.float32)
+        if ir.ndim == 1:
+            ir = ir[:, None]
+        if ir.shape[1] != channels:
+            ir = np.repeat(ir[:, :1], channels, axis=1)
+        B = int(block_size)
+        P = max(1, -(-len(ir) // B))
+        self.block_size = B
+        self.channels = channels
+        self.ir_length = len(ir)
+        self.latency = B
+        self.mix = float(np.clip(mix, 0.0, 1.0))
+
+        # Partizioni della IR, ciascuna seguita da B zeri: (P, canali, B+1)
+        parts = np.zeros((P, channels, 2 * B), dtype=np.float32)
+        padded = np.zeros((P * B, channels), dtype=np.float32)
+        padded[:len(ir)] = ir
+        parts[:, :, :B] = padded.reshape(P, B, channels).transpose(0, 2, 1)
+        H = sp_fft.rfft(parts, axis=2).astype(np.complex64)
+        # Il peso dello slot s della linea di ritardo è H[(pos - s) % P]: con H
+        # raddoppiata e rovesciata, i pesi di tutti gli slot sono una sola fetta
+        self._H_rev = np.concatenate((H, H))[::-1].copy()
+        self._partitions = P
+
+        self._fdl = np.zeros((P, channels, B + 1), dtype=np.complex64)
+        self._spectrum = np.zeros((channels, B + 1), dtype=np.complex64)
+        self._time_in = np.zeros((channels, 2 * B), dtype=np.float32)
+        self._in_fifo = np.zeros((B, channels), dtype=np.float32)
+        self._out_fifo = np.zeros((B, channels), dtype=np.float32)
+        self._fill = 0
+        self._pos = 0
+
+    @classmethod
+    def from_wav(cls, path, fs=FS, block_size=BLOCK_SIZE, mix=BODY_MIX_DEFAULT):
+        """Crea il convolutore da un file WAV, o restituisce None se non è leggibile."""
+        ir = load_impulse_response(path, fs)
+        if ir is None:
+            return None
+        return cls(ir, block_size=block_size, mix=mix)
+
+    def reset(self):
+        """Azzera lo stato (code della cassa comprese), es. dopo uno stop."""
+        self._fdl[:] = 0.0
+        self._time_in[:] = 0.0
+        self._in_fifo[:] = 0.0
+        self._out_fifo[:] = 0.0
+        self._fill = 0
+        self._pos = 0
+
+    def process(self, block):
+        """Sostituisce 'block' (campioni, canali) con il segnale convoluto, ritardato di 'latency' campioni."""
+        B = self.block_size
+        done = 0
+        frames = len(block)
+        while done < frames:
+            n = min(B - self._fill, frames - done)
+            chunk = block[done:done + n]
+            fill = self._fill
+            self._in_fifo[fill:fill + n] = chunk
+            chunk[:] = self._out_fifo[fill:fill + n]
+            self._fill = fill + n
+            done += n
+            if self._fill == B:
+                self._process_partition()
+                self._fill = 0
+        return block
+
+    def _process_partition(self):
+        B = self.block_size
+        P = self._partitions
+        x = self._in_fifo
+        t = self._time_in
+        t[:, :B] = t[:, B:]
+        t[:, B:] = x.T
+        self._fdl[self._pos] = sp_fft.rfft(t, axis=1)
+        weights = self._H_rev[P - 1 - self._pos:2 * P - 1 - self._pos]
+        np.einsum('pcf,pcf->cf', self._fdl, weights, out=self._spectrum)
+        wet = sp_fft.irfft(self._spectrum, n=2 * B, axis=1)[:, B:]
+        self._pos = (self._pos + 1) % P
+        # Uscita del prossimo giro: cassa + segnale diretto, allineati
+        np.multiply(wet.T, self.mix, out=self._out_fifo)
+        self._out_fifo += (1.0 - self.mix) * x
+
+# Comandi accettati dalla callback di PolyphonicPlayer
+_CMD_PLUCK = 0
+_CMD_MUTE = 1
+_CMD_PAN = 2
+_CMD_STOP = 3
+_CMD_RELEASE = 4
+_CMD_SCHEDULE = 5
+_CMD_CONVOLVER = 6
 
 class PolyphonicPlayer:
     """
     Motore di stream continuo. Mixa N canali (bus) indipendenti in real-time.
     Se una corda viene ri-suonata, il suo buffer si azzera e riparte,
     mentre le altre corde continuano a suonare.
+    La callback non alloca memoria: ogni voce scrive il suo blocco in una riga
+    di un'unica matrice preallocata, e il mix stereo è un solo prodotto matriciale
+    con i guadagni di panning, calcolati una volta in set_pan.
+    pluck, pluck_voice e mute accettano 'at', un istante in campioni sull'orologio
+    del player (vedi now/frames_from_now): l'evento scatta dentro la callback
+    esattamente su quel campione, anche a metà blocco.
+    Con set_convolver il mix passa da un PartitionedConvolver (risonanza della cassa).
+    Il player non apre uno stream: start() lo registra come bus 'name' sul motore
+    audio condiviso (audio_backend.AudioEngine), stop() lo toglie.
     """
-    def __init__(self, fs=FS, num_strings=6):
+    def __init__(self, fs=FS, num_strings=6, name=None, engine=None):
         self.fs = fs
         self.num_strings = num_strings
-        self.buses = [np.zeros(0, dtype=np.float32) for _ in range(num_strings)]
-        self.indices = [0 for _ in range(num_strings)]
+        self.name = name or f"voci-{id(self):x}"
+        # None = motore condiviso (audio_backend.get_engine), risolto all'avvio
+        self.engine = engine
+        # Ogni bus contiene una voce (BufferVoice o StringVoice) oppure None
+        self.buses = [None for _ in range(num_strings)]
         
-        # Panning base (modificabile via set_pan)
+        # Panning base (modificabile via set_pan) e relativi guadagni L/R
         self.pans = np.zeros(num_strings, dtype=np.float32)
+        self.gains = np.zeros((num_strings, 2), dtype=np.float32)
+        
+        # Buffer di lavoro della callback, preallocati
+        self._alloc_scratch(BLOCK_SIZE)
+        
+        # Rilascio in corso per bus: campioni mancanti e lunghezza totale della rampa
+        self._release_left = np.zeros(num_strings, dtype=np.int64)
+        self._release_len = np.ones(num_strings, dtype=np.int64)
+        # Picco dell'ultimo blocco di ogni bus (letto dal VoiceManager)
+        self.levels = np.zeros(num_strings, dtype=np.float32)
         
+        # Orologio in campioni: (campioni già prodotti, istante della callback)
+        self.frame_time = 0
+        self._clock = (0, time.perf_counter())
+        # Eventi programmati: heap di (campione, progressivo, comando), usato solo dalla callback
+        self._scheduled = []
+        self._schedule_seq = 0
+        # Risonanza della cassa sul mix (PartitionedConvolver) o None
+        self.convolver = None
+        # Carico della callback, xrun, voci e picchi (vedi audio_backend.CallbackStats).
+        # Una riga per bus: due player che suonano insieme non mescolano i loro numeri
+        self.stats = audio_backend.get_stats(f"PolyphonicPlayer {self.name}", fs)
+        
+        # Bus, pan e stop si modificano solo tramite comandi, mai direttamente dalla UI
+        self.commands = CommandRing()
         self.is_running = False
+        for i in range(num_strings):
+            self.set_pan(i, 0.0)
 
-        self.stream = sd.OutputStream(
-            samplerate=self.fs, channels=2, dtype=np.float32,
-            callback=self._audio_callback, latency='low'
-        )
+    def _alloc_scratch(self, frames):
+        self._scratch_frames = frames
+        self._voice_block = np.zeros((self.num_strings, frames), dtype=np.float32)
+        self._abs_block = np.zeros((self.num_strings, frames), dtype=np.float32)
+        self._row_used = np.zeros(self.num_strings, dtype=bool)
+        self._mix = np.zeros((frames, 2), dtype=np.float32)
+        self._frame_idx = np.arange(frames, dtype=np.float32)
+        self._ramp = np.zeros(frames, dtype=np.float32)
 
     def start(self):
         if not self.is_running:
-            self.stream.start()
+            if self.engine is None:
+                self.engine = audio_backend.get_engine()
+            if self.engine.samplerate != self.fs:
+                print(f"Attenzione: il player è a {self.fs} Hz ma il motore audio a {self.engine.samplerate} Hz.")
+            # Da qui in poi i comandi passano dalla coda, che la callback svuota appena parte
             self.is_running = True
+            self.engine.add_bus(self.name, self._audio_callback)
 
     def stop(self):
         if self.is_running:
-            self.stream.stop()
+            # La callback svuota i bus al prossimo blocco; altrimenti lo fa il drain qui sotto
+            self._send((_CMD_STOP, -1, None))
+            self.engine.remove_bus(self.name)
             self.is_running = False
+            self._drain_commands()
+
+    def now(self):
+        """Posizione attuale dell'orologio del player, in campioni (stimata tra una callback e l'altra)."""
+        frame, t = self._clock
+        if not self.is_running:
+            return frame
+        return frame + int((time.perf_counter() - t) * self.fs)
+
+    def frames_from_now(self, seconds=SCHEDULE_LEAD):
+        """Istante 'seconds' secondi nel futuro, da usare come 'at' o come ancora di una sequenza."""
+        return self.now() + int(round(seconds * self.fs))
+
+    def next_frame(self):
+        """
+        Primo campione del prossimo blocco: l'istante più vicino in cui può ancora suonare un evento.
+        È l'ancora giusta per ciò che parte alla pressione di un tasto (pennate, scale):
+        il primo evento suona subito e i successivi mantengono la spaziatura esatta.
+        """
+        return self.frame_time
+
+    def seconds_until(self, frame):
+        return (frame - self.now()) / self.fs
+
+    def _send(self, cmd, at=None):
+        """Passa un comando alla callback (subito o al campione 'at'). Se lo stream è fermo lo applica subito."""
+        if at is not None:
+            self._schedule_seq += 1
+            cmd = (_CMD_SCHEDULE, -1, (int(at), self._schedule_seq, cmd))
+        if not self.is_running:
+            self._apply_command(cmd)
+            return
+        for _ in range(200):
+            if self.commands.push(cmd):
+                return
+            # Coda piena: la callback la svuoterà al prossimo blocco
+            time.sleep(0.001)
+        print("Coda comandi audio piena: comando ignorato.")
 
     def set_pan(self, string_idx, pan_value):
         if 0 <= string_idx < self.num_strings:
-            self.pans[string_idx] = np.clip(pan_value, -1.0, 1.0)
+            self._send((_CMD_PAN, string_idx, float(np.clip(pan_value, -1.0, 1.0))))
 
-    def pluck(self, string_idx, audio_mono):
+    def pluck(self, string_idx, audio_mono, at=None):
         """Suona una corda. Sostituisce il suo bus interrompendone il suono precedente."""
+        self.pluck_voice(string_idx, BufferVoice(audio_mono), at)
+
+    def pluck_voice(self, string_idx, voice, at=None):
+        """Come pluck, ma con una voce già pronta (es. una StringVoice sintetizzata in streaming)."""
         if 0 <= string_idx < self.num_strings:
-            self.buses[string_idx] = audio_mono
-            self.indices[string_idx] = 0
+            self._send((_CMD_PLUCK, string_idx, voice), at)
 
-    def mute(self, string_idx=None):
-        """Silenzia una corda specifica o tutte."""
+    def release(self, string_idx, voice, release_ms=RELEASE_MS):
+        """Sfuma la voce sul bus in release_ms, se nel frattempo non è stata sostituita."""
+        if 0 <= string_idx < self.num_strings:
+            n = max(1, int(self.fs * release_ms / 1000.0))
+            self._send((_CMD_RELEASE, string_idx, (voice, n)))
+
+    def mute(self, string_idx=None, at=None):
+        """Silenzia una corda specifica o tutte. Il mute di tutte cancella anche gli eventi programmati."""
         if string_idx is None:
-            for i in range(self.num_strings):
-                self.buses[i] = np.zeros(0, dtype=np.float32)
-                self.indices[i] = 0
+            self._send((_CMD_MUTE, -1, None), at)
         elif 0 <= string_idx < self.num_strings:
-            self.buses[string_idx] = np.zeros(0, dtype=np.float32)
-            self.indices[string_idx] = 0
+            self._send((_CMD_MUTE, string_idx, None), at)
+
+    def set_convolver(self, convolver):
+        """Applica al mix un PartitionedConvolver (None per disattivarlo)."""
+        self._send((_CMD_CONVOLVER, -1, convolver))
+
+    def _apply_command(self, cmd):
+        op, idx, arg = cmd
+        if op == _CMD_PLUCK:
+            self._drop_voice(idx)
+            self.buses[idx] = arg
+        elif op == _CMD_RELEASE:
+            voice, n = arg
+            if self.buses[idx] is voice and self._release_left[idx] == 0:
+                self._release_left[idx] = n
+                self._release_len[idx] = n
+        elif op == _CMD_PAN:
+            self.pans[idx] = arg
+            self.gains[idx, 0] = np.cos((arg + 1.0) * np.pi / 4.0)
+            self.gains[idx, 1] = np.sin((arg + 1.0) * np.pi / 4.0)
+        elif op == _CMD_SCHEDULE:
+            heapq.heappush(self._scheduled, arg)
+        elif op == _CMD_CONVOLVER:
+            self.convolver = arg
+        elif op == _CMD_MUTE and idx >= 0:
+            self._drop_voice(idx)
+        else:  # mute di tutte le corde o stop
+            self._scheduled.clear()
+            for i in range(self.num_strings):
+                self._drop_voice(i)
+            if self.convolver is not None:
+                self.convolver.reset()
+
+    def _drop_voice(self, idx):
+        """Toglie la voce dal bus segnandola come finita."""
+        voice = self.buses[idx]
+        if voice is not None:
+            voice.stop()
+            self.buses[idx] = None
+        self._release_left[idx] = 0
+
+    def _drain_commands(self):
+        cmd = self.commands.pop()
+        while cmd is not None:
+            self._apply_command(cmd)
+            cmd = self.commands.pop()
+
+    def _audio_callback(self, outdata, frames, time_info, status):
+        t0 = time.perf_counter()
+        # I cambi di voce arrivano solo qui, all'inizio del blocco
+        self._drain_commands()
+        if frames != self._scratch_frames:
+            # Succede solo se lo stream cambia dimensione di blocco
+            self._alloc_scratch(frames)
+        block = self._voice_block
+        block_start = self.frame_time
+        scheduled = self._scheduled
+        
+        # Il blocco si spezza in segmenti agli istanti degli eventi programmati
+        seg_start = 0
+        while True:
+            seg_end = frames
+            if scheduled:
+                seg_end = min(frames, max(seg_start, scheduled[0][0] - block_start))
+            if seg_end > seg_start:
+                self._render_segment(seg_start, seg_end)
+            if seg_end >= frames:
+                break
+            while scheduled and scheduled[0][0] - block_start <= seg_end:
+                self._apply_command(heapq.heappop(scheduled)[2])
+            seg_start = seg_end
+        
+        self.frame_time = block_start + frames
+        self._clock = (self.frame_time, time.perf_counter())
+
+        np.abs(block, out=self._abs_block)
+        np.max(self._abs_block, axis=1, out=self.levels)
+        np.matmul(block.T, self.gains, out=self._mix)
+        if self.convolver is not None:
+            self.convolver.process(self._mix)
+        peak = max(float(self._mix.max()), -float(self._mix.min()))
+        np.clip(self._mix, -1.0, 1.0, out=outdata)
+        self.stats.record(time.perf_counter() - t0, frames, status,
+                          int(np.count_nonzero(self._row_used)), peak)
 
-    def _audio_callback(self, outdata, frames, time, status):
-        mix = np.zeros((frames, 2), dtype=np.float32)
+    def _render_segment(self, start, end):
+        """Scrive nella matrice dei bus i campioni [start, end) di ogni voce."""
+        block = self._voice_block
+        length = end - start
         for i in range(self.num_strings):
-            buf = self.buses[i]
-            idx = self.indices[i]
-            buf_len = len(buf)
+            voice = self.buses[i]
+            if voice is None or voice.finished:
+                if voice is not None:
+                    self._drop_voice(i)
+                if self._row_used[i]:
+                    block[i, start:end] = 0.0
+                    # La riga è tutta pulita solo se il segmento copre l'intero blocco:
+                    # altrimenti nel resto del blocco restano i campioni del blocco precedente
+                    if start == 0 and end == block.shape[1]:
+                        self._row_used[i] = False
+                continue
+            row = block[i, start:end]
+            n = voice.read_into(row)
+            if n < length:
+                row[n:] = 0.0
+            self._row_used[i] = True
+            left = self._release_left[i]
+            if left > 0:
+                # Rampa lineare da left/len verso zero
+                ramp = self._ramp[:length]
+                np.subtract(left, self._frame_idx[:length], out=ramp)
+                ramp *= 1.0 / self._release_len[i]
+                np.maximum(ramp, 0.0, out=ramp)
+                row *= ramp
+                if left <= length:
+                    self._drop_voice(i)
+                else:
+                    self._release_left[i] = left - length
+
+class VoiceManager:
+    """
+    Assegna le note ai bus di un PolyphonicPlayer.
+    Tiene traccia delle note attive, sfuma le voci sul note-off e, quando i bus
+    sono tutti occupati, ruba prima le voci già rilasciate, poi la più debole
+    e, a parità, la più vecchia. Una nota ripetuta riusa il suo bus.
+    """
+    def __init__(self, player, polyphony=None, release_ms=RELEASE_MS):
+        self.player = player
+        self.polyphony = min(polyphony or player.num_strings, player.num_strings)
+        self.release_ms = release_ms
+        self._voices = [None] * self.polyphony   # Voce inviata su ciascun bus
+        self._notes = [None] * self.polyphony    # Nota che occupa il bus
+        self._held = [False] * self.polyphony    # Nota ancora premuta
+        self._age = [0] * self.polyphony
+        self._counter = 0
+        self._note_slot = {}
+        self._lock = threading.Lock()
+
+    def _is_free(self, slot):
+        voice = self._voices[slot]
+        return voice is None or voice.finished
 
-            if idx < buf_len:
-                remaining = buf_len - idx
-                chunk_len = min(frames, remaining)
+    def _pick_slot(self, note):
+        slot = self._note_slot.get(note)
+        if slot is not None and self._notes[slot] == note:
+            return slot
+        for i in range(self.polyphony):
+            if self._is_free(i):
+                return i
+        levels = self.player.levels
+        buses = self.player.buses
+        def steal_key(i):
+            # Una voce non ancora presa dalla callback non ha un livello: non rubarla
+            level = float(levels[i]) if buses[i] is self._voices[i] else float('inf')
+            return (self._held[i], level, self._age[i])
+        return min(range(self.polyphony), key=steal_key)
 
-                pan = self.pans[i]
-                pan_l = np.cos((pan + 1.0) * np.pi / 4.0)
-                pan_r = np.sin((pan + 1.0) * np.pi / 4.0)
+    def note_on(self, note, voice, held=True):
+        """
+        Suona 'voice' per la nota 'note' e restituisce il bus usato.
+        Con held=False la nota non aspetta un note-off (es. tastiera del PC).
+        """
+        if voice is None:
+            return None
+        with self._lock:
+            slot = self._pick_slot(note)
+            old_note = self._notes[slot]
+            if old_note is not None and self._note_slot.get(old_note) == slot:
+                del self._note_slot[old_note]
+            self._counter += 1
+            self._voices[slot] = voice
+            self._notes[slot] = note
+            self._held[slot] = held
+            self._age[slot] = self._counter
+            self._note_slot[note] = slot
+        self.player.pluck_voice(slot, voice)
+        return slot
 
-                mono_chunk = buf[idx : idx + chunk_len]
+    def note_off(self, note):
+        """Rilascia la nota con una breve rampa."""
+        with self._lock:
+            slot = self._note_slot.pop(note, None)
+            if slot is None or self._notes[slot] != note:
+                return
+            voice = self._voices[slot]
+            self._held[slot] = False
+            self._notes[slot] = None
+        self.player.release(slot, voice, self.release_ms)
 
-                mix[:chunk_len, 0] += mono_chunk * pan_l
-                mix[:chunk_len, 1] += mono_chunk * pan_r
+    def all_notes_off(self):
+        with self._lock:
+            notes = list(self._note_slot.keys())
+        for note in notes:
+            self.note_off(note)
 
-                self.indices[i] += chunk_len
+    def active_notes(self):
+        """Note che stanno ancora suonando."""
+        with self._lock:
+            return [n for n, s in self._note_slot.items() if not self._is_free(s)]
 
-        mix = np.clip(mix, -1.0, 1.0)
-        outdata[:] = mix
+class RenderCache:
+    """
+    Cache LRU delle note già renderizzate, con un budget massimo in byte.
+    La chiave è la tupla quantizzata dei parametri di sintesi: una corda
+    ripizzicata con gli stessi parametri costa una ricerca, non un nuovo lfilter.
+    """
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(fs, freq, dur, vol, pluck_hardness, damping_factor, pick_position, brightness, kind, adsr,
+                 tail_db=TAIL_THRESHOLD_DB, seed=EXCITATION_SEED):
+        """
+        Quantizza i parametri per evitare che differenze infinitesimali generino chiavi diverse.
+        La durata entra come numero di campioni: due durate con la stessa chiave hanno sempre
+        buffer della stessa lunghezza. Il seme conta solo per le corde Karplus-Strong.
+        """
+        pluck_hardness = float(pluck_hardness)
+        return (
+            int(fs), round(float(freq), 3), int(round(float(dur) * fs)), round(float(vol), 4),
+            round(pluck_hardness, 4), round(float(damping_factor), 6),
+            round(float(pick_position), 4), round(float(brightness), 4),
+            int(kind), tuple(round(float(v), 3) for v in adsr),
+            None if tail_db is None else round(float(tail_db), 1),
+            int(seed) if pluck_hardness > 0.0 else None
+        )
+
+    def get(self, key):
+        with self._lock:
+            wave = self._items.get(key)
+            if wave is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return wave
+
+    def put(self, key, wave):
+        size = wave.nbytes
+        if size > self.max_bytes:
+            return
+        # Il buffer viene condiviso tra più chiamanti: lo rendiamo di sola lettura
+        wave.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._items[key] = wave
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+_render_cache = RenderCache()
+
+def get_render_cache():
+    """Restituisce la cache condivisa delle note renderizzate."""
+    return _render_cache
+
+class WavetableBank:
+    """
+    Tabelle d'onda band-limited per i suoni sintetici (kind 1-5).
+    Per ogni kind si costruisce, una volta sola, una piramide (mip-map) di tabelle:
+    ogni livello contiene solo le armoniche fino a un limite (1, 2, 4, 8, ...).
+    In riproduzione si sceglie il livello più ricco le cui armoniche restano sotto
+    Nyquist, così le note acute non producono aliasing, e si legge la tabella con
+    un accumulatore di fase e interpolazione lineare invece di calcolare seni.
+    """
+    def __init__(self, size=WAVETABLE_SIZE):
+        self.size = size
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def _harmonic_coeffs(self, kind, max_h):
+        """Coefficienti (seno, coseno) delle armoniche 1..max_h, in fase con le forme d'onda di scipy."""
+        k = np.arange(1, max_h + 1, dtype=np.float64)
+        sin_c = np.zeros(max_h)
+        cos_c = np.zeros(max_h)
+        odd = (k % 2) == 1
+        if kind == 2: # Quadra: signal.square
+            sin_c[odd] = 4.0 / (np.pi * k[odd])
+        elif kind == 3: # Triangolare: signal.sawtooth(..., 0.5), parte da -1
+            cos_c[odd] = -8.0 / (np.pi ** 2 * k[odd] ** 2)
+        elif kind == 4: # Dente di sega: signal.sawtooth, rampa da -1 a 1
+            sin_c[:] = -2.0 / (np.pi * k)
+        elif kind == 5: # Additiva: HARMONICS
+            n = min(max_h, len(HARMONICS))
+            sin_c[:n] = HARMONICS[:n]
+        else: # Sinusoide
+            sin_c[0] = 1.0
+        return sin_c, cos_c
+
+    def _build_levels(self, kind):
+        if kind == 1 or kind not in (2, 3, 4, 5):
+            top = 1
+        elif kind == 5:
+            top = len(HARMONICS)
+        else:
+            top = self.size // 2 - 1
+        limits = []
+        h = 1
+        while h < top:
+            limits.append(h)
+            h *= 2
+        limits.append(top)
+
+        levels = []
+        for max_h in limits:
+            sin_c, cos_c = self._harmonic_coeffs(kind, max_h)
+            spectrum = np.zeros(self.size // 2 + 1, dtype=np.complex128)
+            spectrum[1:max_h + 1] = (self.size / 2.0) * (cos_c - 1j * sin_c)
+            table = np.fft.irfft(spectrum, n=self.size)
+            peak = np.max(np.abs(table))
+            if peak > 0: table /= peak
+            # Punto di guardia in coda per l'interpolazione senza modulo
+            table = np.append(table, table[0]).astype(np.float32)
+            table.flags.writeable = False
+            levels.append((max_h, table))
+        return levels
+
+    def levels(self, kind):
+        with self._lock:
+            levels = self._levels.get(kind)
+            if levels is None:
+                levels = self._build_levels(kind)
+                self._levels[kind] = levels
+            return levels
+
+    def _table_for(self, kind, freq, fs):
+        """Sceglie il livello con più armoniche che non superano Nyquist."""
+        levels = self.levels(kind)
+        max_allowed = (fs / 2.0) / freq if freq > 0 else 0
+        chosen = levels[0][1]
+        for max_h, table in levels:
+            if max_h <= max_allowed:
+                chosen = table
+            else:
+                break
+        return chosen
+
+    def render(self, kind, freqs, n_samples, fs=FS, phases=None):
+        """
+        Genera n_samples campioni per ogni frequenza in freqs (una riga per nota).
+        phases: fase iniziale per nota, in cicli [0, 1). Restituisce (onde, fasi_finali),
+        così un chiamante può proseguire la stessa nota blocco dopo blocco.
+        """
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+        phases = np.zeros(len(freqs)) if phases is None else np.asarray(phases, dtype=np.float64)
+        waves = np.zeros((len(freqs), n_samples), dtype=np.float32)
+        steps = np.arange(n_samples, dtype=np.float64)
+        for i, freq in enumerate(freqs):
+            if freq <= 0:
+                continue
+            table = self._table_for(kind, freq, fs)
+            # Accumulatore di fase in campioni di tabella: la parte intera, ridotta con
+            # una maschera (size è una potenza di 2), indicizza; la frazionaria interpola.
+            pos = steps * (freq * self.size / fs)
+            pos += phases[i] * self.size
+            idx = pos.astype(np.int64)
+            frac = (pos - idx).astype(np.float32)
+            idx &= self.size - 1
+            lo = table.take(idx)
+            hi = table[1:].take(idx)
+            hi -= lo
+            hi *= frac
+            hi += lo
+            waves[i] = hi
+        new_phases = (phases + n_samples * freqs / fs) % 1.0
+        return waves, new_phases
+
+_wavetable_bank = WavetableBank()
+
+def get_wavetable_bank():
+    """Restituisce il banco condiviso delle tabelle d'onda."""
+    return _wavetable_bank
+
+def _adsr_envelope(n_samples, adsr_list):
+    """Inviluppo ADSR in percentuale della durata della nota."""
+    a_pct, d_pct, s_level_pct, r_pct = adsr_list
+    attack_samples = int(round((a_pct/100.0)*n_samples))
+    decay_samples = int(round((d_pct/100.0)*n_samples))
+    release_samples = int(round((r_pct/100.0)*n_samples))
+    sustain_level = s_level_pct / 100.0
+    sustain_samples = n_samples - (attack_samples + decay_samples + release_samples)
+    if sustain_samples < 0:
+        release_samples = max(0, release_samples + sustain_samples)
+        sustain_samples = 0
+
+    envelope = np.zeros(n_samples, dtype=np.float32)
+    curr = 0
+    if attack_samples > 0:
+        envelope[curr:curr+attack_samples] = np.linspace(0., 1., attack_samples, dtype=np.float32)
+        curr += attack_samples
+    if decay_samples > 0:
+        envelope[curr:curr+decay_samples] = np.linspace(1., sustain_level, decay_samples, dtype=np.float32)
+        curr += decay_samples
+    if sustain_samples > 0:
+        envelope[curr:curr+sustain_samples] = sustain_level
+        curr += sustain_samples
+    if release_samples > 0:
+        envelope[curr:curr+release_samples] = np.linspace(sustain_level, 0., release_samples, dtype=np.float32)
+    return envelope
 
 class NoteRenderer:
     """
     Gestisce il rendering "one-shot" di una singola nota.
     Supporta Karplus-Strong e Sintesi Additiva/Semplice.
     """
-    def __init__(self, fs=FS):
+    def __init__(self, fs=FS, seed=None, use_cache=True, tail_db=TAIL_THRESHOLD_DB):
         self.fs = fs
+        self.use_cache = use_cache
+        self.tail_db = tail_db
         self.freq = 0.0
         self.vol = 0.0
         self.dur = 0
@@ -218,7 +1232,7 @@ class NoteRenderer:
         self.damping_factor = 0.0
         self.pick_position = 0.15
         self.brightness = 0.4
-        self.fast_synth = FastGuitarSynth(fs=self.fs)
+        self.fast_synth = FastGuitarSynth(fs=self.fs, seed=seed)
 
     def set_params(self, freq, dur, vol, pan, **kwargs):
         self.freq = freq
@@ -251,63 +1265,592 @@ class NoteRenderer:
         )
 
     def _render_legacy_osc(self, n_samples):
-        t = np.linspace(0., n_samples / self.fs, n_samples, endpoint=False)
-        phase_vector = 2 * np.pi * self.freq * t
-        
-        if self.kind == 2: wave = signal.square(phase_vector)
-        elif self.kind == 3: wave = signal.sawtooth(phase_vector, 0.5)
-        elif self.kind == 4: wave = signal.sawtooth(phase_vector)
-        elif self.kind == 5:
-            wave = np.zeros(n_samples, dtype=np.float32)
-            for i, h_amp in enumerate(HARMONICS):
-                wave += np.sin((i + 1) * phase_vector) * h_amp
-            max_val = np.max(np.abs(wave))
-            if max_val > 0: wave /= max_val
-        else: wave = np.sin(phase_vector)
+        waves, _ = _wavetable_bank.render(self.kind, self.freq, n_samples, self.fs)
+        wave = waves[0]
+        wave *= _adsr_envelope(n_samples, self.adsr_list)
+        return wave
+
+    def copy(self):
+        """Copia indipendente con gli stessi parametri, da usare in un altro thread."""
+        clone = NoteRenderer(fs=self.fs, seed=self.fast_synth.seed, use_cache=self.use_cache, tail_db=self.tail_db)
+        clone.freq, clone.dur, clone.vol = self.freq, self.dur, self.vol
+        clone.pan_l, clone.pan_r = self.pan_l, self.pan_r
+        clone.adsr_list = list(self.adsr_list)
+        clone.kind = self.kind
+        clone.pluck_hardness = self.pluck_hardness
+        clone.damping_factor = self.damping_factor
+        clone.pick_position = self.pick_position
+        clone.brightness = self.brightness
+        return clone
+
+    def cache_key(self):
+        """Chiave della cache per i parametri correnti (il panning non conta: si applica dopo)."""
+        return RenderCache.make_key(
+            self.fs, self.freq, self.dur, self.vol,
+            self.pluck_hardness, self.damping_factor, self.pick_position, self.brightness,
+            self.kind, self.adsr_list, self.tail_db, self.fast_synth.seed
+        )
+
+    def _render_wave(self, total_note_samples):
+        """
+        Renderizza la nota mono (volume incluso), passando dalla cache se abilitata.
+        La coda sotto tail_db viene tagliata, quindi il buffer può essere più corto della durata.
+        """
+        key = self.cache_key() if self.use_cache else None
+        if key is not None:
+            wave = _render_cache.get(key)
+            if wave is None:
+                wave = _sample_bank_get(key)
+            if wave is not None:
+                return wave
+
+        if self.pluck_hardness > 0.0:
+            wave = self._render_karplus_strong(total_note_samples)
+        else:
+            wave = self._render_legacy_osc(total_note_samples)
+        wave *= self.vol
+        wave = _trim_tail(wave, self.tail_db)
+
+        if key is not None:
+            _render_cache.put(key, wave)
+        return wave
+
+    def create_voice(self):
+        """
+        Restituisce una voce pronta per PolyphonicPlayer.pluck_voice.
+        Se la nota è già in cache si legge il buffer, altrimenti una nota
+        Karplus-Strong viene sintetizzata in streaming dentro la callback.
+        """
+        if self.freq <= 0.0: return None
+        total_note_samples = int(round(self.dur * self.fs))
+        if total_note_samples == 0: return None
         
-        wave = wave.astype(np.float32)
-        a_pct, d_pct, s_level_pct, r_pct = self.adsr_list
-        attack_samples = int(round((a_pct/100.0)*n_samples))
-        decay_samples = int(round((d_pct/100.0)*n_samples))
-        release_samples = int(round((r_pct/100.0)*n_samples))
-        sustain_level = s_level_pct / 100.0
-        sustain_samples = n_samples - (attack_samples + decay_samples + release_samples)
-        if sustain_samples < 0:
-            release_samples = max(0, release_samples + sustain_samples)
-            sustain_samples = 0
-
-        envelope = np.zeros(n_samples, dtype=np.float32)
-        curr = 0
-        if attack_samples > 0:
-            envelope[curr:curr+attack_samples] = np.linspace(0., 1., attack_samples)
-            curr += attack_samples
-        if decay_samples > 0:
-            envelope[curr:curr+decay_samples] = np.linspace(1., sustain_level, decay_samples)
-            curr += decay_samples
-        if sustain_samples > 0:
-            envelope[curr:curr+sustain_samples] = sustain_level
-            curr += sustain_samples
-        if release_samples > 0:
-            envelope[curr:curr+release_samples] = np.linspace(sustain_level, 0., release_samples)
+        if self.use_cache:
+            key = self.cache_key()
+            wave = _render_cache.get(key)
+            if wave is None:
+                wave = _sample_bank_get(key)
+            if wave is not None:
+                return BufferVoice(wave)
         
-        return wave * envelope
+        if self.pluck_hardness > 0.0:
+            return self.fast_synth.create_voice(
+                self.freq, total_note_samples / self.fs, self.vol,
+                self.pluck_hardness, self.damping_factor,
+                self.pick_position, self.brightness, tail_db=self.tail_db
+            )
+        return BufferVoice(self._render_wave(total_note_samples))
+
+    def render_mono(self):
+        """Nota mono con la coda silenziosa già tagliata, pronta per PolyphonicPlayer.pluck."""
+        if self.freq <= 0.0: return np.array([], dtype=np.float32)
+        total_note_samples = int(round(self.dur * self.fs))
+        if total_note_samples == 0: return np.array([], dtype=np.float32)
+        return self._render_wave(total_note_samples)
 
     def render(self):
+        """Nota stereo con il panning applicato, lunga esattamente 'dur' secondi."""
         if self.freq <= 0.0: return np.array([], dtype=np.float32)
         total_note_samples = int(round(self.dur * self.fs))
         if total_note_samples == 0: return np.array([], dtype=np.float32)
         
-        if self.pluck_hardness > 0.0:
-            wave = self._render_karplus_strong(total_note_samples)
-        else:
-            wave = self._render_legacy_osc(total_note_samples)
-            
-        wave *= self.vol
+        wave = self._render_wave(total_note_samples)
         stereo = np.zeros((total_note_samples, 2), dtype=np.float32)
-        stereo[:, 0] = wave * self.pan_l
-        stereo[:, 1] = wave * self.pan_r
+        n = len(wave)
+        np.multiply(wave, self.pan_l, out=stereo[:n, 0])
+        np.multiply(wave, self.pan_r, out=stereo[:n, 1])
         return stereo
 
+class RenderService:
+    """
+    Rendering delle note in background su un piccolo pool di thread.
+    submit() restituisce un Future con la nota mono (volume incluso), che finisce
+    anche nella cache. voice_for() non aspetta mai la sintesi: se la nota non è
+    in cache parte subito una voce in streaming, mentre il render completo
+    riempie la cache per le pressioni successive.
+    """
+    def __init__(self, max_workers=RENDER_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, renderer):
+        """Renderizza in background i parametri correnti di 'renderer'."""
+        job = renderer.copy()
+        key = job.cache_key()
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._render_job, job)
+            self._pending[key] = future
+        future.add_done_callback(lambda f, k=key: self._forget(k))
+        return future
+
+    def _render_job(self, job):
+        n_samples = int(round(job.dur * job.fs))
+        if job.freq <= 0.0 or n_samples == 0:
+            return np.array([], dtype=np.float32)
+        return job._render_wave(n_samples)
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def voice_for(self, renderer):
+        """Come NoteRenderer.create_voice, ma il render completo avviene in background."""
+        voice = renderer.create_voice()
+        if isinstance(voice, StringVoice) and renderer.use_cache:
+            self.submit(renderer)
+        return voice
+
+    def run(self, fn, *args):
+        """Esegue un lavoro generico (es. la costruzione di un banco) sul pool di rendering."""
+        return self._executor.submit(fn, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+_render_service = None
+_render_service_lock = threading.Lock()
+
+def get_render_service():
+    global _render_service
+    with _render_service_lock:
+        if _render_service is None:
+            _render_service = RenderService()
+            atexit.register(_render_service.shutdown)
+        return _render_service
+
+class SampleBank:
+    """
+    Banco di campioni su disco: tutte le note del manico renderizzate una volta
+    e salvate in un .npy mappato in memoria, identificato dall'hash di accordatura
+    e parametri di sintesi. Al riavvio le note si leggono dal file (page-in)
+    invece di essere risintetizzate; se i parametri cambiano si costruisce un nuovo banco.
+    Le note sono concatenate senza padding: l'indice .json ne conserva inizio e lunghezza.
+    """
+    def __init__(self, directory=SAMPLE_BANK_DIR, fs=FS, tail_db=TAIL_THRESHOLD_DB, seed=None):
+        self.directory = directory
+        self.fs = fs
+        self.tail_db = tail_db
+        # Seme delle eccitazioni con cui il banco viene sintetizzato (default EXCITATION_SEED)
+        self.seed = EXCITATION_SEED if seed is None else seed
+        self._rows = {}
+        self._loaded = set()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def bank_id(self, freqs, dur, vol, fs=None, **kwargs):
+        """Hash dei parametri che determinano il contenuto del banco (alla frequenza 'fs', default quella del banco)."""
+        desc = {
+            'version': SAMPLE_BANK_VERSION, 'fs': int(fs or self.fs), 'seed': self.seed,
+            'dur': round(float(dur), 4), 'vol': round(float(vol), 4),
+            'tail_db': self.tail_db,
+            'params': {k: kwargs[k] for k in sorted(kwargs)},
+            'freqs': self._unique_freqs(freqs),
+        }
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _unique_freqs(freqs):
+        return sorted({round(float(f), 3) for f in freqs if f and f > 0.0})
+
+    def _paths(self, bank_id):
+        base = os.path.join(self.directory, bank_id)
+        return base + ".npy", base + ".json"
+
+    def prepare(self, freqs, dur, vol, **kwargs):
+        """
+        Rende disponibile il banco per queste note e parametri.
+        Restituisce True se è già pronto (in memoria o letto dal disco); altrimenti
+        avvia la costruzione in background e restituisce False: nel frattempo le note
+        continuano a passare da cache e sintesi normale.
+        Se esiste lo stesso banco a un'altra frequenza di campionamento, viene
+        ricampionato una volta (filtro polifase) invece di risintetizzare tutto.
+        """
+        bank_id = self.bank_id(freqs, dur, vol, **kwargs)
+        with self._lock:
+            if bank_id in self._loaded:
+                return True
+            if bank_id in self._building:
+                return False
+        if self._load(bank_id, dur, vol, kwargs):
+            return True
+        with self._lock:
+            if bank_id in self._building or bank_id in self._loaded:
+                return bank_id in self._loaded
+            source = self._find_other_rate(freqs, dur, vol, kwargs)
+            if source is not None:
+                future = get_render_service().run(self._build_resampled, bank_id, source, dur, vol, kwargs)
+            else:
+                future = get_render_service().run(self._build, bank_id, self._unique_freqs(freqs), dur, vol, kwargs)
+            self._building[bank_id] = future
+        return False
+
+    def _renderer(self):
+        """Renderer con gli stessi fs, seme e soglia della coda del banco, fuori dalla cache LRU."""
+        return NoteRenderer(fs=self.fs, seed=self.seed, use_cache=False, tail_db=self.tail_db)
+
+    def _register(self, bank_id, data, index, dur, vol, kwargs):
+        params = self._renderer()
+        rows = {}
+        for f, start, length in zip(index['freqs'], index['offsets'], index['lengths']):
+            params.set_params(f, dur, vol, 0.0, **kwargs)
+            rows[params.cache_key()] = data[start:start + length]
+        with self._lock:
+            self._rows.update(rows)
+            self._loaded.add(bank_id)
+
+    def _load(self, bank_id, dur, vol, kwargs):
+        npy_path, json_path = self._paths(bank_id)
+        if not (os.path.exists(npy_path) and os.path.exists(json_path)):
+            return False
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            data = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Banco campioni {bank_id} illeggibile, verrà ricostruito: {e}")
+            return False
+        self._register(bank_id, data, index, dur, vol, kwargs)
+        # Aggiorna la data: i banchi usati di recente sopravvivono alla pulizia
+        try:
+            os.utime(npy_path)
+        except OSError:
+            pass
+        return True
+
+    def _find_other_rate(self, freqs, dur, vol, kwargs):
+        """Cerca su disco lo stesso banco a un'altra frequenza: (id, frequenza) o None."""
+        for rate in SAMPLE_BANK_RATES:
+            if rate == int(self.fs):
+                continue
+            other_id = self.bank_id(freqs, dur, vol, fs=rate, **kwargs)
+            npy_path, json_path = self._paths(other_id)
+            if os.path.exists(npy_path) and os.path.exists(json_path):
+                return other_id, rate
+        return None
+
+    def _build(self, bank_id, freqs, dur, vol, kwargs):
+        renderer = self._renderer()
+        def waves():
+            # Una nota alla volta, già tagliata: in memoria non c'è mai l'intero manico
+            for f in freqs:
+                renderer.set_params(f, dur, vol, 0.0, **kwargs)
+                yield renderer.render_mono()
+        try:
+            self._write(bank_id, freqs, waves(), dur, vol, kwargs)
+        except OSError as e:
+            print(f"Impossibile salvare il banco campioni: {e}")
+        finally:
+            with self._lock:
+                self._building.pop(bank_id, None)
+
+    def _build_resampled(self, bank_id, source, dur, vol, kwargs):
+        source_id, rate = source
+        try:
+            npy_path, json_path = self._paths(source_id)
+            with open(json_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            data = np.load(npy_path, mmap_mode='r')
+            waves = (resample(data[start:start + length], rate, self.fs)
+                     for start, length in zip(index['offsets'], index['lengths']))
+            self._write(bank_id, index['freqs'], (w[:_tail_length(w, self.tail_db)] for w in waves), dur, vol, kwargs)
+        except (OSError, ValueError) as e:
+            print(f"Impossibile ricampionare il banco campioni {source_id}: {e}")
+        finally:
+            with self._lock:
+                self._building.pop(bank_id, None)
+
+    @staticmethod
+    def _npy_header(length):
+        return {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)), 'fortran_order': False, 'shape': (length,)}
+
+    def _write(self, bank_id, freqs, waves, dur, vol, kwargs):
+        """
+        Salva le note (già tagliate, anche da un generatore) come banco 'bank_id' e le registra.
+        Ogni nota finisce subito nel file: la memoria non cresce con il numero di note.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        npy_path, json_path = self._paths(bank_id)
+        lengths = []
+        # Scrittura su file temporanei e rename: un banco a metà non viene mai letto
+        with open(npy_path + ".tmp.npy", 'wb') as f:
+            # L'intestazione .npy lascia spazio per le cifre della lunghezza: si riscrive alla fine
+            np.lib.format.write_array_header_1_0(f, self._npy_header(0))
+            data_start = f.tell()
+            for w in waves:
+                f.write(np.ascontiguousarray(w, dtype=np.float32).data)
+                lengths.append(len(w))
+            f.seek(0)
+            np.lib.format.write_array_header_1_0(f, self._npy_header(sum(lengths)))
+            if f.tell() != data_start:
+                raise ValueError("intestazione .npy di lunghezza inattesa")
+        os.replace(npy_path + ".tmp.npy", npy_path)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int).tolist() if lengths else []
+        index = {'freqs': list(freqs), 'offsets': offsets, 'lengths': lengths}
+        with open(json_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(json_path + ".tmp", json_path)
+
+        self._register(bank_id, np.load(npy_path, mmap_mode='r'), index, dur, vol, kwargs)
+        self._cleanup()
+
+    def _cleanup(self):
+        """Rimuove i banchi meno recenti oltre SAMPLE_BANK_MAX_FILES."""
+        try:
+            banks = [os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith(".npy")]
+            banks.sort(key=os.path.getmtime, reverse=True)
+            for npy_path in banks[SAMPLE_BANK_MAX_FILES:]:
+                bank_id = os.path.basename(npy_path)[:-4]
+                if bank_id in self._loaded:
+                    continue
+                os.remove(npy_path)
+                json_path = npy_path[:-4] + ".json"
+                if os.path.exists(json_path):
+                    os.remove(json_path)
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Nota mono del banco (vista a sola lettura sul file) o None."""
+        return self._rows.get(key)
+
+    def wait(self, timeout=None):
+        """Attende la fine delle costruzioni in corso (utile negli script)."""
+        with self._lock:
+            futures = list(self._building.values())
+        for future in futures:
+            future.result(timeout)
+
+_sample_bank = None
+_sample_bank_lock = threading.Lock()
+
+def get_sample_bank():
+    """Restituisce il banco di campioni condiviso (creato al primo uso)."""
+    global _sample_bank
+    with _sample_bank_lock:
+        if _sample_bank is None:
+            _sample_bank = SampleBank()
+        return _sample_bank
+
+def _sample_bank_get(key):
+    bank = _sample_bank
+    return None if bank is None else bank.get(key)
+
+def render_many(freqs, dur, vol, fs=FS, tail_db=TAIL_THRESHOLD_DB, unison=True, **kwargs):
+    """
+    Renderizza più note con parametri di sintesi comuni in un colpo solo.
+    I kwargs sono gli stessi di NoteRenderer.set_params (kind/adsr_list oppure pluck_hardness & co.).
+    Restituisce una matrice mono (num_note, campioni), volume incluso.
+    Le note già presenti nella cache non vengono ricalcolate; quelle nuove vi vengono salvate
+    con la coda sotto tail_db tagliata (nella matrice restano zeri).
+    Con unison=True le corde Karplus-Strong con la stessa lunghezza di ritardo dopo la prima
+    usano un seme diverso, come in un accordo vero: queste non passano dalla cache, perché
+    la loro chiave è quella della stessa nota suonata da sola.
+    """
+    params = NoteRenderer(fs=fs, tail_db=tail_db)
+    params.set_params(0.0, dur, vol, 0.0, **kwargs)
+    n_samples = int(round(dur * fs))
+    freqs = [float(f) if f else 0.0 for f in freqs]
+    out = np.zeros((len(freqs), n_samples), dtype=np.float32)
+    if n_samples == 0: return out
+
+    # Posizione di ogni corda tra quelle all'unisono (stessa L): solo la prima ha il seme di base
+    ranks = [0] * len(freqs)
+    if unison and params.pluck_hardness > 0.0:
+        seen = {}
+        for i, f in enumerate(freqs):
+            if f > 0.0:
+                L = int(fs / f)
+                ranks[i] = seen.get(L, 0)
+                seen[L] = ranks[i] + 1
+
+    # 1. Recupera dalla cache quello che c'è già
+    missing = []
+    keys = []
+    for i, f in enumerate(freqs):
+        params.freq = f
+        key = params.cache_key() if ranks[i] == 0 else None
+        keys.append(key)
+        if f <= 0.0:
+            continue
+        if key is None:
+            missing.append(i)
+            continue
+        wave = _render_cache.get(key)
+        if wave is None:
+            wave = _sample_bank_get(key)
+        if wave is not None:
+            out[i, :len(wave)] = wave
+        else:
+            missing.append(i)
+    if not missing:
+        return out
+
+    # 2. Renderizza il resto in blocco (lfilter su matrici o tabelle d'onda)
+    missing_freqs = np.array([freqs[i] for i in missing])
+    if params.pluck_hardness > 0.0:
+        waves = params.fast_synth.render_strings(
+            missing_freqs, n_samples / fs, vol,
+            params.pluck_hardness, params.damping_factor,
+            params.pick_position, params.brightness,
+            seeds=[params.fast_synth.seed + ranks[i] for i in missing]
+        )
+    else:
+        waves, _ = _wavetable_bank.render(params.kind, missing_freqs, n_samples, fs)
+        waves *= _adsr_envelope(n_samples, params.adsr_list)
+        waves *= vol
+
+    for row, i in enumerate(missing):
+        out[i] = waves[row]
+        if keys[i] is None:
+            continue
+        wave = _trim_tail(waves[row], tail_db)
+        _render_cache.put(keys[i], wave.copy() if wave.base is not None else wave)
+    return out
+
+def render_chord(freqs, dur, vol, pans=None, onsets=None, fs=FS, **kwargs):
+    """
+    Renderizza e mixa un accordo in un buffer stereo.
+    pans: panning per nota (-1..1, default centro); onsets: ritardo d'attacco in secondi
+    per nota (es. per una pennata), default tutte insieme.
+    """
+    waves = render_many(freqs, dur, vol, fs=fs, **kwargs)
+    num_notes, n_samples = waves.shape
+    if num_notes == 0 or n_samples == 0:
+        return np.zeros((0, 2), dtype=np.float32)
+
+    pans = np.zeros(num_notes) if pans is None else np.clip(np.asarray(pans, dtype=np.float64), -1.0, 1.0)
+    pan_angle = pans * (np.pi / 4.0) + np.pi / 4.0
+    gains = np.stack([np.cos(pan_angle), np.sin(pan_angle)], axis=1).astype(np.float32)
+
+    if onsets is None:
+        # Tutte le note partono insieme: il mix è un unico prodotto matriciale
+        return waves.T @ gains
+
+    offsets = np.round(np.asarray(onsets, dtype=np.float64) * fs).astype(np.int64)
+    offsets -= offsets.min()
+    stereo = np.zeros((int(offsets.max()) + n_samples, 2), dtype=np.float32)
+    for i in range(num_notes):
+        start = offsets[i]
+        stereo[start:start + n_samples] += waves[i][:, None] * gains[i]
+    return stereo
+
+def _voice_length(voice):
+    return len(voice.audio) if isinstance(voice, BufferVoice) else voice.n_samples
+
+class OfflineMixer:
+    """
+    Mixer non in tempo reale: le voci (BufferVoice o StringVoice) vengono
+    programmate a un certo istante e il risultato stereo viene scritto a blocchi.
+    In memoria ci sono solo le voci attive nel blocco corrente, non l'intero brano:
+    le note aggiunte con add_note diventano voci solo quando il mix arriva al loro attacco.
+    """
+    def __init__(self, fs=FS, block_size=OFFLINE_BLOCK_SIZE, convolver=None):
+        self.fs = fs
+        self.block_size = block_size
+        # Risonanza della cassa opzionale; il suo ritardo viene compensato nel file
+        self.convolver = convolver
+        self._events = []  # (inizio in campioni, ordine, voce o NoteRenderer, guadagni L/R)
+
+    def add(self, onset, voice, pan=0.0):
+        """Programma una voce a 'onset' secondi dall'inizio, con panning -1..1."""
+        if voice is None: return
+        self._schedule(onset, voice, pan)
+
+    def add_note(self, onset, renderer, pan=0.0):
+        """
+        Programma la nota descritta da un NoteRenderer già configurato.
+        Si salvano solo i parametri: la voce viene creata all'attacco e scartata appena finisce.
+        """
+        if renderer.freq <= 0.0 or int(round(renderer.dur * renderer.fs)) == 0: return
+        self._schedule(onset, renderer.copy(), pan)
+
+    def _schedule(self, onset, source, pan):
+        pan = float(np.clip(pan, -1.0, 1.0))
+        gains = np.array([np.cos((pan + 1.0) * np.pi / 4.0), np.sin((pan + 1.0) * np.pi / 4.0)], dtype=np.float32)
+        start = max(0, int(round(onset * self.fs)))
+        self._events.append((start, len(self._events), source, gains))
+
+    @staticmethod
+    def _source_length(source):
+        if isinstance(source, NoteRenderer):
+            return int(round(source.dur * source.fs))
+        return _voice_length(source)
+
+    @property
+    def total_frames(self):
+        return max((start + self._source_length(source) for start, _, source, _ in self._events), default=0)
+
+    def render(self, writer, duration=None):
+        """
+        Mixa tutte le voci scrivendo blocco per blocco su 'writer' (es. WavWriter).
+        Con 'duration' (secondi) il risultato dura almeno tanto, completato con silenzio.
+        """
+        events = sorted(self._events, key=lambda e: (e[0], e[1]))
+        total = self.total_frames
+        conv = self.convolver
+        skip = 0
+        if conv is not None:
+            conv.reset()
+            skip = conv.latency
+            total += conv.ir_length - 1
+        if duration is not None:
+            total = max(total, int(round(duration * self.fs)))
+        total += skip
+        block = self.block_size
+        mix = np.zeros((block, 2), dtype=np.float32)
+        row = np.zeros(block, dtype=np.float32)
+        active = []
+        next_event = 0
+        pos = 0
+        while pos < total:
+            frames = min(block, total - pos)
+            while next_event < len(events) and events[next_event][0] < pos + frames:
+                start, _, source, gains = events[next_event]
+                next_event += 1
+                voice = source.create_voice() if isinstance(source, NoteRenderer) else source
+                if voice is not None:
+                    active.append((start, voice, gains))
+            mix[:frames] = 0.0
+            still_active = []
+            for event in active:
+                start, voice, gains = event
+                offset = max(0, start - pos)
+                n = voice.read_into(row[offset:frames])
+                if n > 0:
+                    mix[offset:offset + n] += row[offset:offset + n, None] * gains
+                if not voice.finished:
+                    still_active.append(event)
+            active = still_active
+            first = 0
+            if conv is not None:
+                conv.process(mix[:frames])
+                first = min(skip, frames)
+                skip -= first
+            if first < frames:
+                writer.write(mix[first:frames])
+            pos += frames
+        return pos - (conv.latency if conv is not None else 0)
+
+    def render_to_wav(self, path, duration=None):
+        """Scrive il mix su un file WAV stereo. Restituisce la durata in secondi."""
+        with WavWriter(path, fs=self.fs, channels=2) as writer:
+            frames = self.render(writer, duration)
+        return frames / self.fs
+
+def render_chord_to_wav(path, freqs, dur, vol, pans=None, onsets=None, fs=FS, **kwargs):
+    """Come render_chord, ma scrive l'accordo direttamente su file WAV."""
+    mixer = OfflineMixer(fs=fs)
+    renderer = NoteRenderer(fs=fs)
+    for i, f in enumerate(freqs):
+        if not f: continue
+        renderer.set_params(float(f), dur, vol, 0.0, **kwargs)
+        mixer.add_note(onsets[i] if onsets is not None else 0.0, renderer, pans[i] if pans is not None else 0.0)
+    return mixer.render_to_wav(path)
+
 def render_scale_audio(note_list, suono_params, bpm):
     s_vol = suono_params.get('volume', 0.35)
     s_dur = 60.0 / bpm
@@ -325,8 +1868,7 @@ def render_scale_audio(note_list, suono_params, bpm):
         s_kind = suono_params.get('kind', 1)
         s_adsr = suono_params.get('adsr', [0,0,0,0])
 
-    for item in note_list:
-        freq = note_to_freq(item) if isinstance(item, str) else (float(item) if item else 0.0)
+    for freq in notes_to_freqs(note_list):
         if freq <= 0:
             segmenti.append(np.zeros((int(s_dur * FS), 2), dtype=np.float32))
             continue
@@ -344,6 +1886,26 @@ def render_scale_audio(note_list, suono_params, bpm):
 
     return np.concatenate(segmenti, axis=0) if segmenti else np.array([], dtype=np.float32)
 
+def render_scale_to_wav(path, note_list, suono_params, bpm, fs=FS):
+    """Come render_scale_audio, ma scrive la scala su file WAV a blocchi."""
+    s_dur = 60.0 / bpm
+    mixer = OfflineMixer(fs=fs)
+    renderer = NoteRenderer(fs=fs)
+    for i, freq in enumerate(notes_to_freqs(note_list)):
+        if freq <= 0: continue
+        if 'pluck_hardness' in suono_params:
+            renderer.set_params(freq, s_dur, suono_params.get('volume', 0.35), 0.0,
+                                pluck_hardness=suono_params.get('pluck_hardness', 0.6),
+                                damping_factor=suono_params.get('damping_factor', 0.997),
+                                pick_position=suono_params.get('pick_position', 0.15),
+                                brightness=suono_params.get('brightness', 0.4))
+        else:
+            renderer.set_params(freq, s_dur, suono_params.get('volume', 0.35), 0.0,
+                                kind=suono_params.get('kind', 1), adsr_list=suono_params.get('adsr', [0,0,0,0]))
+        mixer.add_note(i * s_dur, renderer)
+    # La scala dura esattamente una nota per battito, anche se l'ultima è una pausa
+    return mixer.render_to_wav(path, duration=len(note_list) * s_dur)
+
 
 # --- Supporto MIDI Nativo ---
 
@@ -481,45 +2043,24 @@ def note_to_midi(note_str):
     if isinstance(note_str, int): return note_str
     if isinstance(note_str, float): return int(round(note_str))
     if isinstance(note_str, str):
-        note_lower = note_str.lower()
-        if note_lower == 'p': return None
-        note_lower = note_lower.replace('-', 'b')
-        
-        match_octave = re.search(r"\d+$", note_lower)
-        if not match_octave:
-            return None
-        octave_str = match_octave.group()
-        try:
-            octave = int(octave_str)
-        except ValueError:
-            return None
-            
-        note_base = note_lower[:-len(octave_str)]
-        
-        micro_offset = 0
-        possible_micros = [("~~", 1), ("``", -1), ("~", 0), ("`", 0)]
-        for micro, offset in possible_micros:
-            if note_base.endswith(micro):
-                micro_offset = offset
-                note_base = note_base[:-len(micro)]
-                break
-                
-        match_std = re.match(r"^([a-g])([#b]?)$", note_base)
-        if not match_std:
-            return None
-        note_letter, accidental = match_std.groups()
-        
-        note_base_semitones = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
-        semitone = note_base_semitones[note_letter]
-        if accidental == '#':
-            semitone += 1
-        elif accidental == 'b':
-            semitone -= 1
-            
-        midi_num = 12 + semitone + 12 * octave + micro_offset
-        return int(round(midi_num))
+        midi_num = _NOTE_MIDI_TABLE.get(note_str, _NOTE_MISSING)
+        if midi_num is not _NOTE_MISSING:
+            return midi_num
+        parsed = _parse_note(note_str)
+        return None if parsed is None else parsed[1]
     return None
 
+def notes_to_midi(notes, missing=-1):
+    """Versione vettoriale di note_to_midi: array int64, con 'missing' per pause e nomi non validi."""
+    notes = list(notes)
+    table = _NOTE_MIDI_TABLE
+    def _one(n):
+        m = table.get(n, _NOTE_MISSING) if isinstance(n, str) else _NOTE_MISSING
+        if m is _NOTE_MISSING:
+            m = note_to_midi(n)
+        return missing if m is None else m
+    return np.fromiter((_one(n) for n in notes), dtype=np.int64, count=len(notes))
+
 def freq_to_midi(freq):
     """Converte una frequenza Hz in numero MIDI standard (0-127)."""
     if freq <= 0.0: return None
@@ -562,7 +2103,8 @@ class MIDIINCAPSA(ctypes.Structure):
         ("dwSupport", ctypes.c_uint)
     ]
 
-MidiInCallbackType = ctypes.WINFUNCTYPE(
+# WINFUNCTYPE esiste solo su Windows: altrove il modulo deve comunque importarsi (es. server headless)
+MidiInCallbackType = getattr(ctypes, 'WINFUNCTYPE', ctypes.CFUNCTYPE)(
     None,
     ctypes.c_void_p,
     ctypes.c_uint,
@@ -669,28 +2211,109 @@ def get_midi_in():
     global _midi_in
     return _midi_in
 
+def velocity_layer(velocity, layers=MIDI_VELOCITY_LAYERS):
+    """Velocity MIDI (1-127) quantizzata in 'layers' livelli, da 1/layers a 1.0."""
+    v = min(max(int(velocity), 1), 127)
+    return int(np.ceil(v * layers / 127.0)) / layers
+
+class MidiInSynth:
+    """
+    Sintesi delle note che arrivano dalla tastiera MIDI.
+    La callback di winmm si limita ad accodare gli eventi: un thread dedicato
+    prepara le voci (dalla cache, dal banco o in streaming tramite il RenderService)
+    e le assegna a un VoiceManager su un player persistente, registrato sul
+    motore audio come bus 'midi_in'. La velocity, quantizzata in pochi livelli
+    perché i render si riusino, scala il volume e schiarisce il timbro.
+    """
+    def __init__(self, fs=FS, polyphony=DEFAULT_POLYPHONY, name=MIDI_IN_BUS):
+        self.fs = fs
+        self.player = PolyphonicPlayer(fs=fs, num_strings=polyphony, name=name)
+        self.voices = VoiceManager(self.player)
+        self.renderer = NoteRenderer(fs=fs)
+        self.suono_key = None  # None = il suono scelto nelle impostazioni
+        self._events = queue.SimpleQueue()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self.player.start()
+            self._thread = threading.Thread(target=self._run, name="midi-in-synth", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._events.put(None)
+            self._thread.join(timeout=1.0)
+            self._thread = None
+            self.player.stop()
+
+    def note_on(self, note_num, velocity):
+        """Accoda un note-on; non sintetizza nulla nel thread chiamante."""
+        self._events.put((note_num, velocity))
+
+    def note_off(self, note_num):
+        self._events.put((note_num, 0))
+
+    def _run(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            note_num, velocity = event
+            try:
+                if velocity > 0:
+                    self._play(note_num, velocity)
+                else:
+                    self.voices.note_off(note_num)
+            except Exception as e:
+                print(f"\n[MIDI-IN] Errore di sintesi: {e}")
+        self.voices.all_notes_off()
+
+    def _play(self, note_num, velocity):
+        import config
+        suono_key = self.suono_key or config.impostazioni.get('tipo_suono', 'suono_1')
+        if suono_key == 'midi':
+            return
+        suono = config.impostazioni[suono_key]
+        level = velocity_layer(velocity)
+        freq = midi_to_freq(note_num)
+        dur = suono.get('dur_accordi', 2.0)
+        vol = suono.get('volume', 0.35) * level ** MIDI_VELOCITY_CURVE
+        if 'pluck_hardness' in suono:
+            # brightness verso 0.5 = filtro d'anello più scuro; al livello massimo resta quella del preset
+            brightness = suono.get('brightness', 0.4)
+            brightness += (0.5 - brightness) * (1.0 - level) * MIDI_VELOCITY_TIMBRE
+            self.renderer.set_params(freq, dur, vol, 0.0,
+                                     pluck_hardness=suono.get('pluck_hardness', 0.6),
+                                     damping_factor=suono.get('damping_factor', 0.997),
+                                     pick_position=suono.get('pick_position', 0.15), brightness=brightness)
+        else:
+            self.renderer.set_params(freq, dur, vol, 0.0, kind=suono.get('kind', 1), adsr_list=suono.get('adsr', [0,0,0,0]))
+        self.voices.note_on(note_num, get_render_service().voice_for(self.renderer))
+
+_midi_in_synth = None
+_midi_in_synth_lock = threading.Lock()
+
+def get_midi_in_synth():
+    global _midi_in_synth
+    with _midi_in_synth_lock:
+        if _midi_in_synth is None:
+            import config
+            _midi_in_synth = MidiInSynth(polyphony=config.impostazioni.get('polifonia', DEFAULT_POLYPHONY))
+        return _midi_in_synth
+
 def on_midi_in_note_on(note_num, velocity):
     """Callback di default per Note On da tastiera MIDI."""
     try:
         import config
-        tipo_suono = config.impostazioni.get('tipo_suono', 'suono_1')
-        if tipo_suono == 'midi':
+        if config.impostazioni.get('tipo_suono', 'suono_1') == 'midi':
             get_midi_out().note_on(note_num, velocity)
         else:
-            freq = 440.0 * (2.0 ** ((note_num - 69) / 12.0))
-            suono = config.impostazioni[tipo_suono]
-            dur = suono.get('dur_accordi', 2.0)
-            vol = suono.get('volume', 0.35)
-            renderer = NoteRenderer(fs=FS)
-            if 'pluck_hardness' in suono:
-                renderer.set_params(freq, dur, vol, 0.0, 
-                                    pluck_hardness=suono.get('pluck_hardness', 0.6), 
-                                    damping_factor=suono.get('damping_factor', 0.997))
-            else:
-                renderer.set_params(freq, dur, vol, 0.0, kind=suono.get('kind', 1), adsr_list=suono.get('adsr', [0,0,0,0]))
-            note_audio = renderer.render()
-            if note_audio.size > 0:
-                sd.play(note_audio, samplerate=FS, blocking=False)
+            get_midi_in_synth().note_on(note_num, velocity)
     except Exception:
         pass
 
@@ -698,9 +2321,10 @@ def on_midi_in_note_off(note_num):
     """Callback di default per Note Off da tastiera MIDI."""
     try:
         import config
-        tipo_suono = config.impostazioni.get('tipo_suono', 'suono_1')
-        if tipo_suono == 'midi':
+        if config.impostazioni.get('tipo_suono', 'suono_1') == 'midi':
             get_midi_out().note_off(note_num)
+        else:
+            get_midi_in_synth().note_off(note_num)
     except Exception:
         pass
 
@@ -710,6 +2334,8 @@ def open_global_midi_in(device_idx):
     close_global_midi_in()
     if device_idx >= 0:
         _midi_in = WindowsMidiIn(device_idx, on_midi_in_note_on, on_midi_in_note_off)
+        if _midi_in.h_midi is not None:
+            get_midi_in_synth().start()
 
 @atexit.register
 def close_global_midi_in():
@@ -717,4 +2343,6 @@ def close_global_midi_in():
     global _midi_in
     if _midi_in is not None:
         _midi_in.close_port()
-        _midi_in = None
\ No newline at end of file
+        _midi_in = None
+    if _midi_in_synth is not None:
+        _midi_in_synth.stop()
\ No newline at end of file
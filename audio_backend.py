@@ -0,0 +1,847 @@
+# Backend audio di Chitabry.
+# Tutti i motori (PolyphonicPlayer, Metronomo, MidiStudy, Accordatore) aprono
+# gli stream da qui, così possono girare anche senza scheda audio:
+# server headless, test di carico, CI.
+# Si sceglie con la variabile d'ambiente CHITABRY_AUDIO_BACKEND o con
+# l'impostazione 'audio_backend': sounddevice (default), null, wav, loopback.
+# Le viste non aprono stream di uscita propri: registrano un bus su AudioEngine
+# (get_engine), l'unico stream dell'applicazione, aperto una volta e tenuto aperto.
+# Le callback registrano carico, xrun, voci e picchi in CallbackStats (get_stats);
+# con CHITABRY_AUDIO_LOG o l'impostazione 'audio_log' i riepiloghi finiscono su file.
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import wave
+from collections import deque
+import numpy as np
+
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    # Manca il modulo o la libreria PortAudio: restano i backend simulati
+    sd = None
+
+BACKEND_ENV_VAR = "CHITABRY_AUDIO_BACKEND"
+WAV_PATH_ENV_VAR = "CHITABRY_AUDIO_WAV"
+DEFAULT_BACKEND = "sounddevice"
+DEFAULT_WAV_PATH = "chitabry_audio.wav"
+SIM_BLOCK_SIZE = 512  # Blocco degli stream simulati quando il chiamante non lo specifica
+SIM_SAMPLE_RATE = 44100
+SAMPLE_RATE_ENV_VAR = "CHITABRY_SAMPLE_RATE"  # Forza la frequenza di campionamento (es. 48000)
+SUPPORTED_SAMPLE_RATES = (44100, 48000, 88200, 96000, 32000, 22050)
+LOOPBACK_MAX_SECONDS = 60  # Audio trattenuto in memoria dal backend loopback
+ENGINE_BLOCK_SIZE = 256  # Blocco dello stream condiviso di AudioEngine
+ENGINE_MAX_PREVIEWS = 16  # Anteprime (play) che possono suonare insieme
+STATS_LOG_ENV_VAR = "CHITABRY_AUDIO_LOG"
+STATS_LOG_INTERVAL = 5.0  # Secondi tra due righe di riepilogo nel file di log
+STATS_MAX_EVENTS = 256  # Eventi (xrun, sforamenti) in attesa di essere scritti nel log
+LOAD_BINS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)  # Soglie del carico: tempo della callback / durata del blocco
+
+if sd is not None:
+    CallbackStop = sd.CallbackStop
+    CallbackAbort = sd.CallbackAbort
+else:
+    class CallbackStop(Exception):
+        """Sollevata dalla callback per chiudere lo stream dopo il blocco corrente."""
+
+    class CallbackAbort(Exception):
+        """Sollevata dalla callback per interrompere subito lo stream."""
+
+class WavWriter:
+    """
+    Scrive audio su file WAV (PCM 16 bit) un blocco alla volta.
+    Accetta blocchi float (-1..1) oppure int16, mono (n,) o (n, canali).
+    """
+    def __init__(self, path, fs=SIM_SAMPLE_RATE, channels=2):
+        self.path = path
+        self.fs = fs
+        self.channels = channels
+        self.frames_written = 0
+        self._file = wave.open(path, 'wb')
+        self._file.setnchannels(channels)
+        self._file.setsampwidth(2)
+        self._file.setframerate(int(fs))
+
+    def write(self, block):
+        if len(block) == 0: return
+        if block.dtype != np.int16:
+            block = (np.clip(block, -1.0, 1.0) * 32767.0).astype(np.int16)
+        self._file.writeframes(np.ascontiguousarray(block).tobytes())
+        self.frames_written += len(block)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _to_float(block):
+    if block.dtype == np.int16:
+        return block.astype(np.float32) / 32767.0
+    return np.array(block, dtype=np.float32)
+
+class CallbackStats:
+    """
+    Statistiche di una callback audio: istogramma del carico (tempo di esecuzione
+    diviso la durata del blocco, cioè la scadenza), sforamenti della scadenza,
+    underflow/overflow segnalati dallo stream, voci attive e picchi in uscita.
+    record() è pensato per la callback: solo aritmetica su contatori, nessuna stampa.
+    Gli xrun e gli sforamenti finiscono anche in 'events', che il log svuota.
+    """
+    def __init__(self, name, samplerate=SIM_SAMPLE_RATE):
+        self.name = name
+        self.samplerate = samplerate
+        self.events = deque(maxlen=STATS_MAX_EVENTS)
+        self.reset()
+
+    def reset(self):
+        self.callbacks = 0
+        self.frames = 0
+        self.histogram = [0] * (len(LOAD_BINS) + 1)
+        self.overruns = 0
+        self.max_load = 0.0
+        self.total_load = 0.0
+        self.output_underflows = 0
+        self.output_overflows = 0
+        self.input_underflows = 0
+        self.input_overflows = 0
+        self.voices = 0
+        self.max_voices = 0
+        self.peak = 0.0
+        self.max_peak = 0.0
+        self.clipped = 0
+        self.started = time.time()
+
+    def record(self, elapsed, frames, status=None, voices=0, peak=0.0):
+        """Registra una callback durata 'elapsed' secondi per un blocco di 'frames' campioni."""
+        self.callbacks += 1
+        self.frames += frames
+        load = elapsed * self.samplerate / frames if frames else 0.0
+        self.histogram[bisect.bisect_left(LOAD_BINS, load)] += 1
+        self.total_load += load
+        if load > self.max_load:
+            self.max_load = load
+        if load > 1.0:
+            self.overruns += 1
+            self.events.append((time.time(), f"callback oltre la scadenza ({load:.0%} del blocco)"))
+        if status:
+            self._record_status(status)
+        self.voices = voices
+        if voices > self.max_voices:
+            self.max_voices = voices
+        self.peak = peak
+        if peak > self.max_peak:
+            self.max_peak = peak
+        if peak > 1.0:
+            self.clipped += 1
+
+    def _record_status(self, status):
+        # CallbackFlags di sounddevice; gli stream simulati passano None
+        for flag in ('output_underflow', 'output_overflow', 'input_underflow', 'input_overflow'):
+            if getattr(status, flag, False):
+                setattr(self, flag + 's', getattr(self, flag + 's') + 1)
+                self.events.append((time.time(), flag.replace('_', ' ')))
+
+    @property
+    def xruns(self):
+        return self.output_underflows + self.output_overflows + self.input_underflows + self.input_overflows
+
+    def snapshot(self):
+        """Copia dei contatori come dizionario (per log, benchmark o confronti)."""
+        return {
+            'name': self.name, 'callbacks': self.callbacks, 'frames': self.frames,
+            'seconds': self.frames / self.samplerate if self.samplerate else 0.0,
+            'load_bins': list(LOAD_BINS), 'histogram': list(self.histogram),
+            'mean_load': self.total_load / self.callbacks if self.callbacks else 0.0,
+            'max_load': self.max_load, 'overruns': self.overruns,
+            'output_underflows': self.output_underflows, 'output_overflows': self.output_overflows,
+            'input_underflows': self.input_underflows, 'input_overflows': self.input_overflows,
+            'voices': self.voices, 'max_voices': self.max_voices,
+            'peak': self.peak, 'max_peak': self.max_peak, 'clipped': self.clipped,
+        }
+
+    def summary(self):
+        """Riepilogo su una riga."""
+        mean = self.total_load / self.callbacks if self.callbacks else 0.0
+        return (f"{self.name}: {self.callbacks} callback, carico medio {mean:.0%} max {self.max_load:.0%}, "
+                f"sforamenti {self.overruns}, xrun {self.xruns}, voci {self.voices} (max {self.max_voices}), "
+                f"picco {self.max_peak:.2f}, blocchi saturati {self.clipped}")
+
+    def report(self):
+        """Riepilogo esteso con l'istogramma del carico, per il comando delle statistiche."""
+        lines = [self.summary()]
+        if self.callbacks:
+            lows = (0.0,) + LOAD_BINS
+            for i, count in enumerate(self.histogram):
+                label = f"{lows[i]:.0%}-{LOAD_BINS[i]:.0%}" if i < len(LOAD_BINS) else f">{LOAD_BINS[-1]:.0%}"
+                bar = "#" * int(round(40 * count / self.callbacks))
+                lines.append(f"  {label:>9} {count:8d} {bar}")
+            lines.append(f"  underflow out/in: {self.output_underflows}/{self.input_underflows}, "
+                         f"overflow out/in: {self.output_overflows}/{self.input_overflows}")
+        return "\n".join(lines)
+
+_stats = {}
+_stats_lock = threading.Lock()
+_stats_logger = None
+
+def get_stats(name, samplerate=SIM_SAMPLE_RATE):
+    """
+    Statistiche condivise della callback 'name' (es. "PolyphonicPlayer accordo", "Metronomo"):
+    sopravvivono agli stream, così si possono consultare dopo averli chiusi.
+    """
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = CallbackStats(name, samplerate)
+        stats.samplerate = samplerate
+    _ensure_stats_logger()
+    return stats
+
+def all_stats():
+    with _stats_lock:
+        return list(_stats.values())
+
+def stats_report():
+    """Report di tutte le callback strumentate finora."""
+    stats = all_stats()
+    if not stats:
+        return "Nessuna statistica audio: nessuno stream è ancora partito."
+    return "\n".join(s.report() for s in stats)
+
+class StatsLogger:
+    """Thread che ogni 'interval' secondi aggiunge al file di log gli eventi e un riepilogo per callback."""
+    def __init__(self, path, interval=STATS_LOG_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="audio-stats-log")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        lines = []
+        for stats in all_stats():
+            while stats.events:
+                t, text = stats.events.popleft()
+                lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))} {stats.name} EVENTO {text}")
+            if stats.callbacks:
+                lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {stats.summary()}")
+        if not lines: return
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"Impossibile scrivere il log audio '{self.path}': {e}")
+
+def _configured_log_path():
+    path = os.environ.get(STATS_LOG_ENV_VAR)
+    if not path:
+        path = _setting('audio_log', '')
+    return str(path).strip()
+
+def _ensure_stats_logger():
+    global _stats_logger
+    with _stats_lock:
+        if _stats_logger is not None:
+            return
+        path = _configured_log_path()
+        if not path:
+            return
+        _stats_logger = StatsLogger(path)
+        _stats_logger.start()
+        atexit.register(_stats_logger.stop)
+
+class SimulatedStream:
+    """
+    Stream senza hardware con la stessa interfaccia di sounddevice.
+    Un thread chiama la callback a blocchi, al ritmo del tempo reale
+    (realtime=True) oppure il più velocemente possibile.
+    I blocchi in uscita vanno a 'sink', quelli in ingresso arrivano da 'source'.
+    """
+    def __init__(self, samplerate, channels, dtype, callback, blocksize=None,
+                 is_input=False, sink=None, source=None, on_close=None, realtime=True):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.blocksize = blocksize or SIM_BLOCK_SIZE
+        self.callback = callback
+        self.is_input = is_input
+        self.sink = sink
+        self.source = source
+        self.on_close = on_close
+        self.realtime = realtime
+        self.frames_processed = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.active: return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    abort = stop
+
+    def close(self):
+        self.stop()
+        if not self._closed:
+            self._closed = True
+            if self.on_close is not None:
+                self.on_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        frames = self.blocksize
+        buf = np.zeros((frames, self.channels), dtype=self.dtype)
+        t0 = time.perf_counter()
+        while not self._stop_event.is_set():
+            if self.is_input:
+                if self.source is not None:
+                    self.source(buf)
+                else:
+                    buf.fill(0)
+            try:
+                self.callback(buf, frames, None, None)
+            except (CallbackStop, CallbackAbort):
+                break
+            if not self.is_input and self.sink is not None:
+                self.sink(buf)
+            self.frames_processed += frames
+            if self.realtime:
+                delay = t0 + self.frames_processed / self.samplerate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+class AudioBackend:
+    """Interfaccia comune: stream in uscita/ingresso, riproduzione one-shot e periferiche di input."""
+    name = ""
+    CallbackStop = CallbackStop
+    CallbackAbort = CallbackAbort
+
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+        self._play_stream = None
+        self._play_lock = threading.Lock()
+
+    def output_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        return SimulatedStream(samplerate, channels, dtype, callback, blocksize,
+                               sink=self._output_sink(samplerate, channels), realtime=self.realtime)
+
+    def input_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        return SimulatedStream(samplerate, channels, dtype, callback, blocksize,
+                               is_input=True, source=self._input_source(), realtime=self.realtime)
+
+    def _output_sink(self, samplerate, channels):
+        return None
+
+    def _input_source(self):
+        return None
+
+    def input_devices(self):
+        """Periferiche di input: {indice: {'name', 'hostapi', 'default_samplerate'}}."""
+        return {0: {'name': f"Ingresso simulato ({self.name})", 'hostapi': self.name,
+                    'default_samplerate': SIM_SAMPLE_RATE}}
+
+    def play(self, audio, samplerate):
+        """Riproduce un buffer (mono o stereo) senza bloccare, interrompendo il precedente."""
+        audio = audio if audio.ndim == 2 else audio[:, None]
+        pos = [0]
+        def callback(outdata, frames, time_info, status):
+            n = min(frames, len(audio) - pos[0])
+            outdata[:n] = audio[pos[0]:pos[0] + n]
+            outdata[n:] = 0
+            pos[0] += n
+            if pos[0] >= len(audio):
+                raise CallbackStop
+        self.stop()
+        stream = self.output_stream(samplerate, audio.shape[1], audio.dtype, callback)
+        with self._play_lock:
+            self._play_stream = stream
+        stream.start()
+
+    def stop(self):
+        """Ferma la riproduzione avviata con play()."""
+        with self._play_lock:
+            stream, self._play_stream = self._play_stream, None
+        if stream is not None:
+            stream.close()
+
+class SoundDeviceBackend(AudioBackend):
+    """Scheda audio reale tramite sounddevice/PortAudio."""
+    name = "sounddevice"
+
+    def output_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        return sd.OutputStream(samplerate=samplerate, channels=channels, dtype=dtype, callback=callback,
+                               blocksize=blocksize or 0, latency=latency, device=device)
+
+    def input_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        return sd.InputStream(samplerate=samplerate, channels=channels, dtype=dtype, callback=callback,
+                              blocksize=blocksize or 0, latency=latency, device=device)
+
+    def input_devices(self):
+        devices = {}
+        for idx, dev in enumerate(sd.query_devices()):
+            if dev['max_input_channels'] > 0:
+                try:
+                    api_name = sd.query_hostapis(dev['hostapi'])['name']
+                except Exception:
+                    api_name = "Sconosciuto"
+                devices[idx] = {'name': dev['name'], 'hostapi': api_name,
+                                'default_samplerate': dev['default_samplerate']}
+        return devices
+
+    def play(self, audio, samplerate):
+        sd.play(audio, samplerate=samplerate, blocking=False)
+
+    def stop(self):
+        sd.stop()
+
+class NullBackend(AudioBackend):
+    """Nessuna uscita: le callback girano davvero, l'audio viene scartato. In ingresso, silenzio."""
+    name = "null"
+
+class WavFileBackend(AudioBackend):
+    """
+    Scrive ogni stream in uscita su un file WAV (il primo su 'path', i successivi
+    con un numero progressivo). In ingresso, silenzio.
+    """
+    name = "wav"
+
+    def __init__(self, path=None, realtime=True):
+        super().__init__(realtime)
+        self.path = path or os.environ.get(WAV_PATH_ENV_VAR, DEFAULT_WAV_PATH)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _next_path(self):
+        with self._lock:
+            self._count += 1
+            n = self._count
+        if n == 1:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        return f"{root}_{n}{ext}"
+
+    def output_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        writer = WavWriter(self._next_path(), fs=samplerate, channels=channels)
+        return SimulatedStream(samplerate, channels, dtype, callback, blocksize,
+                               sink=writer.write, on_close=writer.close, realtime=self.realtime)
+
+class LoopbackBackend(AudioBackend):
+    """
+    Backend in memoria: quello che esce dagli stream in uscita viene registrato
+    (captured) e rientra dagli stream in ingresso, mixato in mono.
+    Con feed() si può iniettare un segnale in ingresso, es. per provare l'accordatore.
+    """
+    name = "loopback"
+
+    def __init__(self, realtime=True, max_seconds=LOOPBACK_MAX_SECONDS):
+        super().__init__(realtime)
+        self.max_seconds = max_seconds
+        # Ridimensionato sulla frequenza di ogni stream aperto; questa vale solo per feed() prima del primo stream
+        self.max_frames = int(max_seconds * SIM_SAMPLE_RATE)
+        self._recorded = deque()
+        self._recorded_frames = 0
+        self._pending = deque()
+        self._pending_frames = 0
+        self._lock = threading.Lock()
+
+    def _set_rate(self, samplerate):
+        self.max_frames = int(self.max_seconds * samplerate)
+
+    def input_stream(self, samplerate, channels, dtype, callback, blocksize=None, latency=None, device=None):
+        self._set_rate(samplerate)
+        return super().input_stream(samplerate, channels, dtype, callback, blocksize, latency, device)
+
+    def _output_sink(self, samplerate, channels):
+        self._set_rate(samplerate)
+        def sink(block):
+            block = _to_float(block)
+            with self._lock:
+                self._recorded.append(block)
+                self._recorded_frames += len(block)
+                while self._recorded_frames > self.max_frames and len(self._recorded) > 1:
+                    self._recorded_frames -= len(self._recorded.popleft())
+            self.feed(block.mean(axis=1) if block.ndim == 2 else block)
+        return sink
+
+    def feed(self, audio_mono):
+        """Accoda audio mono che gli stream in ingresso leggeranno."""
+        audio_mono = np.asarray(audio_mono, dtype=np.float32)
+        with self._lock:
+            self._pending.append(audio_mono)
+            self._pending_frames += len(audio_mono)
+            while self._pending_frames > self.max_frames and len(self._pending) > 1:
+                self._pending_frames -= len(self._pending.popleft())
+
+    def _input_source(self):
+        def source(buf):
+            frames = len(buf)
+            mono = np.zeros(frames, dtype=np.float32)
+            filled = 0
+            with self._lock:
+                while filled < frames and self._pending:
+                    chunk = self._pending[0]
+                    n = min(frames - filled, len(chunk))
+                    mono[filled:filled + n] = chunk[:n]
+                    filled += n
+                    if n < len(chunk):
+                        self._pending[0] = chunk[n:]
+                    else:
+                        self._pending.popleft()
+                    self._pending_frames -= n
+            if buf.dtype == np.int16:
+                mono = (np.clip(mono, -1.0, 1.0) * 32767.0).astype(np.int16)
+            buf[:] = mono[:, None]
+        return source
+
+    def captured(self, clear=False):
+        """Audio uscito finora (fino a max_seconds), come un unico array float32."""
+        with self._lock:
+            blocks = list(self._recorded)
+            if clear:
+                self._recorded.clear()
+                self._recorded_frames = 0
+        if not blocks:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate([b if b.ndim == 2 else b[:, None] for b in blocks], axis=0)
+
+BACKENDS = {
+    "sounddevice": SoundDeviceBackend,
+    "null": NullBackend,
+    "wav": WavFileBackend,
+    "loopback": LoopbackBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def _configured_name():
+    name = os.environ.get(BACKEND_ENV_VAR)
+    if not name:
+        name = _setting('audio_backend', DEFAULT_BACKEND)
+    return str(name).strip().lower()
+
+def _setting(key, default):
+    """
+    Impostazione di Chitabry. GBAudio e il metronomo chiedono la frequenza già all'import,
+    prima che config carichi le impostazioni: in quel caso si leggono direttamente dal file.
+    """
+    try:
+        import config
+        if config.impostazioni:
+            return config.impostazioni.get(key, default)
+        with open(config.FILE_IMPOSTAZIONI, 'r', encoding='utf-8') as f:
+            return json.load(f).get(key, default)
+    except Exception:
+        return default
+
+_native_samplerate = None
+
+def native_samplerate():
+    """
+    Frequenza di campionamento con cui sintetizzare: quella nativa dell'uscita
+    predefinita, così né PortAudio né il sistema operativo devono ricampionare.
+    Si può forzare con CHITABRY_SAMPLE_RATE. È calcolata una sola volta, perché
+    tutti i motori (GBAudio, metronomo) devono usare la stessa.
+    """
+    global _native_samplerate
+    if _native_samplerate is None:
+        _native_samplerate = _query_samplerate()
+    return _native_samplerate
+
+def _query_samplerate():
+    forced = os.environ.get(SAMPLE_RATE_ENV_VAR)
+    if forced:
+        try:
+            return int(forced)
+        except ValueError:
+            print(f"{SAMPLE_RATE_ENV_VAR}='{forced}' non valida, uso la frequenza del dispositivo.")
+    if sd is None or _configured_name() != "sounddevice":
+        # Gli stream simulati accettano qualsiasi frequenza
+        return SIM_SAMPLE_RATE
+    try:
+        rate = int(round(sd.query_devices(kind='output')['default_samplerate']))
+    except Exception:
+        return SIM_SAMPLE_RATE
+    return rate if rate in SUPPORTED_SAMPLE_RATES else SIM_SAMPLE_RATE
+
+def create_backend(name):
+    """Crea il backend richiesto; se sounddevice non è disponibile ripiega su null."""
+    cls = BACKENDS.get(name)
+    if cls is None:
+        print(f"Backend audio '{name}' sconosciuto, uso {DEFAULT_BACKEND}.")
+        cls = BACKENDS[DEFAULT_BACKEND]
+    if cls is SoundDeviceBackend and sd is None:
+        print("sounddevice non disponibile: audio disattivato (backend null).")
+        cls = NullBackend
+    return cls()
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend(_configured_name())
+        return _backend
+
+def set_backend(backend):
+    """Imposta il backend attivo (un nome di BACKENDS o un'istanza) e lo restituisce."""
+    global _backend
+    with _backend_lock:
+        _backend = create_backend(backend) if isinstance(backend, str) else backend
+        return _backend
+
+class _EngineBus:
+    """Un bus del motore: callback in stile sounddevice più il suo buffer preallocato."""
+    def __init__(self, name, callback, channels, dtype, gain, frames):
+        self.name = name
+        self.callback = callback
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.gain = gain
+        self.ended = False
+        self.resize(frames)
+
+    @property
+    def scale(self):
+        # I bus int16 vengono riportati in -1..1
+        return self.gain / 32767.0 if self.dtype == np.int16 else self.gain
+
+    def resize(self, frames):
+        self.scratch = np.zeros((frames, self.channels), dtype=self.dtype)
+
+class AudioEngine:
+    """
+    Motore audio unico dell'applicazione: un solo stream di uscita stereo, aperto
+    una volta e tenuto aperto, che mixa i bus registrati dalle viste
+    (PolyphonicPlayer, metronomo, anteprime). Ogni bus è una callback con la
+    firma di sounddevice che scrive il suo blocco in un buffer preallocato (mono
+    o stereo, float32 o int16); il motore applica il guadagno e somma.
+    L'elenco dei bus è una tupla sostituita per intero: la callback la legge senza lock.
+    play() mixa buffer già pronti sopra tutto il resto, senza interrompere gli altri suoni.
+    """
+    def __init__(self, samplerate=None, blocksize=ENGINE_BLOCK_SIZE, backend=None):
+        self._samplerate = int(samplerate) if samplerate else None
+        self.blocksize = blocksize
+        self._backend = backend
+        self._buses = ()
+        self._lock = threading.Lock()
+        self._blocks = 0
+        self.stream = None
+        self.stats = get_stats("AudioEngine", self._samplerate or SIM_SAMPLE_RATE)
+        # Anteprime: buffer stereo float32 in arrivo dalla UI e in riproduzione nella callback
+        self._preview_queue = deque()
+        # Slot fissi per le anteprime in corso: la callback non crea liste né array
+        self._preview_audio = [None] * ENGINE_MAX_PREVIEWS
+        self._preview_pos = [0] * ENGINE_MAX_PREVIEWS
+        self._clear_previews = False
+        self._alloc(blocksize)
+
+    def _alloc(self, frames):
+        self._frames = frames
+        self._mix = np.zeros((frames, 2), dtype=np.float32)
+        self._tmp = np.zeros((frames, 2), dtype=np.float32)
+        for bus in self._buses:
+            bus.resize(frames)
+
+    @property
+    def samplerate(self):
+        # Risolta al primo uso (di solito all'avvio dello stream), non quando si crea il motore
+        if self._samplerate is None:
+            self._samplerate = native_samplerate()
+            self.stats.samplerate = self._samplerate
+        return self._samplerate
+
+    @property
+    def is_running(self):
+        return self.stream is not None and self.stream.active
+
+    def start(self):
+        """Apre lo stream la prima volta e lo tiene aperto."""
+        with self._lock:
+            if self.stream is None:
+                backend = self._backend or get_backend()
+                self.stream = backend.output_stream(
+                    samplerate=self.samplerate, channels=2, dtype=np.float32,
+                    callback=self._audio_callback, blocksize=self.blocksize, latency='low'
+                )
+            if not self.stream.active:
+                self.stream.start()
+
+    def close(self):
+        with self._lock:
+            if self.stream is not None:
+                self.stream.stop()
+                self.stream.close()
+                self.stream = None
+
+    def add_bus(self, name, callback, channels=2, dtype=np.float32, gain=1.0):
+        """Registra (o sostituisce) il bus 'name' e avvia il motore se serve."""
+        bus = _EngineBus(name, callback, channels, dtype, gain, self._frames)
+        with self._lock:
+            self._buses = tuple(b for b in self._buses if b.name != name) + (bus,)
+        self.start()
+        return bus
+
+    def remove_bus(self, name):
+        """
+        Toglie il bus 'name'. Al ritorno la callback non lo sta più eseguendo,
+        quindi chi lo possedeva può toccarne lo stato senza lock.
+        """
+        with self._lock:
+            buses = tuple(b for b in self._buses if b.name != name)
+            if len(buses) == len(self._buses):
+                return False
+            self._buses = buses
+        self._wait_block()
+        return True
+
+    def has_bus(self, name):
+        return any(b.name == name for b in self._buses)
+
+    def bus_names(self):
+        return [b.name for b in self._buses]
+
+    def set_gain(self, name, gain):
+        for bus in self._buses:
+            if bus.name == name:
+                bus.gain = float(gain)
+                return True
+        return False
+
+    def _wait_block(self, timeout=0.5):
+        """Attende che finisca un blocco iniziato dopo l'ultima modifica dei bus."""
+        if not self.is_running:
+            return
+        target = self._blocks + 2
+        deadline = time.perf_counter() + timeout
+        while self._blocks < target and time.perf_counter() < deadline:
+            time.sleep(0.002)
+
+    def play(self, audio, samplerate=None):
+        """Riproduce un buffer (mono o stereo, float o int16) mixandolo sopra i bus attivi."""
+        audio = _to_float(np.asarray(audio))
+        if audio.ndim == 1:
+            audio = audio[:, None]
+        if audio.shape[1] == 1:
+            audio = np.repeat(audio, 2, axis=1)
+        audio = np.ascontiguousarray(audio[:, :2])
+        if samplerate and int(samplerate) != self.samplerate and len(audio) > 1:
+            # Caso raro (i motori sintetizzano già alla frequenza del motore): interpolazione lineare
+            n = int(round(len(audio) * self.samplerate / samplerate))
+            x = np.linspace(0, len(audio) - 1, n)
+            audio = np.stack([np.interp(x, np.arange(len(audio)), audio[:, c]) for c in range(2)], axis=1).astype(np.float32)
+        self._preview_queue.append(audio)
+        self.start()
+
+    def stop_previews(self):
+        """Interrompe le anteprime in corso (i bus continuano a suonare)."""
+        self._preview_queue.clear()
+        self._clear_previews = True
+
+    def _audio_callback(self, outdata, frames, time_info, status):
+        t0 = time.perf_counter()
+        if frames != self._frames:
+            self._alloc(frames)
+        mix = self._mix
+        mix.fill(0.0)
+        tmp = self._tmp
+        voices = 0
+        for bus in self._buses:
+            if bus.ended:
+                continue
+            buf = bus.scratch
+            try:
+                bus.callback(buf, frames, time_info, status)
+            except (CallbackStop, CallbackAbort):
+                # Il bus ha finito: resta muto finché chi l'ha registrato non lo toglie
+                bus.ended = True
+                continue
+            ch = bus.channels
+            np.multiply(buf, bus.scale, out=tmp[:, :ch], casting='unsafe')
+            if ch == 1:
+                mix += tmp[:, :1]
+            else:
+                mix += tmp[:, :2]
+            voices += 1
+        voices += self._mix_previews(mix, frames)
+        peak = max(float(mix.max()), -float(mix.min()))
+        np.clip(mix, -1.0, 1.0, out=outdata)
+        self._blocks += 1
+        self.stats.record(time.perf_counter() - t0, frames, status, voices, peak)
+
+    def _mix_previews(self, mix, frames):
+        slots = self._preview_audio
+        positions = self._preview_pos
+        if self._clear_previews:
+            self._clear_previews = False
+            for i in range(ENGINE_MAX_PREVIEWS):
+                slots[i] = None
+        active = 0
+        for i in range(ENGINE_MAX_PREVIEWS):
+            audio = slots[i]
+            if audio is None:
+                if not self._preview_queue:
+                    continue
+                try:
+                    audio = slots[i] = self._preview_queue.popleft()
+                except IndexError:  # Svuotata nel frattempo da stop_previews()
+                    continue
+                positions[i] = 0
+            pos = positions[i]
+            n = min(frames, len(audio) - pos)
+            out = mix[:n]
+            np.add(out, audio[pos:pos + n], out=out)
+            pos += n
+            if pos >= len(audio):
+                slots[i] = None  # Finita: il buffer non resta referenziato dalla callback
+            positions[i] = pos
+            active += 1
+        return active
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Restituisce il motore audio condiviso (creato al primo uso, chiuso all'uscita)."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AudioEngine()
+            atexit.register(_engine.close)
+        return _engine
@@ -0,0 +1,217 @@
+# Benchmark dei percorsi audio critici di Chitabry.
+# Misura sintesi, mixer e metronomo con parametri fissi, salva i risultati in JSON
+# e li confronta con una baseline: se un caso rallenta oltre la tolleranza il
+# programma esce con codice 1, così le regressioni si vedono prima del rilascio.
+#
+# Uso:
+#   python benchmark_audio.py                     # misura e confronta con la baseline, se c'è
+#   python benchmark_audio.py --save-baseline     # misura e salva i risultati come nuova baseline
+#   python benchmark_audio.py --quick --only callback
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import numpy as np
+import scipy
+
+import audio_backend
+# Nessuna scheda audio: gli stream vengono creati ma non partono mai
+audio_backend.set_backend("null")
+import GBAudio
+import clitronomo
+
+DEFAULT_RESULTS = "benchmark_results.json"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+DEFAULT_TOLERANCE = 0.25  # Rallentamento massimo accettato rispetto alla baseline (25%)
+
+# Dal Mi grave della chitarra (E2) al Mi del 24° tasto del cantino (E6)
+STRING_FREQS = [82.41, 110.0, 196.0, 329.63, 659.26, 1318.51]
+STRING_DURS = [0.5, 2.0, 9.0]
+LEGACY_KINDS = [1, 2, 3, 4, 5]
+LEGACY_ADSR = [1.0, 5.0, 60.0, 30.0]
+CALLBACK_VOICES = [1, 2, 4, 8, 16, 32]
+CALLBACK_BLOCKS = 400
+SUBDIVISIONS = [0, 2, 4, 8]
+KS_PARAMS = dict(pluck_hardness=0.2, damping_factor=0.998, pick_position=0.15, brightness=0.4)
+LEGACY_PARAMS = {'kind': 3, 'adsr': LEGACY_ADSR, 'volume': 0.35}
+SCALE_NOTES = ["C4", "D4", "E4", "F4", "G4", "A4", "B4", "C5", "D5", "E5", "F5", "G5", "A5", "B5", "C6"]
+
+def misura(funzione, ripetizioni, prepara=None):
+    """Esegue 'funzione' una volta a vuoto e poi 'ripetizioni' volte. Restituisce i tempi in ms."""
+    if prepara: prepara()
+    funzione()
+    tempi = []
+    for _ in range(ripetizioni):
+        if prepara: prepara()
+        t0 = time.perf_counter()
+        funzione()
+        tempi.append((time.perf_counter() - t0) * 1000.0)
+    return tempi
+
+def risultato(tempi, **extra):
+    r = {'min_ms': min(tempi), 'median_ms': statistics.median(tempi), 'repeat': len(tempi)}
+    r.update(extra)
+    return r
+
+def bench_render_string(ripetizioni):
+    synth = GBAudio.FastGuitarSynth(fs=GBAudio.FS, seed=GBAudio.EXCITATION_SEED)
+    out = {}
+    for dur in STRING_DURS:
+        for freq in STRING_FREQS:
+            tempi = misura(lambda: synth.render_string(freq, dur, 0.45, **KS_PARAMS), ripetizioni)
+            out[f"render_string/{freq:g}Hz/{dur:g}s"] = risultato(tempi, audio_s=dur)
+    return out
+
+def bench_legacy(ripetizioni):
+    renderer = GBAudio.NoteRenderer(fs=GBAudio.FS, use_cache=False)
+    n_samples = int(2.0 * GBAudio.FS)
+    out = {}
+    for kind in LEGACY_KINDS:
+        renderer.set_params(440.0, 2.0, 0.35, 0.0, kind=kind, adsr_list=LEGACY_ADSR)
+        tempi = misura(lambda: renderer._render_legacy_osc(n_samples), ripetizioni)
+        out[f"legacy_osc/kind{kind}"] = risultato(tempi, audio_s=2.0)
+    return out
+
+def bench_scale(ripetizioni):
+    cache = GBAudio.get_render_cache()
+    out = {}
+    for nome, params in (("ks", dict(KS_PARAMS, volume=0.45)), ("legacy", LEGACY_PARAMS)):
+        # Cache svuotata prima di ogni giro: si misura il render, non la lettura
+        tempi = misura(lambda: GBAudio.render_scale_audio(SCALE_NOTES, params, 120), ripetizioni, prepara=cache.clear)
+        out[f"render_scale_audio/{nome}"] = risultato(tempi, audio_s=len(SCALE_NOTES) * 0.5)
+    return out
+
+def bench_callback(ripetizioni, blocchi=CALLBACK_BLOCKS):
+    """Throughput della callback del PolyphonicPlayer con voci da buffer e in streaming."""
+    frames = GBAudio.BLOCK_SIZE
+    outdata = np.zeros((frames, 2), dtype=np.float32)
+    durata_blocco_ms = frames * 1000.0 / GBAudio.FS
+    n_samples = frames * (blocchi + 1)
+    wave = (0.1 * np.sin(2 * np.pi * 220.0 * np.arange(n_samples) / GBAudio.FS)).astype(np.float32)
+    synth = GBAudio.FastGuitarSynth(fs=GBAudio.FS, seed=GBAudio.EXCITATION_SEED)
+    out = {}
+    for tipo in ("buffer", "stream"):
+        for voci in CALLBACK_VOICES:
+            player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=voci)
+
+            def carica():
+                for i in range(voci):
+                    if tipo == "buffer":
+                        voce = GBAudio.BufferVoice(wave)
+                    else:
+                        voce = synth.create_voice(STRING_FREQS[i % len(STRING_FREQS)], n_samples / GBAudio.FS, 0.1,
+                                                  KS_PARAMS['pluck_hardness'], KS_PARAMS['damping_factor'],
+                                                  KS_PARAMS['pick_position'], KS_PARAMS['brightness'], tail_db=None)
+                    player.pluck_voice(i, voce)
+
+            def esegui():
+                for _ in range(blocchi):
+                    player._audio_callback(outdata, frames, None, None)
+
+            tempi = misura(esegui, ripetizioni, prepara=carica)
+            per_blocco = min(tempi) / blocchi
+            out[f"callback/{tipo}/{voci}v"] = risultato(
+                tempi, blocks=blocchi, us_per_block=per_blocco * 1000.0,
+                load=per_blocco / durata_blocco_ms)
+    return out
+
+def bench_measure_buffer(ripetizioni):
+    metronomo = clitronomo.Metronome(bpm=120, time_signature="4/4")
+    out = {}
+    for sub in SUBDIVISIONS:
+        metronomo.subdivision_level = sub
+        tempi = misura(metronomo._generate_measure_buffer, ripetizioni)
+        out[f"measure_buffer/4-4/sub{sub}"] = risultato(tempi)
+    return out
+
+BENCHMARKS = {
+    'render_string': bench_render_string,
+    'legacy': bench_legacy,
+    'scale': bench_scale,
+    'callback': bench_callback,
+    'measure': bench_measure_buffer,
+}
+
+def esegui_benchmark(nomi, ripetizioni):
+    risultati = {}
+    for nome in nomi:
+        print(f"Benchmark {nome}...", flush=True)
+        risultati.update(BENCHMARKS[nome](ripetizioni))
+    return {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'fs': GBAudio.FS, 'block_size': GBAudio.BLOCK_SIZE, 'repeat': ripetizioni,
+        },
+        'results': risultati,
+    }
+
+def confronta(attuale, baseline, tolleranza):
+    """Stampa il confronto caso per caso. Restituisce la lista dei casi peggiorati."""
+    peggiorati = []
+    base = baseline.get('results', {})
+    print(f"\n{'Caso':<34} {'ms':>9} {'base':>9} {'rapporto':>9}")
+    for nome, r in attuale['results'].items():
+        b = base.get(nome)
+        if b is None:
+            print(f"{nome:<34} {r['min_ms']:9.3f} {'-':>9} {'nuovo':>9}")
+            continue
+        rapporto = r['min_ms'] / b['min_ms'] if b['min_ms'] > 0 else float('inf')
+        segno = ""
+        if rapporto > 1.0 + tolleranza:
+            segno = "  << REGRESSIONE"
+            peggiorati.append(nome)
+        print(f"{nome:<34} {r['min_ms']:9.3f} {b['min_ms']:9.3f} {rapporto:9.2f}{segno}")
+    if baseline.get('meta', {}).get('platform') != attuale['meta']['platform']:
+        print("\nAttenzione: la baseline è stata registrata su un'altra piattaforma.")
+    return peggiorati
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi audio di Chitabry.")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="Esegue solo questi gruppi")
+    parser.add_argument('--repeat', type=int, default=5, help="Ripetizioni per caso (default 5)")
+    parser.add_argument('--quick', action='store_true', help="Una sola ripetizione, per un controllo veloce")
+    parser.add_argument('--output', default=DEFAULT_RESULTS, help=f"File JSON dei risultati (default {DEFAULT_RESULTS})")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help=f"Baseline da confrontare (default {DEFAULT_BASELINE})")
+    parser.add_argument('--save-baseline', action='store_true', help="Salva i risultati anche come nuova baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Rallentamento tollerato, es. 0.25 = 25%% (default {DEFAULT_TOLERANCE})")
+    args = parser.parse_args(argv)
+
+    ripetizioni = 1 if args.quick else max(1, args.repeat)
+    attuale = esegui_benchmark(args.only or list(BENCHMARKS), ripetizioni)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(attuale, f, indent=2)
+    print(f"\nRisultati salvati in '{args.output}'.")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(attuale, f, indent=2)
+        print(f"Baseline aggiornata in '{args.baseline}'.")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"Nessuna baseline in '{args.baseline}': usa --save-baseline per crearla.")
+        return 0
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Impossibile leggere la baseline '{args.baseline}': {e}")
+        return 0
+
+    peggiorati = confronta(attuale, baseline, args.tolerance)
+    if peggiorati:
+        print(f"\n{len(peggiorati)} casi oltre la tolleranza del {args.tolerance:.0%}.")
+        return 1
+    print("\nNessuna regressione rispetto alla baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,13 +2,30 @@
 # Un metronomo da riga di comando.
 # Data di concepimento 9 settembre 2025.
 
+import contextlib
+import io
 import numpy as np
-import sounddevice as sd
 import threading
 import time
 import json
-
-SAMPLE_RATE = 44100 
+from collections import OrderedDict, deque
+import audio_backend
+
+SAMPLE_RATE = audio_backend.native_samplerate()  # La stessa di GBAudio.FS: quella nativa dell'uscita
+ENGINE_BUS = "metronomo"  # Nome del bus sul motore audio condiviso
+LOOKAHEAD_BARS = 2  # Battute già pronte in coda dietro a quella che sta suonando
+LOOKAHEAD_SECONDS = 0.5  # ...e almeno questo anticipo, per le battute molto corte
+LOOKAHEAD_POLL = 0.05  # Intervallo massimo (s) tra due controlli del thread di lookahead
+MEASURE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Budget della cache delle battute renderizzate
+MEASURE_CACHE_PHASE_STEPS = 64  # La fase d'inizio battuta viene arrotondata a 1/64 di campione
+DEFAULT_CONFIG_ACCENTO = {
+    "beep_duration_ms": 70, "volume_perc": 50, "attack_ms": 5,
+    "decay_ms": 8, "frequency_hz": 915.0
+}
+DEFAULT_CONFIG_TICK = {
+    "beep_duration_ms": 40, "volume_perc": 35, "attack_ms": 5,
+    "decay_ms": 12, "frequency_hz": 550.0
+}
 COMANDI = {
     'g', 's', 'b', '?', '0', '1', '2', '3',
     'v1', 'v2', 'v3',
@@ -19,7 +36,7 @@ COMANDI = {
     'ms', 'm', 'ml', 'mc',
     'q', 'i', 'x',
     'p', 'pa', 'pc',
-    'gb',
+    'gb', 'w', 'st',
 }
 HELP_STRING = """
 --- Menu Comandi Metronomo ---
@@ -54,6 +71,10 @@ HELP_STRING = """
   p           - Visualizza il programma del preset attivo
   pa          - Aggiunge uno step al programma (modo interattivo)
   pc <battuta>- Cancella uno step del programma (es. pc 16)
+  w [battute] - Esporta in WAV le battute indicate (default: tutto il programma)
+
+>> DIAGNOSTICA
+  st          - Statistiche audio: carico della callback, xrun, voci e picchi (st r per azzerarle)
 ---------------------------------
 """
 
@@ -103,6 +124,108 @@ def genera_suono_mono_int16(config):
     
     # --- 4. Restituisce direttamente il beep generato ---
     return beep_int16
+_click_cache = {}
+
+def genera_click(config):
+    """Beep in float32 (-1..1) per una configurazione, calcolato una volta e condiviso tra metronomo ed esercizi."""
+    key = tuple(sorted(config.items()))
+    beep = _click_cache.get(key)
+    if beep is None:
+        beep = _click_cache[key] = genera_suono_mono_int16(config).astype(np.float32) / 32767.0
+    return beep
+
+class MeasureCache:
+    """
+    Cache LRU delle battute già renderizzate, con un budget massimo in byte.
+    Rampe, ghost bars e programmi in loop ripassano per gli stessi stati:
+    la battuta si renderizza solo la prima volta che si incontra.
+    """
+    def __init__(self, max_bytes=MEASURE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(bpm, beats_per_measure, note_value, subdivision_level, configs, is_silent, phase):
+        """Una battuta muta dipende solo dalla sua lunghezza: suoni e suddivisioni non entrano nella chiave."""
+        timing = (SAMPLE_RATE, float(bpm), int(beats_per_measure), int(note_value), float(phase))
+        if is_silent:
+            return timing + (True,)
+        return timing + (False, int(subdivision_level), tuple(tuple(sorted(c.items())) for c in configs))
+
+    def get(self, key):
+        with self._lock:
+            buffer = self._items.get(key)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return buffer
+
+    def put(self, key, buffer):
+        size = buffer.nbytes
+        if size > self.max_bytes:
+            return
+        # Lo stesso nastro può finire più volte in coda: lo rendiamo di sola lettura
+        buffer.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._items[key] = buffer
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def summary(self):
+        total = self.hits + self.misses
+        riuso = 100.0 * self.hits / total if total else 0.0
+        return (f"Cache battute: {len(self)} nastri, {self.current_bytes / 1048576:.1f} MB, "
+                f"{riuso:.0f}% riusate ({self.hits}/{total})")
+
+_measure_cache = MeasureCache()
+
+def get_measure_cache():
+    return _measure_cache
+
+def click_preset_attivo():
+    """
+    Accento e tick (float32) del preset di metronomo usato per ultimo, o quelli di default:
+    chi suona i click fuori dal metronomo (es. l'esercizio delle scale) usa lo stesso suono.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, state = PresetManager().get_last_used_preset()
+    except Exception:
+        state = None
+    state = state or {}
+    return (genera_click(state.get('config_accento') or DEFAULT_CONFIG_ACCENTO),
+            genera_click(state.get('config_tick') or DEFAULT_CONFIG_TICK))
+
+class _QueuedBar:
+    """Battuta pronta per la callback: nastro, flag di muto e stato della sessione prima di calcolarla."""
+    __slots__ = ('buffer', 'silent', 'state', 'messages')
+    def __init__(self, buffer, silent, state, messages):
+        self.buffer = buffer
+        self.silent = silent
+        self.state = state
+        self.messages = messages
+
 class Metronome:
     def __init__(self, bpm=120, time_signature="4/4"):
         self.is_dirty = False
@@ -112,8 +235,7 @@ class Metronome:
         self.bpm = bpm
         self.time_signature = time_signature
         self.beats_per_measure, self.note_value = map(int, self.time_signature.split('/'))
-        # Attributi per la gestione dello stream e del timing
-        self.stream = None
+        # Attributi per la gestione del timing (lo stream è quello del motore audio condiviso)
         self.is_running = threading.Event()
         # Attributi per la logica della callback
         self.config_subdivision = {
@@ -122,25 +244,22 @@ class Metronome:
         }
         self.subdivision_level = 0
         self.active_buffer = np.array([], dtype=np.int16) # Il nastro audio in riproduzione
-        self.pending_buffer = None # Il nastro audio che prepariamo quando cambia un parametro
+        self.active_silent = False # La battuta in riproduzione è muta (programma o ghost bar)
         self.buffer_lock = threading.RLock()
+        self._click_lock = threading.Lock() # Solo per i click in cache: la callback non lo prende mai
         self.cached_accent_beep = None
         self.cached_tick_beep = None
         self.cached_sub_beep = None
         self.playback_index = 0 # La nostra "puntina" sul nastro
-        self.config_accento = {
-            "beep_duration_ms": 70, "volume_perc": 50, "attack_ms": 5,
-            "decay_ms": 8, "frequency_hz": 915.0
-        }
-        self.config_tick = {
-            "beep_duration_ms": 40, "volume_perc": 35, "attack_ms": 5,
-            "decay_ms": 12, "frequency_hz": 550.0
-        }
+        self.config_accento = dict(DEFAULT_CONFIG_ACCENTO)
+        self.config_tick = dict(DEFAULT_CONFIG_TICK)
         self.program = []                       # Lista dei segmenti del programma
         self.program_current_segment_index = -1 # Indice del segmento attualmente in esecuzione
         self.is_muted_by_program = False        # Flag per le sezioni mute
         self.bpm_ramp_active = False            # Flag per le transizioni di BPM
         self.bpm_increment_per_measure = 0.0
+        self.bpm_initial = float(bpm)
+        self.bpm_target = bpm
         # Attributi per Ghost Bars
         self.ghost_mode = None
         self.ghost_cyclic_audible = 3
@@ -150,6 +269,23 @@ class Metronome:
         self.ghost_random_duration_max = 2
         self.ghost_silent_bars_left = 0
         self.is_muted_by_ghost = False
+        # Statistiche della callback (comando 'st')
+        self.stats = audio_backend.get_stats("Metronomo", SAMPLE_RATE)
+        # Lookahead: un thread calcola in anticipo programma, rampe e ghost bars e renderizza
+        # le battute successive; la callback si limita a passare al nastro seguente.
+        # Tutto ciò che riguarda la sessione (bpm, programma, ghost) è quindi avanti di qualche battuta.
+        self.timeline_measure_count = 0 # Battute già calcolate dal lookahead
+        self.timeline_phase = 0.0       # Parte frazionaria (in campioni) dell'inizio della prossima battuta
+        self.lookahead_misses = 0       # Battute ripetute perché la coda era vuota
+        self._bar_queue = deque()
+        self._timeline_lock = threading.Lock()
+        self._timeline_buffer = self.active_buffer
+        self._timeline_buffer_phase = 0.0
+        self._timeline_dirty = True
+        self._timeline_messages = []
+        self._announcements = deque()
+        self._lookahead_wake = threading.Event()
+        self._lookahead_thread = None
     def display_status(self, preset_manager):
         """Mostra una tabella riassuntiva di tutte le impostazioni correnti."""
         print("\n--- Stato Attuale Metronomo ---")
@@ -213,6 +349,7 @@ class Metronome:
         
         if len(self.program) < step_count_before:
             self.is_dirty = True
+            self._request_buffer_rebuild()
             print(f"Segmento che inizia alla battuta {start_bar} cancellato.")
             self.display_program()
         else:
@@ -236,14 +373,8 @@ class Metronome:
         self.is_muted_by_ghost = False
 
         # Ripristina anche i parametri dei suoni
-        self.config_accento = {
-            "beep_duration_ms": 70, "volume_perc": 50, "attack_ms": 5,
-            "decay_ms": 8, "frequency_hz": 915.0
-        }
-        self.config_tick = {
-            "beep_duration_ms": 40, "volume_perc": 35, "attack_ms": 5,
-            "decay_ms": 12, "frequency_hz": 550.0
-        }
+        self.config_accento = dict(DEFAULT_CONFIG_ACCENTO)
+        self.config_tick = dict(DEFAULT_CONFIG_TICK)
         self.config_subdivision = {
             "beep_duration_ms": 10, "volume_perc": 15, "attack_ms": 2,
             "decay_ms": 8, "frequency_hz": 1030.0
@@ -253,7 +384,7 @@ class Metronome:
         self.cached_tick_beep = None
         self.cached_sub_beep = None
         print("\n>> Metronomo resettato alle impostazioni di fabbrica.")
-        self._request_buffer_rebuild()
+        self._request_buffer_rebuild(bpm=self.bpm)
     def set_state(self, state, preset_id):
         """Applica uno stato salvato al metronomo."""
         try:
@@ -280,21 +411,29 @@ class Metronome:
             self.cached_tick_beep = None
             self.cached_sub_beep = None
             print(f"Stato del preset ID{preset_id} applicato.")
-            self._request_buffer_rebuild()
+            self._request_buffer_rebuild(bpm=self.bpm)
             
         except KeyError as e:
             print(f"\nERRORE: Dati mancanti o corrotti nel preset. Chiave non trovata: {e}")
-    def _generate_measure_buffer(self, is_silent=False):
+    def _beat_length(self):
+        """Durata esatta di un beat in campioni (frazionaria: non viene mai troncata)."""
+        # Durata di una semiminima (1/4) in base ai BPM, scalata secondo il denominatore
+        samples_per_quarter_note = (60.0 / self.bpm) * SAMPLE_RATE
+        return samples_per_quarter_note * (4 / self.note_value)
+    def _measure_length(self):
+        """Durata esatta di una battuta in campioni."""
+        return self._beat_length() * self.beats_per_measure
+    def _generate_measure_buffer(self, is_silent=False, phase=0.0):
         """
         "Renderizza" un'intera battuta in un unico array numpy,
         mixando accento, beat e suddivisioni, oppure generando silenzio.
+        'phase' (0..1) è la parte frazionaria della posizione esatta in cui inizia la battuta:
+        ogni click cade sul campione più vicino alla sua posizione esatta e il nastro dura
+        fino al campione in cui comincia la battuta successiva.
         """
-        # --- CORREZIONE: Il calcolo della lunghezza ora avviene SEMPRE per primo ---
-        # 1. Calcoliamo la durata di una semiminima (1/4) in base ai BPM
-        samples_per_quarter_note = (60.0 / self.bpm) * SAMPLE_RATE
-        # 2. Calcoliamo la durata del nostro beat in base al denominatore
-        samples_per_beat = int(samples_per_quarter_note * (4 / self.note_value))
-        samples_per_measure = int(samples_per_beat * self.beats_per_measure) # Usiamo int() per sicurezza
+        # --- Il calcolo della lunghezza avviene SEMPRE per primo ---
+        samples_per_beat = self._beat_length()
+        samples_per_measure = int(phase + samples_per_beat * self.beats_per_measure)
         
         # --- ORA controlliamo se la battuta deve essere silenziosa ---
         if is_silent:
@@ -306,13 +445,13 @@ class Metronome:
         measure_buffer = np.zeros(samples_per_measure, dtype=np.float32)
 
         # 3. Genera i singoli "beep" (accento, tick e suddivisione) usando la cache se disponibile
-        with self.buffer_lock:
+        with self._click_lock:
             if self.cached_accent_beep is None:
-                self.cached_accent_beep = genera_suono_mono_int16(self.config_accento).astype(np.float32) / 32767.0
+                self.cached_accent_beep = genera_click(self.config_accento)
             if self.cached_tick_beep is None:
-                self.cached_tick_beep = genera_suono_mono_int16(self.config_tick).astype(np.float32) / 32767.0
+                self.cached_tick_beep = genera_click(self.config_tick)
             if self.cached_sub_beep is None:
-                self.cached_sub_beep = genera_suono_mono_int16(self.config_subdivision).astype(np.float32) / 32767.0
+                self.cached_sub_beep = genera_click(self.config_subdivision)
             
             accent_beep = self.cached_accent_beep
             tick_beep = self.cached_tick_beep
@@ -320,7 +459,8 @@ class Metronome:
         
         # 4. "Disegna" i suoni sul nastro, beat per beat
         for beat_num in range(self.beats_per_measure):
-            start_pos = beat_num * samples_per_beat
+            beat_pos = phase + beat_num * samples_per_beat
+            start_pos = int(beat_pos + 0.5)
             
             # Scegli e disegna il beat principale (accento o tick)
             main_beep = accent_beep if beat_num == 0 else tick_beep
@@ -331,9 +471,9 @@ class Metronome:
             
             # Disegna le suddivisioni
             if self.subdivision_level > 1 and len(sub_beep) > 0:
-                samples_per_sub = int(samples_per_beat / self.subdivision_level)
+                samples_per_sub = samples_per_beat / self.subdivision_level
                 for sub_num in range(1, self.subdivision_level):
-                    sub_start_pos = start_pos + (sub_num * samples_per_sub)
+                    sub_start_pos = int(beat_pos + sub_num * samples_per_sub + 0.5)
                     
                     if sub_start_pos >= samples_per_measure:
                         break
@@ -350,6 +490,21 @@ class Metronome:
             measure_buffer /= peak
             
         return (measure_buffer * 32767.0).astype(np.int16)
+    def _measure_buffer(self, is_silent=False, phase=0.0):
+        """
+        Come _generate_measure_buffer, ma passando dalla cache delle battute.
+        La fase viene arrotondata alla griglia di MEASURE_CACHE_PHASE_STEPS, così gli stati
+        che si ripetono condividono il nastro e l'errore sui click resta sotto il campione;
+        l'accumulatore di fase usa comunque la lunghezza del nastro restituito.
+        """
+        phase = round(phase * MEASURE_CACHE_PHASE_STEPS) / MEASURE_CACHE_PHASE_STEPS
+        key = MeasureCache.make_key(self.bpm, self.beats_per_measure, self.note_value, self.subdivision_level,
+                                    (self.config_accento, self.config_tick, self.config_subdivision), is_silent, phase)
+        buffer = _measure_cache.get(key)
+        if buffer is None:
+            buffer = self._generate_measure_buffer(is_silent=is_silent, phase=phase)
+            _measure_cache.put(key, buffer)
+        return buffer
     def update_sound_param(self, command, value):
         """Aggiorna un parametro del suono per accento(1), tick(2) o suddivisione(3)."""
         param_map = {
@@ -389,24 +544,29 @@ class Metronome:
                 print(f"\nERRORE: La somma di Attack ({attack}ms) e Decay ({decay}ms) non può superare la Durata ({duration}ms).")
                 return
                 
-            target_dict[param_key] = val
             print(f"\n{param_key} per {'accento' if target_char == '1' else 'tick' if target_char == '2' else 'suddivisione'} impostato a {val}.")
-            if target_char == '1':
-                self.cached_accent_beep = None
-            elif target_char == '2':
-                self.cached_tick_beep = None
-            elif target_char == '3':
-                self.cached_sub_beep = None
+            with self._click_lock:
+                target_dict[param_key] = val
+                if target_char == '1':
+                    self.cached_accent_beep = None
+                elif target_char == '2':
+                    self.cached_tick_beep = None
+                elif target_char == '3':
+                    self.cached_sub_beep = None
             self.is_dirty = True
             self._request_buffer_rebuild()
 
         except (ValueError, IndexError):
             print(f"\nValore non valido: '{value}'. Inserire un numero intero.")
-    def _audio_callback(self, outdata, frames, time, status):
-        """Callback corretta che gestisce il loop e lo swap dei buffer."""
-        if status:
-            print(status, flush=True)
-
+    def _audio_callback(self, outdata, frames, time_info, status):
+        """Callback dello stream: riempie il blocco e ne registra durata, xrun e picco nelle statistiche."""
+        t0 = time.perf_counter()
+        self._fill_output(outdata, frames)
+        voices = 0 if self.active_silent else 1
+        peak = max(int(outdata.max()), -int(outdata.min())) / 32767.0
+        self.stats.record(time.perf_counter() - t0, frames, status, voices, peak)
+    def _fill_output(self, outdata, frames):
+        """Copia il nastro in uscita e, a fine battuta, passa alla successiva già pronta in coda."""
         needed_frames = frames
         written_frames = 0
         
@@ -418,23 +578,25 @@ class Metronome:
                     return
 
                 if self.playback_index >= buffer_len:
-                    self._check_program_events()
-                    self._update_ramp()
-                    self._update_ghost_bars()
-                    
-                    if self.pending_buffer is not None:
-                        self.active_buffer = self.pending_buffer
-                        self.pending_buffer = None
-                    
+                    if self._bar_queue:
+                        bar = self._bar_queue.popleft()
+                        self.active_buffer = bar.buffer
+                        self.active_silent = bar.silent
+                        if bar.messages:
+                            self._announcements.append(bar.messages)
+                    else:
+                        # Il lookahead è in ritardo: meglio ripetere la battuta che fermarsi
+                        self.lookahead_misses += 1
                     self.session_measure_count += 1
                     self.playback_index = 0
+                    self._lookahead_wake.set()
                     continue
 
                 remaining_in_buffer = buffer_len - self.playback_index
                 frames_to_write = min(needed_frames - written_frames, remaining_in_buffer)
                 
                 if frames_to_write > 0:
-                    if getattr(self, 'is_muted_by_ghost', False) or self.is_muted_by_program:
+                    if self.active_silent:
                         outdata[written_frames : written_frames + frames_to_write] = 0
                     else:
                         outdata[written_frames : written_frames + frames_to_write] = \
@@ -442,17 +604,143 @@ class Metronome:
 
                     self.playback_index += frames_to_write
                     written_frames += frames_to_write
-    def _request_buffer_rebuild(self):
-        """Chiede di generare un nuovo buffer (silenzioso o normale) e lo mette in attesa."""
-        new_buffer = self._generate_measure_buffer(is_silent=self.is_muted_by_program)
-        with self.buffer_lock:
-            self.pending_buffer = new_buffer
+    def render_to_wav(self, path, num_bars=None, block_size=512):
+        """
+        Esporta in un file WAV le prime num_bars battute di una sessione, con
+        programma, rampe e ghost bars, senza usare la scheda audio.
+        Il nastro viene prodotto dallo stesso codice della callback usata in riproduzione.
+        """
+        if self.is_running.is_set():
+            print("\nFerma il metronomo prima di esportare.")
+            return None
+        if num_bars is None:
+            num_bars = max([seg['end_bar'] for seg in self.program], default=0) + 1
+            if num_bars < 8: num_bars = 8
+        saved = (self._timeline_state(), self.session_measure_count, self.playback_index,
+                 self.active_buffer, self.active_silent)
+        # Stesso stato iniziale di start(), con il programma ripreso da capo
+        self.program_current_segment_index = -1
+        self.is_muted_by_program = False
+        self.bpm_ramp_active = False
+        self._reset_timeline()
+        outdata = np.zeros((block_size, 1), dtype=np.int16)
+        try:
+            with audio_backend.WavWriter(path, fs=SAMPLE_RATE, channels=1) as writer:
+                while self.session_measure_count < num_bars:
+                    self._fill_lookahead()
+                    self._fill_output(outdata, block_size)
+                    self._print_announcements()
+                    writer.write(outdata)
+                frames = writer.frames_written
+        finally:
+            state, self.session_measure_count, self.playback_index, self.active_buffer, self.active_silent = saved
+            self._restore_timeline(state)
+            self._bar_queue.clear()
+            self._announcements.clear()
+            self._timeline_dirty = True
+        print(f"\n{num_bars} battute esportate in {path} ({frames / SAMPLE_RATE:.1f}s).")
+        return path
+    def _request_buffer_rebuild(self, bpm=None):
+        """
+        Un parametro è cambiato: scarta le battute già in coda e riporta la sessione
+        allo stato di quella che segue la battuta in riproduzione, che il lookahead
+        renderizzerà di nuovo con i parametri aggiornati.
+        'bpm' va passato solo quando è l'utente a cambiare il tempo: altrimenti
+        restano i BPM salvati con la battuta, non quelli già calcolati in anticipo.
+        """
+        with self._timeline_lock:
+            with self.buffer_lock:
+                self._rewind_queue()
+                if bpm is not None:
+                    self.bpm = bpm
+                self._timeline_dirty = True
+        self._lookahead_wake.set()
+    def _rewind_queue(self):
+        """Svuota la coda riportando la sessione allo stato precedente alla prima battuta non ancora suonata."""
+        if self._bar_queue:
+            self._restore_timeline(self._bar_queue[0].state)
+            self._bar_queue.clear()
+    def _timeline_state(self):
+        """Stato della sessione che avanza battuta per battuta (programma, rampa, ghost bars)."""
+        return (self.bpm, self.timeline_measure_count, self.timeline_phase, self.program_current_segment_index,
+                self.is_muted_by_program, self.bpm_ramp_active, self.bpm_initial, self.bpm_target,
+                self.bpm_increment_per_measure, self.ghost_silent_bars_left, self.is_muted_by_ghost)
+    def _restore_timeline(self, state):
+        (self.bpm, self.timeline_measure_count, self.timeline_phase, self.program_current_segment_index,
+         self.is_muted_by_program, self.bpm_ramp_active, self.bpm_initial, self.bpm_target,
+         self.bpm_increment_per_measure, self.ghost_silent_bars_left, self.is_muted_by_ghost) = state
+    def _reset_timeline(self):
+        """Riporta la sessione alla prima battuta, con il suo nastro già pronto e la coda vuota."""
+        with self._timeline_lock:
+            # Il nastro si calcola fuori da buffer_lock e si scambia sotto: la callback non aspetta mai un render
+            first = self._measure_buffer()
+            with self.buffer_lock:
+                self.session_measure_count = 0
+                self.timeline_measure_count = 0
+                self.playback_index = 0
+                self._bar_queue.clear()
+                self._announcements.clear()
+                self._timeline_messages = []
+                self._timeline_buffer = self.active_buffer = first
+                self._timeline_buffer_phase = 0.0
+                self._timeline_dirty = False
+                self.active_silent = False
+                # Il resto frazionario della prima battuta passa alla seconda
+                self.timeline_phase = self._measure_length() - len(self.active_buffer)
+    def _announce(self, message):
+        """Messaggio da stampare quando inizierà a suonare la battuta che si sta calcolando."""
+        self._timeline_messages.append(message)
+    def _print_announcements(self):
+        while self._announcements:
+            for message in self._announcements.popleft():
+                print(message, end="", flush=True)
+    def _render_next_bar(self):
+        """Calcola la battuta successiva: eventi del programma, rampa, ghost bars e, se serve, un nuovo nastro."""
+        state = self._timeline_state()
+        self._check_program_events()
+        self._update_ramp()
+        self._update_ghost_bars()
+        self.timeline_measure_count += 1
+        # Accumulatore di fase: ogni battuta comincia dove è finita esattamente la precedente,
+        # quindi gli arrotondamenti al campione non si sommano mai tra una battuta e l'altra
+        phase = self.timeline_phase
+        if self._timeline_dirty or phase != self._timeline_buffer_phase:
+            self._timeline_buffer = self._measure_buffer(is_silent=self.is_muted_by_program, phase=phase)
+            self._timeline_buffer_phase = phase
+            self._timeline_dirty = False
+        self.timeline_phase = phase + self._measure_length() - len(self._timeline_buffer)
+        bar = _QueuedBar(self._timeline_buffer, self.is_muted_by_program or self.is_muted_by_ghost,
+                         state, self._timeline_messages)
+        self._timeline_messages = []
+        return bar
+    def _fill_lookahead(self):
+        """Porta la coda ad almeno LOOKAHEAD_BARS battute e LOOKAHEAD_SECONDS di audio."""
+        min_frames = int(LOOKAHEAD_SECONDS * SAMPLE_RATE)
+        while True:
+            with self._timeline_lock:
+                with self.buffer_lock:
+                    queued = sum(len(bar.buffer) for bar in self._bar_queue)
+                    if len(self._bar_queue) >= LOOKAHEAD_BARS and queued >= min_frames:
+                        return
+                bar = self._render_next_bar()
+                with self.buffer_lock:
+                    self._bar_queue.append(bar)
+    def _lookahead_loop(self):
+        """Thread di lookahead: si sveglia a ogni cambio di battuta e rimette in pari la coda."""
+        while self.is_running.is_set():
+            self._print_announcements()
+            try:
+                self._fill_lookahead()
+            except Exception as e:
+                print(f"\nErrore nel lookahead del metronomo: {e}")
+            self._lookahead_wake.wait(LOOKAHEAD_POLL)
+            self._lookahead_wake.clear()
     def set_bpm(self, new_bpm):
         if 5 <= new_bpm <= 1000:
             self.bpm = new_bpm
             print(f"\nBPM impostati a {self.bpm}. La modifica sarà attiva dalla prossima battuta.")
             self.is_dirty = True
-            self._request_buffer_rebuild()
+            self._request_buffer_rebuild(bpm=new_bpm)
         else:
             print("\nValore BPM non valido.")
     def set_subdivision(self, level_code):
@@ -485,21 +773,20 @@ class Metronome:
         if self.is_running.is_set():
             return
         print("Metronomo avviato.")
-        self.session_measure_count = 0
         self.session_start_time = time.perf_counter()
         
-        # Genera il primo nastro audio prima di partire
-        self.active_buffer = self._generate_measure_buffer()
+        # Genera il primo nastro audio e le battute successive prima di partire
+        self._reset_timeline()
+        self._fill_lookahead()
         
         # NOTA: In questa versione corretta, non c'è nessuna riga "self.is_dirty = True".
         # L'azione di avvio non modifica il preset.
         
         self.is_running.set()
-        self.stream = sd.OutputStream(
-            samplerate=SAMPLE_RATE, channels=1, dtype=np.int16,
-            callback=self._audio_callback, latency='low'
-        )
-        self.stream.start()
+        self._lookahead_thread = threading.Thread(target=self._lookahead_loop, name="metronomo-lookahead", daemon=True)
+        self._lookahead_thread.start()
+        # Il metronomo è un bus del motore audio condiviso: può suonare insieme alle altre viste
+        audio_backend.get_engine().add_bus(ENGINE_BUS, self._audio_callback, channels=1, dtype=np.int16)
     def stop(self):
         if not self.is_running.is_set():
             return
@@ -539,9 +826,16 @@ class Metronome:
             # Azzeriamo il tempo di partenza
             self.session_start_time = None        
         self.is_running.clear()
-        if self.stream:
-            self.stream.stop()
-            self.stream.close()
+        audio_backend.get_engine().remove_bus(ENGINE_BUS)
+        self._lookahead_wake.set()
+        if self._lookahead_thread is not None:
+            self._lookahead_thread.join(timeout=1.0)
+            self._lookahead_thread = None
+        self._print_announcements()
+        # Riporta bpm e contatori allo stato della battuta interrotta, non a quello calcolato in anticipo
+        with self._timeline_lock:
+            with self.buffer_lock:
+                self._rewind_queue()
         self.playback_index = 0
         self.program_current_segment_index = -1 # Dimentica quale segmento stava eseguendo
         self.is_muted_by_program = False      # Rimuovi lo stato di "muto" forzato
@@ -757,20 +1051,21 @@ class Metronome:
             # Rimuove per sicurezza un segmento con start_bar identica se non rilevato (non dovrebbe succedere con la logica sopra)
             self.program = [s for s in self.program if s['start_bar'] != start_bar]
 
-        self.program.append({
+        new_segment = {
             "start_bar": start_bar,
             "end_bar": end_bar,
             "target_bpm": target_bpm,
             "is_audible": is_audible
-        })
-
-        self.program.sort(key=lambda s: s['start_bar']) # Mantiene la lista ordinata
+        }
+        # Lista nuova e già ordinata: il thread di lookahead può leggere il programma in qualsiasi momento
+        self.program = sorted(self.program + [new_segment], key=lambda s: s['start_bar'])
         self.is_dirty = True
+        self._request_buffer_rebuild()
         print(f"Segmento [BATT. {start_bar} -> {end_bar}] aggiunto/modificato.")
         self.display_program()
     def _check_program_events(self):
         """Controlla se la battuta corrente attiva un nuovo segmento del programma."""
-        current_bar = self.session_measure_count + 1
+        current_bar = self.timeline_measure_count + 1
 
         # Cerca il prossimo segmento da attivare
         next_segment_index = -1
@@ -788,7 +1083,7 @@ class Metronome:
     def _activate_segment(self, segment):
         """Attiva un segmento: imposta il ramp di BPM e lo stato di mute."""
         stato_suono = "Suono Attivo" if segment['is_audible'] else "Muto"
-        print(f"\nP: [BATT. {segment['start_bar']} -> {segment['end_bar']}] - Target: {segment['target_bpm']} BPM ({stato_suono})",end="")
+        self._announce(f"\nP: [BATT. {segment['start_bar']} -> {segment['end_bar']}] - Target: {segment['target_bpm']} BPM ({stato_suono})")
         start_bar = segment['start_bar']
         end_bar = segment['end_bar']
         duration_in_bars = end_bar - start_bar
@@ -802,19 +1097,19 @@ class Metronome:
         else: # Transizione istantanea se start_bar == end_bar
             self.bpm_ramp_active = False
             self.bpm = segment['target_bpm']
-        self._request_buffer_rebuild()
+        self._timeline_dirty = True
     def _update_ramp(self):
         """Se un ramp è attivo, aggiorna i BPM per la battuta corrente."""
         if not self.bpm_ramp_active: return
 
         segment = self.program[self.program_current_segment_index]
-        current_bar = self.session_measure_count + 1
+        current_bar = self.timeline_measure_count + 1
         
         if current_bar <= segment['end_bar']:
             measures_into_ramp = current_bar - segment['start_bar']
             new_bpm = self.bpm_initial + (self.bpm_increment_per_measure * measures_into_ramp)
             self.bpm = round(new_bpm)
-            self._request_buffer_rebuild()
+            self._timeline_dirty = True
             
         else:
             # Il ramp è terminato, imposta i valori finali
@@ -824,14 +1119,14 @@ class Metronome:
             if self.is_muted_by_program:
                 self.is_muted_by_program = False 
             
-            self._request_buffer_rebuild()
-            print("\n P: Fine segmento.",end="")
+            self._timeline_dirty = True
+            self._announce("\n P: Fine segmento.")
     def _update_ghost_bars(self):
         if not getattr(self, 'ghost_mode', None):
             self.is_muted_by_ghost = False
             return
 
-        next_bar_idx = self.session_measure_count + 1
+        next_bar_idx = self.timeline_measure_count + 1
         was_muted = getattr(self, 'is_muted_by_ghost', False)
         is_silent = False
 
@@ -855,9 +1150,9 @@ class Metronome:
             self.is_muted_by_ghost = is_silent
 
         if is_silent and not was_muted:
-            print(" [GHOST MUTO]", end="", flush=True)
+            self._announce(" [GHOST MUTO]")
         elif not is_silent and was_muted:
-            print(" [GHOST SUONO]", end="", flush=True)
+            self._announce(" [GHOST SUONO]")
 
 class PresetManager:
     """Gestisce la lettura, scrittura e manipolazione dei preset da file JSON."""
@@ -1180,6 +1475,26 @@ def main():
                 print("Formato non valido. Usa: pc <battuta>")
         elif command == 'i':
             clitronomo.display_status(preset_manager)
+        elif command == 'w':
+            try:
+                num_bars = int(value) if value else None
+                if num_bars is not None and num_bars < 1:
+                    raise ValueError()
+                clitronomo.render_to_wav(f"metronomo_{time.strftime('%Y%m%d_%H%M%S')}.wav", num_bars)
+            except ValueError:
+                print("Formato non valido. Usa: w [battute]")
+        elif command == 'st':
+            if value in ('r', 'reset'):
+                for stats in audio_backend.all_stats():
+                    stats.reset()
+                clitronomo.lookahead_misses = 0
+                _measure_cache.hits = _measure_cache.misses = 0
+                print("\nStatistiche audio azzerate.")
+            else:
+                print("\n--- Statistiche Audio ---")
+                print(audio_backend.stats_report())
+                print(f"Battute ripetute per lookahead in ritardo: {clitronomo.lookahead_misses}")
+                print(_measure_cache.summary())
         elif command.startswith('b'):
             if clitronomo.is_running.is_set() and clitronomo.bpm_ramp_active:
                 print("\nERRORE: Impossibile cambiare i BPM manualmente durante una programmazione attiva.")
@@ -1260,6 +1575,7 @@ def main():
                     clitronomo.ghost_mode = None
                     clitronomo.is_muted_by_ghost = False
                     clitronomo.is_dirty = True
+                    clitronomo._request_buffer_rebuild()
                     print("\nGhost Bars disattivate.")
                 elif subcmd in ('c', 'cyclic'):
                     try:
@@ -1272,6 +1588,7 @@ def main():
                         clitronomo.ghost_cyclic_silent = silent
                         clitronomo.is_muted_by_ghost = False
                         clitronomo.is_dirty = True
+                        clitronomo._request_buffer_rebuild()
                         print(f"\nGhost Bars impostate su Ciclico: {audible} battute a tempo, {silent} mute.")
                     except (IndexError, ValueError):
                         print("\nErrore: per la modalità ciclica usa 'gb c <suonano> <mute>' con numeri >= 1 (es. gb c 3 1).")
@@ -1299,6 +1616,7 @@ def main():
                         clitronomo.ghost_silent_bars_left = 0
                         clitronomo.is_muted_by_ghost = False
                         clitronomo.is_dirty = True
+                        clitronomo._request_buffer_rebuild()
                         print(f"\nGhost Bars impostate su Casuale: probabilità {prob}%, durata {dur_min}-{dur_max} battute.")
                     except (IndexError, ValueError):
                         print("\nErrore: per la modalità casuale usa 'gb r <prob_percentuale>' (es. gb r 25) o 'gb r <prob> <min>-<max>'.")
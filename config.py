@@ -73,6 +73,11 @@ def get_impostazioni_default():
         "tipo_suono": "suono_1",
         "midi_strumento": 0,
         "midi_in_dispositivo": "",
+        "polifonia": 16,
+        "audio_backend": "sounddevice",
+        "cassa_ir": "",      # WAV con la risposta all'impulso della cassa ("" = disattivata)
+        "cassa_mix": 0.5,    # 0 = solo corde, 1 = solo cassa
+        "audio_log": "",     # File di log delle statistiche audio ("" = disattivato)
         "suono_1": {
             "descrizione": "Suono per accordi (Karplus-Strong Pluck)",
             "pluck_hardness": 0.2,    # Range 0.1 (morbido) - 0.9 (aggressivo)
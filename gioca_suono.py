@@ -78,10 +78,9 @@ def avvia_gioco(impostazioni, get_nota, NOTE_LATINE, NOTE_STD, NOTE_ANGLO, on_sa
                     dur = 2.0
                     renderer.set_params(target_freq, dur, vol, 0.0, kind=s.get('kind', 1), adsr_list=s.get('adsr', [0,0,0,0]))
                 
-                note_audio = renderer.render()
-                if note_audio.size > 0:
-                    mono_audio = note_audio[:, 0] / renderer.pan_l if renderer.pan_l != 0 else note_audio[:, 0]
-                    poly_player.pluck(string_idx=0, audio_mono=mono_audio)
+                voce = renderer.create_voice()
+                if voce is not None:
+                    poly_player.pluck_voice(0, voce)
 
             play_target() # Suona subito all'inizio del round
             
@@ -6,13 +6,13 @@ import re
 import json
 import time
 import numpy as np
-import sounddevice as sd
 import mido
 import ctypes
 from music21 import converter, stream, note, chord, meter, tempo, key as m21key
 from GBUtils import menu, key
 from fractions import Fraction
 import GBAudio
+import audio_backend
 
 # Costanti
 MIDISTUDY_VERSION = "0.4.8 (Alpha) del 21 maggio 2026"
@@ -20,6 +20,10 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_MIDI_DIR = os.path.join(BASE_DIR, "midi")
 SETTINGS_FILE = os.path.join(BASE_DIR, "chitabry-settings.json")
 TEMP_PREVIEW_FILE = os.path.join(DEFAULT_MIDI_DIR, "preview_temp.mid")
+SOUND_NAMES = {1: "Chitarra", 2: "Synth (Flauto)"}
+
+# Suono scelto nel visualizzatore (tasto P): lo usa anche l'esportazione WAV
+tipo_suono_attivo = 2 # Default: Synth/Flauto
 
 def _header():
     print("\n" + "="*40)
@@ -501,19 +505,18 @@ def play_battuta_audio(part, numero_battuta, tipo_suono=2, bpm_override=None):
                 if buf.size > 0: segmenti.append(buf)
             elif isinstance(el, chord.Chord):
                 chord_buf = np.zeros((int(dur_sec * GBAudio.FS), 2), dtype=np.float32)
-                for p in el.pitches:
-                    f = GBAudio.note_to_freq(p.nameWithOctave)
-                    if tipo_suono == 1: renderer.set_params(f, dur_sec, suono_params['volume'], 0.0, pluck_hardness=suono_params['pluck_hardness'], damping_factor=suono_params['damping_factor'])
-                    else: renderer.set_params(f, dur_sec, suono_params['volume'], 0.0, kind=suono_params['kind'], adsr_list=suono_params['adsr'])
-                    n_buf = renderer.render()
-                    if n_buf.size > 0:
-                        min_l = min(len(chord_buf), len(n_buf))
-                        chord_buf[:min_l] += n_buf[:min_l]
+                freqs = GBAudio.notes_to_freqs([p.nameWithOctave for p in el.pitches])
+                if tipo_suono == 1: synth_kwargs = dict(pluck_hardness=suono_params['pluck_hardness'], damping_factor=suono_params['damping_factor'])
+                else: synth_kwargs = dict(kind=suono_params['kind'], adsr_list=suono_params['adsr'])
+                n_buf = GBAudio.render_chord(freqs, dur_sec, suono_params['volume'], **synth_kwargs)
+                if n_buf.size > 0:
+                    min_l = min(len(chord_buf), len(n_buf))
+                    chord_buf[:min_l] += n_buf[:min_l]
                 mx = np.max(np.abs(chord_buf))
                 if mx > 1.0: chord_buf /= mx
                 segmenti.append(chord_buf)
             elif isinstance(el, note.Rest): segmenti.append(np.zeros((int(dur_sec * GBAudio.FS), 2), dtype=np.float32))
-        if segmenti: sd.play(np.concatenate(segmenti, axis=0), samplerate=GBAudio.FS, blocking=False)
+        if segmenti: audio_backend.get_engine().play(np.concatenate(segmenti, axis=0), GBAudio.FS)
     except Exception as e: print(f"Errore audio: {e}")
 
 def esegui_trasposizione(part):
@@ -600,8 +603,9 @@ def visualizzatore_interattivo(output_lines, part):
     tot_righe = len(output_lines)
     idx = 0
     play_continuo = False
-    current_sound_type = 2 # Default: Synth/Flauto
-    sound_names = {1: "Chitarra", 2: "Synth (Flauto)"}
+    global tipo_suono_attivo
+    current_sound_type = tipo_suono_attivo
+    sound_names = SOUND_NAMES
     
     with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
         bpm = float(json.load(f).get('default_bpm', 60))
@@ -645,7 +649,7 @@ def visualizzatore_interattivo(output_lines, part):
             
             if k:
                 play_continuo = False
-                sd.stop()
+                audio_backend.get_engine().stop_previews()
             else:
                 if idx < tot_righe - 1:
                     idx += 1
@@ -656,7 +660,7 @@ def visualizzatore_interattivo(output_lines, part):
         if not k:
             k = key().lower()
         
-        if k == chr(27) or k == 'q' or k == 'esc': sd.stop(); break
+        if k == chr(27) or k == 'q' or k == 'esc': audio_backend.get_engine().stop_previews(); break
         elif k == 'x' or k == 'right' or k == 'down': idx = min(idx + 1, tot_righe - 1)
         elif k == 'z' or k == 'left' or k == 'up': idx = max(idx - 1, 0)
         elif k == '+': bpm += 1
@@ -673,10 +677,11 @@ def visualizzatore_interattivo(output_lines, part):
             # Reimposta print header
             print("\nComandi: [Z/X] Naviga, [+] [-] [=] BPM, [T] Trasponi, [SPAZIO] Play, [P] Strumento, [INVIO] Continuo, [ESC] Esci")
         elif k == ' ':
-            sd.stop()
+            audio_backend.get_engine().stop_previews()
             play_battuta_audio(part, num_battuta, current_sound_type, bpm_override=bpm)
         elif k == 'p':
             current_sound_type = 1 if current_sound_type == 2 else 2
+            tipo_suono_attivo = current_sound_type
             print(f"\n[Audio] Preset cambiato: {sound_names[current_sound_type]}")
             time.sleep(0.5)
         elif k == '\r' or k == 'enter': play_continuo = True        
@@ -704,6 +709,36 @@ def salva_txt(part, label, filepath, idx, tot):
         print("Salvato.")
     except Exception as e: print(f"Errore: {e}")
 
+def salva_wav(part, label, filepath, tipo_suono=2):
+    """Renderizza la traccia con il synth di Chitabry e la salva in WAV, a blocchi."""
+    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    out_name = f"{base_name}_{''.join([c for c in label if c.isalnum() or c in (' ','-','_')]).strip()}.wav"
+    out_path = os.path.join(DEFAULT_MIDI_DIR, out_name)
+    print(f"Rendering audio in {out_path}...")
+    try:
+        with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+            cfg = json.load(f)
+            suono_params = cfg.get(f'suono_{tipo_suono}')
+            bpm = float(cfg.get('default_bpm', 60))
+        flat = part.flatten()
+        mm = flat.getElementsByClass(tempo.MetronomeMark)
+        if mm: bpm = mm[0].getQuarterBPM()
+        q_dur = 60.0 / bpm
+        if tipo_suono == 1: synth_kwargs = dict(pluck_hardness=suono_params['pluck_hardness'], damping_factor=suono_params['damping_factor'])
+        else: synth_kwargs = dict(kind=suono_params['kind'], adsr_list=suono_params['adsr'])
+        mixer = GBAudio.OfflineMixer(fs=GBAudio.FS)
+        renderer = GBAudio.NoteRenderer(fs=GBAudio.FS)
+        for el in flat.notesAndRests:
+            dur_sec = el.duration.quarterLength * q_dur
+            if dur_sec <= 0 or isinstance(el, note.Rest): continue
+            onset = float(el.offset) * q_dur
+            for p in el.pitches:
+                renderer.set_params(GBAudio.note_to_freq(p.nameWithOctave), dur_sec, suono_params['volume'], 0.0, **synth_kwargs)
+                mixer.add_note(onset, renderer)
+        durata = mixer.render_to_wav(out_path, duration=float(part.duration.quarterLength) * q_dur)
+        print(f"Salvato ({durata:.1f}s).")
+    except Exception as e: print(f"Errore durante l'esportazione WAV: {e}")
+
 def salva_pdf(part, label, filepath):
     import shutil
     from GBUtils import enter_escape
@@ -770,13 +805,16 @@ def salva_menu(part, label, filepath, idx, tot):
     print(f"\n--- Salva Traccia {idx}/{tot}: {label} ---")
     opzioni = {
         "Testo": "Salva in formato testo semplice (Standard Chitabry)",
-        "PDF": "Salva spartito grafico (Richiede LilyPond)"
+        "PDF": "Salva spartito grafico (Richiede LilyPond)",
+        "WAV": f"Salva l'audio della traccia ({SOUND_NAMES[tipo_suono_attivo]})"
     }
     s = menu(d=opzioni, p="Formato di esportazione [INVIO per annullare] > ", show=True)
     if s == "Testo":
         salva_txt(part, label, filepath, idx, tot)
     elif s == "PDF":
         salva_pdf(part, label, filepath)
+    elif s == "WAV":
+        salva_wav(part, label, filepath, tipo_suono_attivo)
 
 def send_mci_command(command):
     buffer_size = 256
@@ -791,7 +829,7 @@ def studia_traccia(part, label, filepath, idx, tot):
             "Ascolta": "Riproduce la traccia (Player MCI)",
             "Visualizza": "Mostra gli eventi (Battute/Audio)",
             "Trasponi": "Cambia tonalità (-24/+24 semitoni)",
-            "Salva": "Esporta traccia (TXT, ABC, PDF)"
+            "Salva": "Esporta traccia (TXT, ABC, PDF, WAV)"
         }
         s = menu(d=opzioni, p="Azione [INVIO per Indietro] > ", show=True)
         if not s: cleanup_temp_files(); break
@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_backend
+
+# Nessuna scheda audio nei test: gli stream vengono creati ma non partono mai
+audio_backend.set_backend("null")
@@ -0,0 +1,79 @@
+import json
+
+import numpy as np
+
+import audio_backend
+import config
+
+
+def test_impostazione_letta_dal_file_prima_del_caricamento(tmp_path, monkeypatch):
+    settings = tmp_path / "settings.json"
+    settings.write_text(json.dumps({'audio_backend': 'Loopback'}), encoding='utf-8')
+    monkeypatch.delenv(audio_backend.BACKEND_ENV_VAR, raising=False)
+    monkeypatch.setattr(config, 'FILE_IMPOSTAZIONI', str(settings))
+    monkeypatch.setattr(config, 'impostazioni', {})
+    assert audio_backend._configured_name() == "loopback"
+    # Dopo il caricamento conta config.impostazioni
+    monkeypatch.setattr(config, 'impostazioni', {'audio_backend': 'wav'})
+    assert audio_backend._configured_name() == "wav"
+
+
+def test_frequenza_del_motore_risolta_all_avvio(monkeypatch):
+    engine = audio_backend.AudioEngine(backend=audio_backend.NullBackend(realtime=False))
+    assert engine._samplerate is None
+    monkeypatch.setattr(audio_backend, '_native_samplerate', 48000)
+    try:
+        engine.start()
+        assert engine.samplerate == 48000
+        assert engine.stream.samplerate == 48000
+        assert engine.stats.samplerate == 48000
+    finally:
+        engine.close()
+
+
+def test_loopback_dimensiona_il_buffer_sulla_frequenza_dello_stream():
+    backend = audio_backend.LoopbackBackend(realtime=False, max_seconds=2)
+    backend.output_stream(48000, 2, np.float32, lambda *args: None)
+    assert backend.max_frames == 96000
+    backend.input_stream(22050, 1, np.float32, lambda *args: None)
+    assert backend.max_frames == 44100
+
+
+def _engine():
+    return audio_backend.AudioEngine(samplerate=44100, backend=audio_backend.NullBackend(realtime=False))
+
+
+def test_anteprime_mixate_sopra_i_bus():
+    engine = _engine()
+    engine._preview_queue.append(np.full((300, 2), 0.25, dtype=np.float32))
+    engine._preview_queue.append(np.full((100, 2), 0.5, dtype=np.float32))
+    out = np.zeros((256, 2), dtype=np.float32)
+    engine._audio_callback(out, 256, None, None)
+    np.testing.assert_allclose(out[:100], 0.75)
+    np.testing.assert_allclose(out[100:], 0.25)
+    engine._audio_callback(out, 256, None, None)
+    np.testing.assert_allclose(out[:44], 0.25)
+    assert not out[44:].any()
+    assert engine._preview_audio == [None] * audio_backend.ENGINE_MAX_PREVIEWS
+
+
+def test_anteprime_senza_allocazioni_nella_callback():
+    import tracemalloc
+    engine = _engine()
+    for k in range(4):
+        engine._preview_queue.append(np.full((44100, 2), 0.1, dtype=np.float32))
+    out = np.zeros((256, 2), dtype=np.float32)
+    engine._audio_callback(out, 256, None, None)
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(10):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            engine._audio_callback(out, 256, None, None)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    # Meno di un blocco stereo: solo piccoli oggetti Python
+    # Minimo sui giri: altri thread audio ancora vivi possono allocare durante una misura
+    assert min(peaks) < out.nbytes
@@ -0,0 +1,185 @@
+import contextlib
+import io
+import wave
+
+import numpy as np
+import pytest
+
+import clitronomo
+
+
+@pytest.fixture(autouse=True)
+def cache_vuota():
+    clitronomo.get_measure_cache().clear()
+    yield
+    clitronomo.get_measure_cache().clear()
+
+
+def _quiet(fn, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+
+def _metronomo_con_cambio_di_tempo(bar, bpm):
+    m = clitronomo.Metronome(bpm=120)
+    _quiet(m._add_segment_data, bar, bar, bpm, True)
+    return m
+
+
+# --- Export ---
+
+def test_export_wav_ripetibile_e_non_tocca_la_sessione(tmp_path):
+    m = _metronomo_con_cambio_di_tempo(2, 240)
+    first = _quiet(m.render_to_wav, str(tmp_path / "a.wav"), 4)
+    second = _quiet(m.render_to_wav, str(tmp_path / "b.wav"), 4)
+    assert first and second
+    with wave.open(first) as a, wave.open(second) as b:
+        data_a = a.readframes(a.getnframes())
+        data_b = b.readframes(b.getnframes())
+    assert data_a == data_b
+    samples = np.frombuffer(data_a, dtype=np.int16)
+    # Battuta 1 a 120 BPM, dalla 2 in poi a 240: almeno 2 s + 3 battute da 1 s
+    assert len(samples) >= clitronomo.SAMPLE_RATE * 5
+    assert m.bpm == 120 and m.timeline_measure_count == 0
+
+
+# --- Lookahead ---
+
+def test_ricostruzione_riparte_dai_bpm_della_battuta_in_riproduzione():
+    m = _metronomo_con_cambio_di_tempo(5, 240)
+    m._reset_timeline()
+    while m.timeline_measure_count < 5:
+        m._bar_queue.append(m._render_next_bar())
+    # La callback passa alle prime due battute della coda: il cambio a 240 è ancora lontano
+    for _ in range(2):
+        m.active_buffer = m._bar_queue.popleft().buffer
+    _quiet(m.set_subdivision, 1)
+    assert m.bpm == 120
+    m._fill_lookahead()
+    bar_120 = int(clitronomo.SAMPLE_RATE * 2)
+    assert [len(bar.buffer) for bar in m._bar_queue][:2] == [bar_120, bar_120]
+
+
+def test_set_bpm_vale_dalla_prossima_battuta():
+    m = clitronomo.Metronome(bpm=120)
+    m._reset_timeline()
+    m._fill_lookahead()
+    _quiet(m.set_bpm, 60)
+    m._fill_lookahead()
+    assert m.bpm == 60
+    assert all(len(bar.buffer) == clitronomo.SAMPLE_RATE * 4 for bar in m._bar_queue)
+
+
+def test_stop_riporta_lo_stato_della_battuta_interrotta():
+    m = _metronomo_con_cambio_di_tempo(2, 240)
+    _quiet(m.start)
+    try:
+        m._fill_lookahead()
+    finally:
+        _quiet(m.stop)
+    assert (m.bpm, m.timeline_measure_count, m.program_current_segment_index) == (120, 0, -1)
+    assert not m._bar_queue
+
+
+def _buffer_lock_libero(m):
+    """Vero se un altro thread (come la callback) può prendere buffer_lock in questo momento."""
+    import threading
+    result = []
+
+    def prova():
+        acquired = m.buffer_lock.acquire(blocking=False)
+        if acquired:
+            m.buffer_lock.release()
+        result.append(acquired)
+
+    t = threading.Thread(target=prova)
+    t.start()
+    t.join()
+    return result[0]
+
+
+def test_i_render_non_bloccano_la_callback(monkeypatch):
+    m = clitronomo.Metronome(bpm=120)
+    liberi = []
+    genera_click = clitronomo.genera_click
+    generate = m._generate_measure_buffer
+
+    def click_spia(config):
+        liberi.append(_buffer_lock_libero(m))
+        return genera_click(config)
+
+    def battuta_spia(*args, **kwargs):
+        liberi.append(_buffer_lock_libero(m))
+        return generate(*args, **kwargs)
+
+    monkeypatch.setattr(clitronomo, 'genera_click', click_spia)
+    monkeypatch.setattr(m, '_generate_measure_buffer', battuta_spia)
+    m._reset_timeline()
+    m._fill_lookahead()
+    _quiet(m.update_sound_param, 'v1', 60)
+    m._fill_lookahead()
+    assert len(liberi) >= 5
+    assert all(liberi)
+
+
+# --- Tempo frazionario ---
+
+def test_accumulatore_di_fase_non_deriva():
+    m = clitronomo.Metronome(bpm=97)
+    m._reset_timeline()
+    frames = len(m.active_buffer)
+    for _ in range(200):
+        frames += len(m._render_next_bar().buffer)
+    exact = 201 * m._measure_length()
+    assert abs(frames - exact) < 1.0
+    assert 0.0 <= m.timeline_phase < 1.0
+
+
+def test_click_sul_campione_piu_vicino():
+    m = clitronomo.Metronome(bpm=97)
+    for phase in (0.0, 0.3, 0.7):
+        buffer = m._generate_measure_buffer(phase=phase)
+        assert len(buffer) == int(phase + m._measure_length())
+        # Inizio di ogni click: primo campione non nullo dopo un tratto di silenzio
+        nonzero = np.flatnonzero(buffer)
+        starts = nonzero[np.concatenate(([True], np.diff(nonzero) > 1000))]
+        expected = [int(phase + beat * m._beat_length() + 0.5) for beat in range(m.beats_per_measure)]
+        assert np.all((starts - expected >= 0) & (starts - expected <= 2))
+
+
+# --- Cache delle battute ---
+
+def test_cache_delle_battute_riusa_i_nastri():
+    m = clitronomo.Metronome(bpm=97)
+    m._reset_timeline()
+    for _ in range(200):
+        m._render_next_bar()
+    cache = clitronomo.get_measure_cache()
+    # Le fasi possibili sono al più 64: oltre non si renderizza più nulla
+    assert len(cache) <= clitronomo.MEASURE_CACHE_PHASE_STEPS + 1
+    assert cache.hits > 0
+
+
+def test_chiave_della_battuta_muta_ignora_i_suoni():
+    a = clitronomo.MeasureCache.make_key(120, 4, 4, 0, [{'frequency_hz': 1000}], True, 0.0)
+    b = clitronomo.MeasureCache.make_key(120, 4, 4, 2, [{'frequency_hz': 2000}], True, 0.0)
+    c = clitronomo.MeasureCache.make_key(120, 4, 4, 2, [{'frequency_hz': 2000}], False, 0.0)
+    assert a == b
+    assert a != c
+
+
+def test_cache_delle_battute_rispetta_il_budget():
+    bar = np.zeros(1000, dtype=np.int16)
+    cache = clitronomo.MeasureCache(max_bytes=2 * bar.nbytes)
+    for k in range(3):
+        cache.put(k, bar.copy())
+    assert cache.get(0) is None
+    assert cache.get(2) is not None
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_cambio_di_suono_non_riusa_il_nastro_vecchio():
+    m = clitronomo.Metronome(bpm=120)
+    before = m._measure_buffer()
+    _quiet(m.update_sound_param, 'f1', 2000)
+    assert not np.array_equal(m._measure_buffer(), before)
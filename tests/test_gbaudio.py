@@ -0,0 +1,429 @@
+import numpy as np
+import pytest
+
+import GBAudio
+
+KS = dict(pluck_hardness=0.6, damping_factor=0.996, pick_position=0.15, brightness=0.4)
+
+
+@pytest.fixture(autouse=True)
+def cache_vuota():
+    GBAudio.get_render_cache().clear()
+    yield
+    GBAudio.get_render_cache().clear()
+
+
+def _solo(freq, dur, vol, seed=None, **kwargs):
+    r = GBAudio.NoteRenderer(seed=seed, use_cache=False)
+    r.set_params(freq, dur, vol, 0.0, **kwargs)
+    return r.render_mono()
+
+
+# --- Cache dei render ---
+
+def test_render_cache_lru_rispetta_il_budget():
+    wave = np.zeros(1000, dtype=np.float32)
+    cache = GBAudio.RenderCache(max_bytes=3 * wave.nbytes)
+    for k in range(3):
+        cache.put(k, wave.copy())
+    assert cache.get(0) is not None  # 0 diventa il più recente
+    cache.put(3, wave.copy())
+    assert cache.get(1) is None
+    assert cache.get(0) is not None and cache.get(3) is not None
+    assert cache.current_bytes <= cache.max_bytes
+    assert not cache.get(0).flags.writeable
+
+
+def test_make_key_quantizza_i_parametri():
+    a = GBAudio.RenderCache.make_key(44100, 440.0, 2.0, 0.35, 0.6, 0.996, 0.15, 0.4, 1, [0, 0, 0, 0])
+    b = GBAudio.RenderCache.make_key(44100, 440.0000001, 2.0, 0.35, 0.6, 0.996, 0.15, 0.4, 1, [0, 0, 0, 0])
+    c = GBAudio.RenderCache.make_key(48000, 440.0, 2.0, 0.35, 0.6, 0.996, 0.15, 0.4, 1, [0, 0, 0, 0])
+    assert a == b
+    assert a != c
+
+
+def test_durate_con_lunghezze_diverse_non_condividono_la_chiave():
+    renderer = GBAudio.NoteRenderer(fs=44100, tail_db=None)
+    lengths = []
+    for dur in (0.12346, 0.12345):
+        renderer.set_params(440.0, dur, 0.3, 0.0, **KS)
+        lengths.append(len(renderer.render()))
+    assert lengths == [5445, 5444]
+
+
+def test_il_seme_entra_nella_chiave():
+    ref = GBAudio.NoteRenderer()
+    ref.set_params(220.0, 0.5, 0.3, 0.0, **KS)
+    ref.render_mono()
+    seeded = GBAudio.NoteRenderer(seed=7)
+    seeded.set_params(220.0, 0.5, 0.3, 0.0, **KS)
+    assert seeded.cache_key() != ref.cache_key()
+    wave = seeded.render_mono()
+    np.testing.assert_allclose(wave, _solo(220.0, 0.5, 0.3, seed=7, **KS)[:len(wave)], atol=1e-6)
+    assert not np.array_equal(wave[:1000], ref.render_mono()[:1000])
+    # Per i suoni sintetici il seme non conta
+    legacy = dict(kind=1, adsr_list=[5, 10, 60, 20])
+    ref.set_params(220.0, 0.5, 0.3, 0.0, **legacy)
+    seeded.set_params(220.0, 0.5, 0.3, 0.0, **legacy)
+    assert seeded.cache_key() == ref.cache_key()
+
+
+# --- Eccitazioni ---
+
+def test_excitation_bank_lru():
+    bank = GBAudio.ExcitationBank(max_entries=2)
+    e1 = bank.get(100, 0.6, 0.15)
+    bank.get(101, 0.6, 0.15)
+    assert bank.get(100, 0.6, 0.15) is e1
+    bank.get(102, 0.6, 0.15)
+    assert len(bank) == 2
+    assert bank.get(100, 0.6, 0.15) is e1
+    assert not e1.flags.writeable
+
+
+def test_eccitazione_riproducibile_per_seme():
+    bank = GBAudio.ExcitationBank()
+    a = bank.get(100, 0.6, 0.15, seed=3)
+    np.testing.assert_array_equal(GBAudio.ExcitationBank().get(100, 0.6, 0.15, seed=3), a)
+    assert not np.array_equal(bank.get(100, 0.6, 0.15, seed=4), a)
+
+
+# --- Banco campioni ---
+
+def test_sample_bank_round_trip(tmp_path):
+    freqs = [110.0, 220.0, 330.0]
+    bank = GBAudio.SampleBank(directory=str(tmp_path))
+    assert bank.prepare(freqs, 0.5, 0.3, **KS) is False
+    bank.wait()
+    riletto = GBAudio.SampleBank(directory=str(tmp_path))
+    assert riletto.prepare(freqs, 0.5, 0.3, **KS) is True
+    for f in freqs:
+        r = GBAudio.NoteRenderer(use_cache=False)
+        r.set_params(f, 0.5, 0.3, 0.0, **KS)
+        wave = riletto.get(r.cache_key())
+        assert wave is not None
+        np.testing.assert_allclose(wave, r.render_mono()[:len(wave)], atol=1e-6)
+
+
+def test_sample_bank_con_un_altro_seme(tmp_path):
+    freqs = [110.0, 220.0]
+    default = GBAudio.SampleBank(directory=str(tmp_path))
+    seeded = GBAudio.SampleBank(directory=str(tmp_path), seed=7)
+    assert seeded.bank_id(freqs, 0.5, 0.3, **KS) != default.bank_id(freqs, 0.5, 0.3, **KS)
+    seeded.prepare(freqs, 0.5, 0.3, **KS)
+    seeded.wait()
+    r = GBAudio.NoteRenderer(seed=7, use_cache=False)
+    r.set_params(110.0, 0.5, 0.3, 0.0, **KS)
+    wave = seeded.get(r.cache_key())
+    np.testing.assert_allclose(wave, r.render_mono()[:len(wave)], atol=1e-6)
+    assert default.prepare(freqs, 0.5, 0.3, **KS) is False
+    default.wait()
+
+
+def test_sample_bank_non_passa_dalla_cache_lru(tmp_path):
+    bank = GBAudio.SampleBank(directory=str(tmp_path))
+    cache = GBAudio.get_render_cache()
+    before = (cache.hits, cache.misses)
+    bank.prepare([82.41, 110.0, 146.83], 1.0, 0.3, **KS)
+    bank.wait()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == before
+
+
+# --- Convoluzione della cassa ---
+
+@pytest.mark.parametrize("block_size, chunk", [(64, 64), (64, 37), (128, 300)])
+def test_convolver_uguale_a_np_convolve(block_size, chunk):
+    rng = np.random.default_rng(0)
+    ir = rng.standard_normal(1000).astype(np.float32) * np.exp(-np.arange(1000) / 200.0).astype(np.float32)
+    x = rng.standard_normal((4000, 2)).astype(np.float32)
+    conv = GBAudio.PartitionedConvolver(ir, block_size=block_size, mix=1.0)
+    out = x.copy()
+    for start in range(0, len(out), chunk):
+        conv.process(out[start:start + chunk])
+    for ch in range(2):
+        ref = np.convolve(x[:, ch], ir)[:len(x) - conv.latency]
+        np.testing.assert_allclose(out[conv.latency:, ch], ref, atol=1e-3)
+
+
+def test_convolver_mix_zero_ritarda_solo_il_diretto():
+    x = np.random.default_rng(1).standard_normal((1024, 2)).astype(np.float32)
+    conv = GBAudio.PartitionedConvolver(np.ones(300, dtype=np.float32), block_size=128, mix=0.0)
+    out = conv.process(x.copy())
+    np.testing.assert_allclose(out[128:], x[:-128], atol=1e-6)
+    assert not out[:128].any()
+
+
+# --- Accordi in blocco ---
+
+@pytest.mark.parametrize("kwargs", [KS, dict(kind=1, adsr_list=[5, 10, 60, 20])])
+def test_render_many_uguale_alle_note_singole(kwargs):
+    freqs = [110.0, 0, 146.83, 196.0]
+    waves = GBAudio.render_many(freqs, 0.5, 0.3, **kwargs)
+    assert waves.shape == (4, int(round(0.5 * GBAudio.FS)))
+    assert not waves[1].any()
+    for i in (0, 2, 3):
+        solo = _solo(freqs[i], 0.5, 0.3, **kwargs)
+        np.testing.assert_allclose(waves[i, :len(solo)], solo, atol=1e-6)
+    # Seconda chiamata: tutto dalla cache, uguale a meno della coda tagliata sotto la soglia
+    np.testing.assert_allclose(GBAudio.render_many(freqs, 0.5, 0.3, **kwargs), waves, atol=1e-3)
+
+
+def test_unisono_non_finisce_in_cache_con_la_chiave_della_nota_singola():
+    waves = GBAudio.render_many([440.0, 440.0], 1.0, 0.4, **KS)
+    assert not np.allclose(waves[0], waves[1])
+    assert len(GBAudio.get_render_cache()) == 1
+    cached = GBAudio.NoteRenderer()
+    cached.set_params(440.0, 1.0, 0.4, 0.0, **KS)
+    wave = cached.render_mono()
+    np.testing.assert_allclose(wave, _solo(440.0, 1.0, 0.4, **KS)[:len(wave)], atol=1e-6)
+
+
+def test_render_chord_mixa_con_pan_e_pennata():
+    freqs = [110.0, 220.0]
+    waves = GBAudio.render_many(freqs, 0.5, 0.3, **KS)
+    centro = GBAudio.render_chord(freqs, 0.5, 0.3, **KS)
+    np.testing.assert_allclose(centro[:, 0], waves.sum(axis=0) * np.cos(np.pi / 4), atol=1e-5)
+    np.testing.assert_allclose(centro[:, 0], centro[:, 1], atol=1e-6)
+
+    pennata = GBAudio.render_chord(freqs, 0.5, 0.3, pans=[-1.0, 1.0], onsets=[0.1, 0.0], **KS)
+    shift = int(round(0.1 * GBAudio.FS))
+    assert len(pennata) == waves.shape[1] + shift
+    np.testing.assert_allclose(pennata[shift:, 0], waves[0], atol=1e-6)
+    np.testing.assert_allclose(pennata[:waves.shape[1], 1], waves[1], atol=1e-6)
+
+
+# --- Voci in streaming ---
+
+def test_mixer_non_alloca_buffer_nella_callback():
+    import tracemalloc
+    player = GBAudio.PolyphonicPlayer(num_strings=6)
+    synth = GBAudio.FastGuitarSynth()
+    for i, freq in enumerate([82.41, 110.0, 146.83, 196.0, 246.94, 329.63]):
+        player.pluck_voice(i, synth.create_voice(freq, 2.0, 0.3, tail_db=None, **KS))
+    out = np.zeros((512, 2), dtype=np.float32)
+    for _ in range(3):
+        player._audio_callback(out, 512, None, None)
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(10):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            player._audio_callback(out, 512, None, None)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    # Nemmeno un blocco mono da 512 campioni: solo piccoli oggetti Python
+    # Minimo sui giri: altri thread audio ancora vivi possono allocare durante una misura
+    assert min(peaks) < 512 * 4
+    assert np.abs(out).max() > 0
+
+
+def test_string_voice_uguale_al_render_completo():
+    synth = GBAudio.FastGuitarSynth()
+    for freq in (82.41, 1318.5):
+        ref = synth.render_string(freq, 1.0, 0.4, **KS)
+        voice = synth.create_voice(freq, 1.0, 0.4, tail_db=None, **KS)
+        out = np.zeros(len(ref), dtype=np.float32)
+        pos = 0
+        for size in [1, 64, 256, 300, 5000] * 100:
+            if pos >= len(out):
+                break
+            pos += voice.read_into(out[pos:pos + size])
+        np.testing.assert_allclose(out, ref, atol=1e-6)
+
+
+# --- Player ---
+
+def test_command_ring_fifo_e_piena():
+    ring = GBAudio.CommandRing(size=4)
+    assert all(ring.push(i) for i in range(4))
+    assert not ring.push(4)
+    assert [ring.pop() for _ in range(4)] == [0, 1, 2, 3]
+    assert ring.pop() is None
+    with pytest.raises(ValueError):
+        GBAudio.CommandRing(size=6)
+
+
+def test_command_ring_tra_due_thread():
+    import threading
+    ring = GBAudio.CommandRing(size=64)
+    received = []
+
+    def consumer():
+        while len(received) < 1000:
+            item = ring.pop()
+            if item is not None:
+                received.append(item)
+
+    t = threading.Thread(target=consumer)
+    t.start()
+    for i in range(1000):
+        while not ring.push(i):
+            pass
+    t.join(timeout=10)
+    assert received == list(range(1000))
+
+
+def _ones(n=10000):
+    return GBAudio.BufferVoice(np.ones(n, dtype=np.float32))
+
+
+def test_evento_programmato_spezza_il_blocco():
+    player = GBAudio.PolyphonicPlayer(num_strings=1)
+    player.pluck_voice(0, _ones(), at=100)
+    out = np.zeros((256, 2), dtype=np.float32)
+    player._audio_callback(out, 256, None, None)
+    assert not out[:100].any()
+    assert (out[100:] > 0).all()
+
+
+def test_evento_nel_blocco_non_lascia_campioni_vecchi_sui_bus_liberi():
+    player = GBAudio.PolyphonicPlayer(num_strings=2)
+    out = np.zeros((512, 2), dtype=np.float32)
+    # Il bus 0 suona per tutto il primo blocco e finisce
+    player.pluck_voice(0, _ones(512))
+    player._audio_callback(out, 512, None, None)
+    assert out.any()
+    # Un evento a metà del secondo blocco su un altro bus, poi più nulla
+    player.pluck_voice(1, _ones(1), at=player.frame_time + 100)
+    peaks = []
+    for _ in range(4):
+        player._audio_callback(out, 512, None, None)
+        peaks.append(float(np.abs(out).max()))
+    assert peaks[1:] == [0.0, 0.0, 0.0]
+
+
+def test_voice_manager_ruba_la_voce_piu_vecchia_e_poi_quella_rilasciata():
+    player = GBAudio.PolyphonicPlayer(num_strings=2)
+    manager = GBAudio.VoiceManager(player)
+    assert manager.note_on(60, _ones()) == 0
+    assert manager.note_on(64, _ones()) == 1
+    # Bus pieni: la più vecchia lascia il posto
+    assert manager.note_on(67, _ones()) == 0
+    assert sorted(manager.active_notes()) == [64, 67]
+    # Una nota rilasciata viene rubata prima di una ancora premuta, anche se più recente
+    manager.note_off(67)
+    assert manager.note_on(71, _ones()) == 0
+    # La stessa nota ripetuta riusa il suo bus
+    assert manager.note_on(64, _ones()) == 1
+
+
+def test_release_sfuma_e_libera_il_bus():
+    player = GBAudio.PolyphonicPlayer(num_strings=1)
+    voice = _ones()
+    player.pluck_voice(0, voice)
+    player.release(0, voice, release_ms=1)
+    out = np.zeros((256, 2), dtype=np.float32)
+    player._audio_callback(out, 256, None, None)
+    assert out[0, 0] > 0
+    assert not out[100:].any()
+    assert player.buses[0] is None
+
+
+# --- Export offline ---
+
+class _Blocchi:
+    """Writer in memoria: raccoglie i blocchi e annota quante note sono già state renderizzate."""
+    def __init__(self):
+        self.blocks = []
+        self.rendered = []
+
+    def write(self, block):
+        self.blocks.append(block.copy())
+        self.rendered.append(len(GBAudio.get_render_cache()))
+
+
+def test_offline_mixer_uguale_a_render_chord():
+    freqs, onsets, pans = [110.0, 146.83, 196.0], [0.0, 0.05, 0.1], [-0.5, 0.0, 0.5]
+    mixer = GBAudio.OfflineMixer(block_size=256)
+    renderer = GBAudio.NoteRenderer(tail_db=None)
+    for f, onset, pan in zip(freqs, onsets, pans):
+        renderer.set_params(f, 0.5, 0.3, 0.0, **KS)
+        mixer.add_note(onset, renderer, pan)
+    writer = _Blocchi()
+    frames = mixer.render(writer)
+    mix = np.concatenate(writer.blocks)
+    ref = GBAudio.render_chord(freqs, 0.5, 0.3, pans=pans, onsets=onsets, tail_db=None, **KS)
+    assert frames == len(ref)
+    np.testing.assert_allclose(mix, ref, atol=1e-5)
+
+
+def test_offline_mixer_crea_le_voci_solo_all_attacco():
+    legacy = dict(kind=1, adsr_list=[5, 10, 60, 20])
+    mixer = GBAudio.OfflineMixer(block_size=512)
+    renderer = GBAudio.NoteRenderer()
+    for i in range(20):
+        renderer.set_params(GBAudio.midi_to_freq(48 + i), 0.1, 0.3, 0.0, **legacy)
+        mixer.add_note(i * 0.1, renderer)
+    # add_note salva solo i parametri: nessuna nota renderizzata in anticipo
+    assert len(GBAudio.get_render_cache()) == 0
+    writer = _Blocchi()
+    mixer.render(writer)
+    assert writer.rendered[0] <= 1
+    assert writer.rendered[-1] == 20
+    assert writer.rendered == sorted(writer.rendered)
+
+
+def test_ogni_player_ha_le_sue_statistiche():
+    a = GBAudio.PolyphonicPlayer(num_strings=1, name="test-a")
+    b = GBAudio.PolyphonicPlayer(num_strings=1, name="test-b")
+    assert a.stats is not b.stats
+    a.stats.reset()
+    b.stats.reset()
+    a.pluck_voice(0, _ones())
+    out = np.zeros((256, 2), dtype=np.float32)
+    a._audio_callback(out, 256, None, None)
+    assert a.stats.callbacks == 1
+    assert b.stats.callbacks == 0
+    # Lo stesso bus ricreato continua le sue statistiche
+    assert GBAudio.PolyphonicPlayer(num_strings=1, name="test-a").stats is a.stats
+
+
+# --- Note ---
+
+def test_tabelle_delle_note():
+    assert GBAudio.note_to_freq("A4") == pytest.approx(440.0)
+    assert GBAudio.note_to_freq("C4") == pytest.approx(261.6256, abs=1e-4)
+    assert GBAudio.note_to_freq("C~4") == pytest.approx(GBAudio.midi_to_freq(60.5))
+    assert GBAudio.note_to_midi("A4") == 69
+    for name, freq in GBAudio._NOTE_FREQ_TABLE.items():
+        if name in ('p', 'P'):
+            assert freq == 0.0
+            continue
+        assert freq == pytest.approx(GBAudio.midi_to_freq(GBAudio._parse_note(name)[0]))
+    assert GBAudio.note_to_freq("X9") == 0.0
+
+
+def test_notes_to_freqs_accetta_numeri_numpy():
+    freqs = GBAudio.notes_to_freqs([np.int64(440), np.float32(220.0), "A4", None, 0])
+    np.testing.assert_allclose(freqs, [440.0, 220.0, 440.0, 0.0, 0.0])
+
+
+# --- MIDI in ingresso ---
+
+def test_midi_in_sintetizza_fuori_dal_thread_del_chiamante(monkeypatch):
+    import threading
+    import config
+    monkeypatch.setattr(config, 'impostazioni', config.get_impostazioni_default())
+    service = GBAudio.get_render_service()
+    threads = []
+    voice_for = service.voice_for
+
+    def spia(renderer):
+        threads.append(threading.current_thread().name)
+        return voice_for(renderer)
+
+    monkeypatch.setattr(service, 'voice_for', spia)
+    synth = GBAudio.MidiInSynth(polyphony=2, name="test-midi-in")
+    synth.suono_key = 'suono_2'
+    synth.start()
+    try:
+        synth.note_on(60, 100)
+        synth.note_on(64, 30)
+        synth.note_off(60)
+    finally:
+        # stop() accoda la fine e aspetta che il thread abbia smaltito gli eventi
+        synth.stop()
+    assert threads == ["midi-in-synth", "midi-in-synth"]
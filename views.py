@@ -3,7 +3,7 @@ from music21 import pitch, scale, harmony
 from GBUtils import dgt, menu, key
 from typing import Dict
 import numpy as np
-import sounddevice as sd
+import audio_backend
 import GBAudio
 from GBAudio import FS, NoteRenderer, note_to_freq
 import config
@@ -454,6 +454,35 @@ def get_nota(nota_std_music21):
     # Ricomponi la stringa finale
     return nome_tradotto + micro_suffix + ottava
 # --- Funzioni Audio (Fase 3) ---
+
+def _kwargs_suono(suono):
+    """Parametri di sintesi di un preset, nella forma attesa da NoteRenderer.set_params."""
+    if 'pluck_hardness' in suono:
+        return dict(pluck_hardness=suono.get('pluck_hardness', 0.6), damping_factor=suono.get('damping_factor', 0.997),
+                    pick_position=suono.get('pick_position', 0.15), brightness=suono.get('brightness', 0.4))
+    return dict(kind=suono.get('kind', 1), adsr_list=suono.get('adsr', [0,0,0,0]))
+
+def applica_cassa(poly_player):
+    """Collega al player la risonanza della cassa scelta nelle impostazioni, se presente."""
+    percorso = config.impostazioni.get('cassa_ir', '')
+    if percorso:
+        mix = config.impostazioni.get('cassa_mix', GBAudio.BODY_MIX_DEFAULT)
+        poly_player.set_convolver(GBAudio.PartitionedConvolver.from_wav(percorso, fs=poly_player.fs, mix=mix))
+
+def prepara_banco_campioni(suono_key=None):
+    """
+    Prepara il banco di campioni su disco con tutte le note del manico per il suono indicato
+    (di default quello attivo). Restituisce True se il banco è già pronto; altrimenti la
+    costruzione parte in background e le note vengono sintetizzate come al solito.
+    """
+    if suono_key is None:
+        suono_key = config.impostazioni.get('tipo_suono', 'suono_1')
+    if suono_key not in ('suono_1', 'suono_2'):
+        return False
+    suono = config.impostazioni[suono_key]
+    freqs = GBAudio.notes_to_freqs(set(config.CORDE.values()))
+    return GBAudio.get_sample_bank().prepare(freqs, suono.get('dur_accordi', 9.0), suono.get('volume', 0.35),
+                                             **_kwargs_suono(suono))
 def Suona(tablatura):
     """
     Permette l'ascolto interattivo di una tablatura.
@@ -483,7 +512,8 @@ def Suona(tablatura):
     s_adsr = suono.get('adsr', [0,0,0,0])
     
     # Crea il player polifonico e i renderer
-    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=config.NUM_CORDE)
+    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=config.NUM_CORDE, name="tablatura")
+    applica_cassa(poly_player)
     renderers = [GBAudio.NoteRenderer(fs=GBAudio.FS) for _ in range(config.NUM_CORDE)]
     
     note_da_suonare = []
@@ -525,6 +555,8 @@ def Suona(tablatura):
             note_names_display.append("X")
             
     note_prompt_str = " - ".join(note_names_display)
+    render_service = GBAudio.get_render_service()
+    prepara_banco_campioni(suono_attivo_key)
     poly_player.start()
     
     try:
@@ -541,10 +573,9 @@ def Suona(tablatura):
                             if midi_nums[corda_idx_py] is not None:
                                 GBAudio.play_midi_note_temp(midi_nums[corda_idx_py], dur)
                         else:
-                            note_audio_stereo = renderers[corda_idx_py].render()
-                            if note_audio_stereo.size > 0:
-                                mono_audio = note_audio_stereo[:, 0] / renderers[corda_idx_py].pan_l if renderers[corda_idx_py].pan_l != 0 else note_audio_stereo[:, 0]
-                                poly_player.pluck(string_idx=corda_idx_py, audio_mono=mono_audio)
+                            voce = render_service.voice_for(renderers[corda_idx_py])
+                            if voce is not None:
+                                poly_player.pluck_voice(corda_idx_py, voce)
                             
             elif scelta == ' ':
                 # Cicla tra suono_1 -> suono_2 -> midi -> suono_1
@@ -574,6 +605,7 @@ def Suona(tablatura):
                                                         pick_position=pick_pos, brightness=bright)
                             else:
                                 renderers[i].set_params(note_freq[i], dur, vol, note_pan[i], kind=s_kind, adsr_list=s_adsr)
+                    prepara_banco_campioni(suono_attivo_key)
                     print(f"\n[Suono: {suono['descrizione']}]" + " "*20)
                 else:
                     inst_idx = config.impostazioni.get('midi_strumento', 0)
@@ -586,18 +618,22 @@ def Suona(tablatura):
             elif scelta == 'a' or scelta == 'q': # Pennata
                 strum_delay_sec = 0.07
                 note_order = range(config.NUM_CORDE) if scelta == 'q' else range(config.NUM_CORDE - 1, -1, -1)
+                # Le corde sintetizzate vengono programmate sull'orologio del player: nessuna attesa,
+                # la prima suona al prossimo blocco e le altre seguono con la spaziatura esatta
+                inizio = poly_player.next_frame()
+                passo = 0
                 
                 for i in note_order:
                     if note_da_suonare[i]:
                         if suono_attivo_key == 'midi':
                             if midi_nums[i] is not None:
                                 GBAudio.play_midi_note_temp(midi_nums[i], dur)
+                            aspetta(strum_delay_sec)
                         else:
-                            note_audio_stereo = renderers[i].render()
-                            if note_audio_stereo.size > 0:
-                                mono_audio = note_audio_stereo[:, 0] / renderers[i].pan_l if renderers[i].pan_l != 0 else note_audio_stereo[:, 0]
-                                poly_player.pluck(string_idx=i, audio_mono=mono_audio)
-                        aspetta(strum_delay_sec)
+                            voce = render_service.voice_for(renderers[i])
+                            if voce is not None:
+                                poly_player.pluck_voice(i, voce, at=inizio + int(round(passo * strum_delay_sec * GBAudio.FS)))
+                        passo += 1
                         
             else:
                 print("Comando non valido. Premi 1-6, A, Q, SPAZIO o ESC.")
@@ -669,7 +705,8 @@ def SuonaAccordoTeorico(note_pitch_list):
         key_map['0'] = 9 # Tasto '0' -> indice 9 (decima nota)            
         
     # 6. Prepara Renderers, Player e dati note
-    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=num_notes)
+    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=num_notes, name="accordo")
+    applica_cassa(poly_player)
     renderers = [GBAudio.NoteRenderer(fs=GBAudio.FS) for _ in range(num_notes)]
     note_freqs = []
     note_names_display = []
@@ -730,10 +767,9 @@ def SuonaAccordoTeorico(note_pitch_list):
                             if p and p.midi is not None:
                                 GBAudio.play_midi_note_temp(p.midi, dur)
                         else:
-                            note_audio_stereo = renderers[note_idx].render()
-                            if note_audio_stereo.size > 0:
-                                mono_audio = note_audio_stereo[:, 0] / renderers[note_idx].pan_l if renderers[note_idx].pan_l != 0 else note_audio_stereo[:, 0]
-                                poly_player.pluck(string_idx=note_idx, audio_mono=mono_audio)
+                            voce = renderers[note_idx].create_voice()
+                            if voce is not None:
+                                poly_player.pluck_voice(note_idx, voce)
                     else:
                         print("Nota non valida o senza frequenza.")
                 else:
@@ -778,6 +814,8 @@ def SuonaAccordoTeorico(note_pitch_list):
             elif scelta == 'q' or scelta == 'a': # Strum
                 strum_delay_sec = 0.05 # Più veloce per accordi
                 note_order = range(num_notes) if scelta == 'q' else range(num_notes - 1, -1, -1)
+                inizio = poly_player.next_frame()
+                passo = 0
                 
                 for i in note_order:
                     if note_freqs[i] > 0:
@@ -785,12 +823,12 @@ def SuonaAccordoTeorico(note_pitch_list):
                             p = pitches_to_play[i]
                             if p and p.midi is not None:
                                 GBAudio.play_midi_note_temp(p.midi, dur)
+                            aspetta(strum_delay_sec)
                         else:
-                            note_audio_stereo = renderers[i].render()
-                            if note_audio_stereo.size > 0:
-                                mono_audio = note_audio_stereo[:, 0] / renderers[i].pan_l if renderers[i].pan_l != 0 else note_audio_stereo[:, 0]
-                                poly_player.pluck(string_idx=i, audio_mono=mono_audio)
-                        aspetta(strum_delay_sec)
+                            voce = renderers[i].create_voice()
+                            if voce is not None:
+                                poly_player.pluck_voice(i, voce, at=inizio + int(round(passo * strum_delay_sec * GBAudio.FS)))
+                        passo += 1
 
             else:
                 print("Comando non valido.")
@@ -1216,41 +1254,15 @@ def VisualizzaEsercitatiScala():
             loop_messaggio_stampato = False
 
             num_notes = len(note_per_audio_asc)
-            poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=num_notes + 1)
+            poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=num_notes + 1, name="scala")
+            applica_cassa(poly_player)
             poly_player.set_pan(num_notes, 0.0) # Metronomo centrato
             renderers = [GBAudio.NoteRenderer(fs=GBAudio.FS) for _ in range(num_notes)]
 
-            # Caricamento del preset di metronomo attivo
+            # Click del preset di metronomo attivo, gli stessi del metronomo
             metronomo_attivo = False
             import clitronomo
-            import sys
-            import io
-            
-            old_stdout = sys.stdout
-            sys.stdout = io.StringIO()
-            try:
-                preset_mgr = clitronomo.PresetManager()
-                _, last_state = preset_mgr.get_last_used_preset()
-            except Exception:
-                last_state = None
-            finally:
-                sys.stdout = old_stdout
-
-            if last_state:
-                config_accento = last_state.get('config_accento')
-                config_tick = last_state.get('config_tick')
-            else:
-                config_accento = {
-                    "beep_duration_ms": 70, "volume_perc": 50, "attack_ms": 5,
-                    "decay_ms": 8, "frequency_hz": 915.0
-                }
-                config_tick = {
-                    "beep_duration_ms": 40, "volume_perc": 35, "attack_ms": 5,
-                    "decay_ms": 12, "frequency_hz": 550.0
-                }
-
-            accent_beep = clitronomo.genera_suono_mono_int16(config_accento).astype(np.float32) / 32767.0
-            tick_beep = clitronomo.genera_suono_mono_int16(config_tick).astype(np.float32) / 32767.0
+            accent_beep, tick_beep = clitronomo.click_preset_attivo()
 
             def aggiorna_renderers(suono_key):
                 if suono_key == 'midi':
@@ -1289,6 +1301,7 @@ def VisualizzaEsercitatiScala():
                 key_map_scala['0'] = 9
 
             nota_precedente_loop = None
+            inizio_loop = None # Ancora del prossimo giro di loop, sulla griglia del giro precedente
 
             while True: # Inizio Loop Esercizio
                 scelta_raw = ""
@@ -1314,12 +1327,19 @@ def VisualizzaEsercitatiScala():
                         extra_beats = 0
                         
                     dur_step = 60.0 / bpm
+                    # Ogni passo cade su una griglia assoluta dell'orologio del player: il primo giro parte
+                    # al prossimo blocco, i successivi proseguono la griglia del precedente. I passi
+                    # dopo il primo vengono programmati con un leggero anticipo (il MIDI esterno all'istante)
+                    anticipo = 0.0 if suono_attivo_key == 'midi' else GBAudio.SCHEDULE_LEAD
+                    inizio = inizio_loop if inizio_loop is not None else poly_player.next_frame()
                     
                     interrotto = False
                     beat_in_measure = 0
                     for idx_step in range(num_notes + extra_beats):
+                        t_passo = inizio + int(round(idx_step * dur_step * GBAudio.FS))
+                        t_prossimo = inizio + int(round((idx_step + 1) * dur_step * GBAudio.FS))
                         if nota_precedente_loop is not None:
-                            poly_player.mute(nota_precedente_loop)
+                            poly_player.mute(nota_precedente_loop, at=t_passo)
                             
                         if idx_step < num_notes:
                             idx = seq[idx_step]
@@ -1329,10 +1349,9 @@ def VisualizzaEsercitatiScala():
                                     midi_num = GBAudio.freq_to_midi(freq)
                                     GBAudio.play_midi_note_temp(midi_num, dur_step)
                                 else:
-                                    note_audio_stereo = renderers[idx].render()
-                                    if note_audio_stereo.size > 0:
-                                        mono_audio = note_audio_stereo[:, 0] / renderers[idx].pan_l if renderers[idx].pan_l != 0 else note_audio_stereo[:, 0]
-                                        poly_player.pluck(string_idx=idx, audio_mono=mono_audio)
+                                    voce = renderers[idx].create_voice()
+                                    if voce is not None:
+                                        poly_player.pluck_voice(idx, voce, at=t_passo)
                                         nota_precedente_loop = idx
                         else:
                             nota_precedente_loop = None
@@ -1341,12 +1360,11 @@ def VisualizzaEsercitatiScala():
                             is_accent = (beat_in_measure % 4 == 0)
                             click_audio = accent_beep if is_accent else tick_beep
                             if click_audio.size > 0:
-                                poly_player.pluck(string_idx=num_notes, audio_mono=click_audio)
+                                poly_player.pluck(string_idx=num_notes, audio_mono=click_audio, at=t_passo)
                             beat_in_measure += 1
 
-                        passi = int(dur_step / 0.02)
-                        for _ in range(passi):
-                            tasto = key(attesa=0.02)
+                        while poly_player.seconds_until(t_prossimo) > anticipo:
+                            tasto = key(attesa=min(0.02, max(0.001, poly_player.seconds_until(t_prossimo) - anticipo)))
                             if tasto:
                                 tasto_lower = tasto.lower()
                                 if tasto_lower == 'l':
@@ -1379,20 +1397,19 @@ def VisualizzaEsercitatiScala():
                                     break
                         if interrotto:
                             break
-                        
-                        rimanente = dur_step - (passi * 0.02)
-                        if rimanente > 0:
-                            aspetta(rimanente)
                             
                     if interrotto:
+                        inizio_loop = None
                         if not loop_attivo and tasto == chr(27):
                             break
                         continue
                     
                     loop_count += 1
+                    inizio_loop = t_prossimo
                     
                 else: # Modalità Menu Interattivo
                     loop_messaggio_stampato = False
+                    inizio_loop = None
                     note_da_mostrare = note_asc_str if ultima_direzione == 'a' else note_desc_str
                     if suono_attivo_key == 'midi':
                         suono_abbrev = "MID"
@@ -1439,10 +1456,9 @@ def VisualizzaEsercitatiScala():
                                 dur_play = config.impostazioni['suono_1'].get('dur_accordi', 2.0)
                                 GBAudio.play_midi_note_temp(midi_num, dur_play)
                             else:
-                                note_audio_stereo = renderers[idx].render()
-                                if note_audio_stereo.size > 0:
-                                    mono_audio = note_audio_stereo[:, 0] / renderers[idx].pan_l if renderers[idx].pan_l != 0 else note_audio_stereo[:, 0]
-                                    poly_player.pluck(string_idx=idx, audio_mono=mono_audio)
+                                voce = renderers[idx].create_voice()
+                                if voce is not None:
+                                    poly_player.pluck_voice(idx, voce)
                         continue
                     elif scelta_lower == 'l':
                         loop_attivo = True
@@ -1468,14 +1484,19 @@ def VisualizzaEsercitatiScala():
                             extra_beats = 0
                             
                         dur_step = 60.0 / bpm
+                        # Il primo passo suona subito, i successivi vengono programmati con anticipo
+                        anticipo = 0.0 if suono_attivo_key == 'midi' else GBAudio.SCHEDULE_LEAD
+                        inizio = poly_player.next_frame()
                         
                         nota_precedente_singolo = None
                         interrotto = False
                         beat_in_measure = 0
                         
                         for idx_step in range(num_notes + extra_beats):
+                            t_passo = inizio + int(round(idx_step * dur_step * GBAudio.FS))
+                            t_prossimo = inizio + int(round((idx_step + 1) * dur_step * GBAudio.FS))
                             if nota_precedente_singolo is not None:
-                                poly_player.mute(nota_precedente_singolo)
+                                poly_player.mute(nota_precedente_singolo, at=t_passo)
                             
                             if idx_step < num_notes:
                                 idx = seq[idx_step]
@@ -1485,10 +1506,9 @@ def VisualizzaEsercitatiScala():
                                         midi_num = GBAudio.freq_to_midi(freq)
                                         GBAudio.play_midi_note_temp(midi_num, dur_step)
                                     else:
-                                        note_audio_stereo = renderers[idx].render()
-                                        if note_audio_stereo.size > 0:
-                                            mono_audio = note_audio_stereo[:, 0] / renderers[idx].pan_l if renderers[idx].pan_l != 0 else note_audio_stereo[:, 0]
-                                            poly_player.pluck(string_idx=idx, audio_mono=mono_audio)
+                                        voce = renderers[idx].create_voice()
+                                        if voce is not None:
+                                            poly_player.pluck_voice(idx, voce, at=t_passo)
                                             nota_precedente_singolo = idx
                             else:
                                 nota_precedente_singolo = None
@@ -1497,12 +1517,11 @@ def VisualizzaEsercitatiScala():
                                 is_accent = (beat_in_measure % 4 == 0)
                                 click_audio = accent_beep if is_accent else tick_beep
                                 if click_audio.size > 0:
-                                    poly_player.pluck(string_idx=num_notes, audio_mono=click_audio)
+                                    poly_player.pluck(string_idx=num_notes, audio_mono=click_audio, at=t_passo)
                                 beat_in_measure += 1
 
-                            passi = int(dur_step / 0.02)
-                            for _ in range(passi):
-                                tasto = key(attesa=0.02)
+                            while poly_player.seconds_until(t_prossimo) > anticipo:
+                                tasto = key(attesa=min(0.02, max(0.001, poly_player.seconds_until(t_prossimo) - anticipo)))
                                 if tasto:
                                     tasto_lower = tasto.lower()
                                     if tasto_lower == ' ':
@@ -1525,10 +1544,6 @@ def VisualizzaEsercitatiScala():
                                         break
                             if interrotto:
                                 break
-                            
-                            rimanente = dur_step - (passi * 0.02)
-                            if rimanente > 0:
-                                aspetta(rimanente)
                         continue
 
         print("Fine esercizio.") 
@@ -1773,7 +1788,8 @@ def GestoreImpostazioni():
             '1': f"Modifica {config.impostazioni['suono_1']['descrizione']}",
             '2': f"Modifica {config.impostazioni['suono_2']['descrizione']}",
             '3': f"Seleziona Strumento MIDI (Attivo: {GBAudio.MIDI_INSTRUMENTS[config.impostazioni.get('midi_strumento', 0)]})",
-            '4': f"Connetti Tastiera MIDI (Attivo: {midi_in_desc})"
+            '4': f"Connetti Tastiera MIDI (Attivo: {midi_in_desc})",
+            '5': f"Risonanza della cassa (IR: {config.impostazioni.get('cassa_ir', '') or 'Nessuna'})"
         }
         
         scelta = menu(d=menu_impostazioni, keyslist=True, show=True, show_on_filter=False, ntf="Scelta non valida")
@@ -1863,6 +1879,21 @@ def GestoreImpostazioni():
                     config.salva_impostazioni()
                 key("Premi un tasto...")
             
+        elif scelta == '5':
+            print("\nFile WAV con la risposta all'impulso della cassa (INVIO vuoto per disattivarla).")
+            percorso = dgt("Percorso del file: ", smax=260).strip().strip('"')
+            if percorso == "":
+                config.impostazioni['cassa_ir'] = ""
+                print("Risonanza della cassa disattivata.")
+            elif GBAudio.load_impulse_response(percorso) is not None:
+                mix_attuale = int(round(config.impostazioni.get('cassa_mix', GBAudio.BODY_MIX_DEFAULT) * 100))
+                mix = dgt(f"Quantità di cassa in % (attuale: {mix_attuale}): ", kind='i', imin=0, imax=100, default=mix_attuale)
+                config.impostazioni['cassa_ir'] = percorso
+                config.impostazioni['cassa_mix'] = mix / 100.0
+                print(f"Risonanza della cassa attivata: {percorso}")
+            config.archivio_modificato = True
+            key("Premi un tasto...")
+
         elif scelta == 'i' or scelta is None:
             print("Ritorno al menu principale.")
             break
@@ -1938,21 +1969,16 @@ def TrovaPosizione():
             pan = -0.8 + (corda_idx_zero_based * 0.32)
             vol = suono_1['volume'] 
             
-            # Crea un singolo renderer
-            hardness = suono_1.get('pluck_hardness', 0.6)
-            damping = suono_1.get('damping_factor', 0.997)        
+            # Stessi parametri del banco di campioni: dal secondo avvio la nota si legge dal disco
+            prepara_banco_campioni('suono_1')
             renderer = NoteRenderer(fs=FS)
-            
-            # Imposta i parametri
-            renderer.set_params(freq, dur, vol, pan, 
-                                pluck_hardness=hardness, 
-                                damping_factor=damping)        
+            renderer.set_params(freq, dur, vol, pan, **_kwargs_suono(suono_1))
             # Renderizza la nota e la ottiene
             note_audio = renderer.render()
             
             # Suona (non bloccante) sul buffer renderizzato
             if note_audio.size > 0:
-                sd.play(note_audio, samplerate=GBAudio.FS, blocking=False)
+                audio_backend.get_engine().play(note_audio, GBAudio.FS)
         
     elif s == "":
         print("Operazione annullata.")
@@ -2222,49 +2248,44 @@ def PlayerGenerico():
         '"': (1, 2),  '£': (3, 2),  '%': (6, 2),  '&': (8, 2),  '/': (10, 2), ')': (13, 2), '=': (15, 2), '^': (18, 2),
     }
 
-    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=16) 
-    num_voices = 16
-    renderers = [GBAudio.NoteRenderer(fs=GBAudio.FS) for _ in range(num_voices)]
-    voice_idx = 0
+    num_voices = config.impostazioni.get('polifonia', GBAudio.DEFAULT_POLYPHONY)
+    poly_player = GBAudio.PolyphonicPlayer(fs=GBAudio.FS, num_strings=num_voices, name="tastiera")
+    applica_cassa(poly_player)
+    voice_manager = GBAudio.VoiceManager(poly_player, polyphony=num_voices)
+    renderer_tastiera = GBAudio.NoteRenderer(fs=GBAudio.FS)
+    render_service = GBAudio.get_render_service()
 
     midi_in = GBAudio.get_midi_in()
     old_on_note_on = None
     old_on_note_off = None
+    # Le note della tastiera MIDI passano dal thread di MidiInSynth, mai da quello di winmm
+    midi_synth = GBAudio.get_midi_in_synth()
+    old_suono_key = midi_synth.suono_key
 
     poly_player.start()
     
     if midi_in is not None:
         old_on_note_on = midi_in.on_note_on
         old_on_note_off = midi_in.on_note_off
+        midi_synth.suono_key = suono_attivo_key
+        midi_synth.start()
         
         def player_note_on(note_num, velocity):
-            nonlocal voice_idx
+            # Callback di winmm: si accoda la nota e basta, la sintesi la fa MidiInSynth
             if suono_attivo_key == 'midi':
                 GBAudio.get_midi_out().note_on(note_num, velocity)
             else:
-                freq = 440.0 * (2.0 ** ((note_num - 69) / 12.0))
-                v = voice_idx % num_voices
-                voice_idx += 1
-                suono = config.impostazioni[suono_attivo_key]
-                if 'pluck_hardness' in suono:
-                    renderers[v].set_params(freq, p['dur'], p['vol'], 0.0, 
-                                            pluck_hardness=p['hardness'], damping_factor=p['damping'],
-                                            pick_position=p['pick_pos'], brightness=p['bright'])
-                else:
-                    renderers[v].set_params(freq, p['dur'], p['vol'], 0.0, kind=p['kind'], adsr_list=p['adsr'])
-                note_audio = renderers[v].render()
-                if note_audio.size > 0:
-                    mono_audio = note_audio[:, 0] / renderers[v].pan_l if renderers[v].pan_l != 0 else note_audio[:, 0]
-                    poly_player.pluck(string_idx=v, audio_mono=mono_audio)
+                midi_synth.note_on(note_num, velocity)
             
-            nota_obj = pitch.Pitch(midi=note_num)
-            nota_nome = get_nota(nota_obj.nameWithOctave.replace('-', 'b'))
+            nota_nome = get_nota(_midi_to_note_std(note_num))
             freq_calc = 440.0 * (2.0 ** ((note_num - 69) / 12.0))
             print(f"\r[Tastiera MIDI] Nota: {nota_nome} ({freq_calc:.1f} Hz){' '*15}\r", end="", flush=True)
 
         def player_note_off(note_num):
             if suono_attivo_key == 'midi':
                 GBAudio.get_midi_out().note_off(note_num)
+            else:
+                midi_synth.note_off(note_num)
                 
         midi_in.on_note_on = player_note_on
         midi_in.on_note_off = player_note_off
@@ -2307,6 +2328,7 @@ def PlayerGenerico():
                     suono_attivo_key = 'midi'
                 else:
                     suono_attivo_key = 'suono_1'
+                midi_synth.suono_key = suono_attivo_key
                 
                 p = get_synth_params('suono_1' if suono_attivo_key == 'midi' else suono_attivo_key)
                 print(f"\r[Suono: {get_desc_suono(suono_attivo_key)}] Ottava Base: {base_octave}{' '*20}\r", end="", flush=True)
@@ -2336,21 +2358,16 @@ def PlayerGenerico():
                     dur = suono_1.get('dur_accordi', 2.0)
                     GBAudio.play_midi_note_temp(midi_num, dur)
                 else:
-                    v = voice_idx % num_voices
-                    voice_idx += 1
-                    
                     suono = config.impostazioni[suono_attivo_key]
                     if 'pluck_hardness' in suono:
-                        renderers[v].set_params(freq, p['dur'], p['vol'], 0.0, 
-                                                pluck_hardness=p['hardness'], damping_factor=p['damping'],
-                                                pick_position=p['pick_pos'], brightness=p['bright'])
+                        renderer_tastiera.set_params(freq, p['dur'], p['vol'], 0.0, 
+                                                     pluck_hardness=p['hardness'], damping_factor=p['damping'],
+                                                     pick_position=p['pick_pos'], brightness=p['bright'])
                     else:
-                        renderers[v].set_params(freq, p['dur'], p['vol'], 0.0, kind=p['kind'], adsr_list=p['adsr'])
+                        renderer_tastiera.set_params(freq, p['dur'], p['vol'], 0.0, kind=p['kind'], adsr_list=p['adsr'])
                     
-                    note_audio = renderers[v].render()
-                    if note_audio.size > 0:
-                        mono_audio = note_audio[:, 0] / renderers[v].pan_l if renderers[v].pan_l != 0 else note_audio[:, 0]
-                        poly_player.pluck(string_idx=v, audio_mono=mono_audio)
+                    # La tastiera del PC non invia note-off: la nota suona per tutta la sua durata
+                    voice_manager.note_on(midi_num, render_service.voice_for(renderer_tastiera), held=False)
                 
                 # Calcola il nome della nota per il display
                 nota_obj = pitch.Pitch(midi=midi_num)
@@ -2361,6 +2378,7 @@ def PlayerGenerico():
         if midi_in is not None:
             midi_in.on_note_on = old_on_note_on
             midi_in.on_note_off = old_on_note_off
+        midi_synth.suono_key = old_suono_key
         poly_player.stop()
         print("\nUscita dal Player Generico.")
 
@@ -2390,15 +2408,11 @@ def Accordatore():
     import threading
     from GBUtils import enter_escape
     import time
-    devices = sd.query_devices()
+    backend = audio_backend.get_backend()
+    devices = backend.input_devices()
     input_devices = {}
-    for idx, dev in enumerate(devices):
-        if dev['max_input_channels'] > 0:
-            try:
-                api_name = sd.query_hostapis(dev['hostapi'])['name']
-            except Exception:
-                api_name = "Sconosciuto"
-            input_devices[str(idx)] = f"{dev['name']} [{api_name}]"
+    for idx, dev in devices.items():
+        input_devices[str(idx)] = f"{dev['name']} [{dev['hostapi']}]"
     if not input_devices:
         print("\nErrore: Nessun dispositivo di input audio (microfono) trovato.")
         key("Premi un tasto per continuare...")
@@ -2413,15 +2427,14 @@ def Accordatore():
         lock = threading.Lock()
         def test_device(device_idx):
             try:
-                dev_info = sd.query_devices(device_idx, 'input')
-                sr = int(dev_info['default_samplerate'])
+                sr = int(devices[device_idx]['default_samplerate'])
                 max_rms = [0.0]
                 def callback(indata, frames, time_info, status):
                     mono = indata[:, 0]
                     rms = float(np.sqrt(np.mean(mono ** 2)))
                     if rms > max_rms[0]:
                         max_rms[0] = rms
-                stream = sd.InputStream(
+                stream = backend.input_stream(
                     device=device_idx,
                     samplerate=sr,
                     channels=1,
@@ -2446,15 +2459,14 @@ def Accordatore():
         if failed_parallel:
             for idx in failed_parallel:
                 try:
-                    dev_info = sd.query_devices(idx, 'input')
-                    sr = int(dev_info['default_samplerate'])
+                    sr = int(devices[idx]['default_samplerate'])
                     max_rms = [0.0]
                     def callback(indata, frames, time_info, status):
                         mono = indata[:, 0]
                         rms = float(np.sqrt(np.mean(mono ** 2)))
                         if rms > max_rms[0]:
                             max_rms[0] = rms
-                    stream = sd.InputStream(
+                    stream = backend.input_stream(
                         device=idx,
                         samplerate=sr,
                         channels=1,
@@ -2482,8 +2494,7 @@ def Accordatore():
     if scelta_device is None:
         return
     device_idx = int(scelta_device)
-    dev_info = sd.query_devices(device_idx, 'input')
-    device_sr = int(dev_info['default_samplerate'])
+    device_sr = int(devices[device_idx]['default_samplerate'])
     BLOCK_SIZE = 4096
     RMS_THRESHOLD = 0.002
     # Autocorrelazione: soglia per il primo picco significativo
@@ -2559,7 +2570,7 @@ def Accordatore():
         return sr / refined_lag
     def _audio_callback(indata, frames, time_info, status):
         if stop_event.is_set():
-            raise sd.CallbackAbort
+            raise audio_backend.CallbackAbort
         mono = indata[:, 0]
         rms = float(np.sqrt(np.mean(mono ** 2)))
         current_rms[0] = rms
@@ -2573,7 +2584,7 @@ def Accordatore():
     print("Accordatore cromatico.")
     print("ESC per uscire.")
     try:
-        stream = sd.InputStream(
+        stream = backend.input_stream(
             device=device_idx,
             samplerate=device_sr,
             channels=1,